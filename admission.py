@@ -0,0 +1,179 @@
+from flask import request, jsonify, g, current_app
+from werkzeug.middleware.proxy_fix import ProxyFix
+from collections import OrderedDict, namedtuple
+import logging
+import math
+import os
+import threading
+import time
+import jwt
+
+# Admission control: per-route concurrency limits, per-client concurrency limits
+# and per-client token bucket rate limits, kept in process memory. Expensive
+# routes (password hashing, SMTP, exports, imports) are throttled with fast 429
+# or 503 responses so they can't starve the clinical read endpoints, which
+# have no limits.
+
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'True').lower() == 'true'
+
+def default_proxy_hops(environ=os.environ):
+    """
+    Vercel's edge network sets X-Forwarded-For to the client address, replacing
+    anything the client sent, so one hop is trusted when running there
+    """
+    return 1 if environ.get('VERCEL') else 0
+
+
+# Number of reverse proxies in front of the app that append to X-Forwarded-For.
+# Clients are told apart by the address the outermost trusted proxy saw; with 0
+# the header is ignored, since any client can send it. Behind a proxy that
+# must not be 0: every anonymous caller would share the proxy's address, and
+# so one rate limit bucket.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', default_proxy_hops()))
+
+logger = logging.getLogger(__name__)
+
+# concurrency: requests served at once by a worker across all clients
+# client_concurrency: requests served at once for a single client
+# rate, burst: token bucket refill per second and capacity, per client
+RouteLimit = namedtuple('RouteLimit', ['concurrency', 'client_concurrency', 'rate', 'burst'])
+
+ROUTE_LIMITS = {
+    'login': RouteLimit(concurrency=8, client_concurrency=2, rate=0.5, burst=5),
+    'verify_login': RouteLimit(concurrency=16, client_concurrency=2, rate=1, burst=10),
+    'register': RouteLimit(concurrency=4, client_concurrency=1, rate=0.1, burst=3),
+    'verify_registration': RouteLimit(concurrency=8, client_concurrency=2, rate=0.5, burst=5),
+    'resend_totp': RouteLimit(concurrency=4, client_concurrency=1, rate=1 / 30, burst=2),
+    'refresh_token': RouteLimit(concurrency=16, client_concurrency=2, rate=1, burst=10),
+    'patient_import.import_patients_route': RouteLimit(concurrency=2, client_concurrency=1, rate=0.1, burst=2),
+    'patient_export.export_patient': RouteLimit(concurrency=8, client_concurrency=2, rate=1, burst=5),
+    'logs.export_audit_logs': RouteLimit(concurrency=4, client_concurrency=1, rate=0.2, burst=2),
+}
+
+# Number of per-client buckets and counters kept before the least recent are dropped
+MAX_TRACKED_CLIENTS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token; return 0 on success or the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    def __init__(self, limits):
+        self.limits = limits
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.route_active = {endpoint: 0 for endpoint in limits}
+        self.client_active = OrderedDict()
+
+    def track(self, table, key, factory):
+        value = table.get(key)
+        if value is None:
+            value = table[key] = factory()
+        table.move_to_end(key)
+        while len(table) > MAX_TRACKED_CLIENTS:
+            table.popitem(last=False)
+        return value
+
+    def admit(self, endpoint, client):
+        """
+        Try to admit a request. Returns None when admitted, otherwise
+        (status, message, retry_after seconds).
+        """
+        limit = self.limits[endpoint]
+        key = (endpoint, client)
+
+        with self.lock:
+            bucket = self.track(self.buckets, key, lambda: TokenBucket(limit.rate, limit.burst))
+            wait = bucket.take()
+            if wait:
+                return 429, 'Too many requests, please retry later', math.ceil(wait)
+
+            if self.route_active[endpoint] >= limit.concurrency:
+                return 503, 'Server busy, please retry shortly', 1
+
+            active = self.client_active.get(key, 0)
+            if active >= limit.client_concurrency:
+                return 429, 'Too many concurrent requests', 1
+
+            self.route_active[endpoint] += 1
+            self.track(self.client_active, key, int)
+            self.client_active[key] = active + 1
+        return None
+
+    def release(self, endpoint, client):
+        key = (endpoint, client)
+        with self.lock:
+            self.route_active[endpoint] -= 1
+            if self.client_active.get(key, 0) > 1:
+                self.client_active[key] -= 1
+            else:
+                self.client_active.pop(key, None)
+
+
+controller = AdmissionController(ROUTE_LIMITS)
+
+
+def client_key():
+    """
+    Identify the caller: the user of a validly signed bearer token, otherwise
+    the client address. Nothing the client can forge picks the bucket.
+    """
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        try:
+            data = jwt.decode(auth_header.split(' ')[1], current_app.config['SECRET_KEY'], algorithms=["HS256"])
+            return f"user:{data['user_id']}"
+        except Exception:
+            pass
+    # Resolved from X-Forwarded-For by ProxyFix only for trusted proxy hops
+    return f"ip:{request.remote_addr}"
+
+
+def before_request():
+    endpoint = request.endpoint
+    if endpoint not in ROUTE_LIMITS or request.method == 'OPTIONS':
+        return None
+
+    client = client_key()
+    rejection = controller.admit(endpoint, client)
+    if rejection:
+        status, message, retry_after = rejection
+        return jsonify({'message': message, 'retry_after': retry_after}), status, {'Retry-After': str(retry_after)}
+
+    g.admission = (endpoint, client)
+    return None
+
+
+def teardown_request(exc):
+    admission = g.pop('admission', None)
+    if admission:
+        controller.release(*admission)
+
+
+def init_app(app):
+    if TRUSTED_PROXY_HOPS:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+    if not ADMISSION_CONTROL:
+        return
+    if not TRUSTED_PROXY_HOPS:
+        logger.warning(
+            "TRUSTED_PROXY_HOPS is 0: anonymous clients are told apart by their direct address. "
+            "Behind a reverse proxy or load balancer they all share one rate limit; set it to the number of proxies."
+        )
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
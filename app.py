@@ -3,26 +3,44 @@
 
 from flask import Flask, request, jsonify, Blueprint
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, firestore
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 import datetime
 import os
 from functools import wraps
 import json
+import logging
 from dotenv import load_dotenv
 import random
 import string
 from flask_mail import Mail, Message
 
+import admission
+import tracing
+from database import get_db, warm_up, health_check, reconnect, CONNECTION_ERRORS
 from logs import logs_bp
 from patient_routes import patient_bp
 from chat import chat_bp
+from patient_import import import_bp
+from patient_export import export_bp
+from bootstrap import bootstrap_bp, prefetch_working_set
+from batch import batch_bp, batch_user
+from refresh_tokens import (
+    RefreshTokenError, issue_refresh_token, rotate_refresh_token, revoke_refresh_token, revoke_user_tokens
+)
 
 load_dotenv()
+tracing.configure_logging()
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app)
+
+# Start the request's trace first, so throttled requests are traced too
+tracing.init_app(app)
+
+# Throttle expensive routes before any other request handling
+admission.init_app(app)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
 
 # Configure Flask-Mail
@@ -36,34 +54,36 @@ app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', app.co
 
 mail = Mail(app)
 
-# Firebase initialization
-if not firebase_admin._apps:
-    if 'FIREBASE_CREDENTIALS' in os.environ:
-        # For production (Vercel)
-        cred_dict = json.loads(os.environ.get('FIREBASE_CREDENTIALS'))
-        cred = credentials.Certificate(cred_dict)
-    else:
-        # For local development
-        cred = credentials.Certificate('serviceAccountKey.json')
-    
-    firebase_admin.initialize_app(cred)
-
-def get_db():
-    return firestore.client()
-
 db = get_db()
 
+# Open the Firestore connection at worker start rather than on the first request
+if os.environ.get('FIRESTORE_WARMUP', 'True').lower() == 'true':
+    warm_up()
+
 app.register_blueprint(patient_bp)
 
 app.register_blueprint(logs_bp)
 
 app.register_blueprint(chat_bp)
+
+app.register_blueprint(import_bp)
+
+app.register_blueprint(export_bp)
+
+app.register_blueprint(bootstrap_bp)
+
+app.register_blueprint(batch_bp)
 # Create a blueprint for MFA-related routes
 mfa_bp = Blueprint('mfa', __name__)
 JWT_EXPIRATION = datetime.timedelta(minutes=60*6)  # 360 minutes
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
+        # Sub-requests of /api/batch were authenticated once by the batch request
+        current_user = batch_user()
+        if current_user is not None:
+            return f(current_user, *args, **kwargs)
+
         token = None
         
         if 'Authorization' in request.headers:
@@ -94,29 +114,95 @@ def token_required(f):
     
     return decorated
 
-@app.route('/api/refresh-token', methods=['POST'])
-@token_required
-def refresh_token(current_user):
-    """Endpoint to refresh the JWT token based on current user activity"""
-    
-    # Generate a new JWT token with a fresh expiration time
-    token = jwt.encode(
+def handle_firestore_connection_error(e):
+    # Rebuild the channel so the next request doesn't hit the same broken connection
+    reconnect()
+    return jsonify({'message': 'Database temporarily unavailable, please retry'}), 503, {'Retry-After': '1'}
+
+for connection_error in CONNECTION_ERRORS:
+    app.register_error_handler(connection_error, handle_firestore_connection_error)
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    firestore_status = health_check()
+    status_code = 200 if firestore_status['status'] == 'ok' else 503
+    return jsonify({
+        'status': firestore_status['status'],
+        'firestore': firestore_status
+    }), status_code
+
+def issue_jwt(user_id, user_data):
+    """Sign a JWT for a user with the configured timeout"""
+    return jwt.encode(
         {
-            'user_id': current_user['id'],
-            'email': current_user['email'],
-            'role': current_user.get('role', 'doctor'),
+            'user_id': user_id,
+            'email': user_data.get('email'),
+            'role': user_data.get('role', 'doctor'),
             'exp': datetime.datetime.now() + JWT_EXPIRATION
         },
         app.config['SECRET_KEY'],
         algorithm="HS256"
     )
+
+
+@app.route('/api/refresh-token', methods=['POST'])
+def refresh_token():
+    """
+    Endpoint to refresh the JWT token
+
+    With a refresh_token (and the device_id it was issued to) in the body, the
+    refresh token is rotated and a new JWT is issued even if the old one has
+    expired. Otherwise the JWT in the Authorization header is renewed.
+    """
+    data = request.get_json(silent=True) or {}
+    if not data.get('refresh_token'):
+        return refresh_jwt()
+    
+    try:
+        user_id, new_refresh_token = rotate_refresh_token(db, data['refresh_token'], data.get('device_id'))
+    except RefreshTokenError as e:
+        return jsonify({'message': e.message, 'code': 'REFRESH_TOKEN_INVALID'}), e.code
+    
+    user_ref = db.collection('users').document(user_id).get()
+    if not user_ref.exists:
+        return jsonify({'message': 'User not found'}), 401
     
     return jsonify({
-        'token': token,
+        'token': issue_jwt(user_id, user_ref.to_dict()),
+        'refresh_token': new_refresh_token,
         'message': 'Token refreshed successfully'
     }), 200
 
 
+@token_required
+def refresh_jwt(current_user):
+    """Renew a still valid JWT based on current user activity"""
+    return jsonify({
+        'token': issue_jwt(current_user['id'], current_user),
+        'message': 'Token refreshed successfully'
+    }), 200
+
+
+@app.route('/api/refresh-token/revoke', methods=['POST'])
+def revoke_refresh_token_route():
+    """Revoke a refresh token and every token rotated from it, e.g. on logout"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('refresh_token'):
+        return jsonify({'message': 'Missing refresh token'}), 400
+    
+    revoke_refresh_token(db, data['refresh_token'])
+    # Unknown tokens are not reported, so the endpoint can't be used to probe them
+    return jsonify({'message': 'Refresh token revoked'}), 200
+
+
+@app.route('/api/refresh-token/revoke-all', methods=['POST'])
+@token_required
+def revoke_all_refresh_tokens(current_user):
+    """Revoke every refresh token of the current user, signing out all devices"""
+    revoked = revoke_user_tokens(db, current_user['id'])
+    return jsonify({'message': 'All refresh tokens revoked', 'revoked': revoked}), 200
+
+
 def generate_totp(length=6):
     """Generate a numeric TOTP of specified length"""
     return ''.join(random.choices(string.digits, k=length))
@@ -129,10 +215,11 @@ def send_email_totp(email, totp):
             recipients=[email]
         )
         msg.body = f"Your verification code is: {totp}\n\nThis code will expire in 10 minutes."
-        mail.send(msg)
+        with tracing.span('smtp.send', kind='client'):
+            mail.send(msg)
         return True, "Email sent successfully"
     except Exception as e:
-        print(f"Error sending email: {str(e)}")
+        logger.error("Error sending email: %s", e)
         return False, str(e)
 
 @app.route('/api/register', methods=['POST'])
@@ -151,7 +238,8 @@ def register():
         return jsonify({'message': 'User already exists'}), 409
     
     # Generate hashed password
-    hashed_password = generate_password_hash(data.get('password'), method='pbkdf2:sha256')
+    with tracing.span('password.hash'):
+        hashed_password = generate_password_hash(data.get('password'), method='pbkdf2:sha256')
     
     # Generate a temporary user record
     new_user = {
@@ -255,7 +343,9 @@ def login():
     user_data = query[0].to_dict()
     
     # Verify password
-    if not check_password_hash(user_data.get('password'), data.get('password')):
+    with tracing.span('password.verify'):
+        password_valid = check_password_hash(user_data.get('password'), data.get('password'))
+    if not password_valid:
         return jsonify({'message': 'Invalid credentials'}), 401
     
     # Generate TOTP for login
@@ -324,21 +414,19 @@ def verify_login():
     user_data = user_ref.to_dict()
     
     # Generate JWT token with the configured timeout
-    token = jwt.encode(
-        {
-            'user_id': user_id,
-            'email': user_data.get('email'),
-            'role': user_data.get('role', 'doctor'),
-            'exp': datetime.datetime.now() + JWT_EXPIRATION
-        },
-        app.config['SECRET_KEY'],
-        algorithm="HS256"
-    )
+    token = issue_jwt(user_id, user_data)
+    
+    # Long-lived token for renewing the session without a full login, only for
+    # clients naming the device to bind it to
+    new_refresh_token = issue_refresh_token(db, user_id, data['device_id']) if data.get('device_id') else None
     
     # Delete login verification record
     db.collection('login_verifications').document(verification_id).delete()
     
-    return jsonify({
+    # Warm up the data the first screen after login asks for
+    prefetch_working_set(db, user_id)
+    
+    response = {
         'token': token,
         'user': {
             'id': user_id,
@@ -346,7 +434,11 @@ def verify_login():
             'name': user_data.get('name', ''),
             'role': user_data.get('role', 'doctor')
         }
-    }), 200
+    }
+    if new_refresh_token:
+        response['refresh_token'] = new_refresh_token
+    
+    return jsonify(response), 200
 @app.route('/api/resend-totp', methods=['POST'])
 def resend_totp():
     data = request.get_json()
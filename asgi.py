@@ -0,0 +1,263 @@
+from asgiref.wsgi import WsgiToAsgi
+from urllib.parse import parse_qs
+import asyncio
+import jwt
+import logging
+import re
+
+from app import app
+from chat import serialize_chat_session
+from database import get_db, get_async_db
+from encryption import decrypt_data, schedule_reencryption
+from patient_routes import serialize_patient, list_session_notes, overlay_draft, \
+    ENCRYPTED_PATIENT_FIELDS, ENCRYPTED_NOTE_FIELDS, SESSION_NOTE_LIST_SELECT
+import tracing
+
+# ASGI serving mode, e.g. `uvicorn asgi:application --workers 4`.
+#
+# The I/O-bound read endpoints run natively on the async Firestore client,
+# overlapping the token_required user lookup with the endpoint's own reads, so
+# a single process can serve many requests while they wait on Firestore. Every
+# other route is served by the regular Flask app through an ASGI adapter.
+#
+# The async handlers share the Flask routes' serializers, lazy re-encryption,
+# autosave draft overlay and request tracing. They read Firestore directly,
+# without the document cache or single-flight coalescing, which are built on
+# the synchronous client: their results are never staler than the Flask
+# routes', but identical concurrent requests each run their own reads, and the
+# async client's RPCs don't get spans of their own.
+
+wsgi_application = WsgiToAsgi(app)
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+
+async def send_json(send, status, body, root=None):
+    # Same compact, key-sorted encoding as jsonify
+    payload = app.json.dumps(body, separators=(',', ':')).encode()
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(payload)).encode()),
+        (b'access-control-allow-origin', b'*')
+    ]
+    if root is not None:
+        headers.append((b'traceparent', tracing.traceparent_header(root).encode()))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+def decode_token(scope):
+    """Validate the bearer token like token_required and return the user id it names"""
+    headers = dict(scope['headers'])
+    auth_header = headers.get(b'authorization', b'').decode()
+    token = auth_header.split(' ')[1] if auth_header.startswith('Bearer ') else None
+
+    if not token:
+        raise HTTPError(401, {'message': 'Token is missing!'})
+
+    try:
+        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+        return data['user_id']
+    except jwt.ExpiredSignatureError:
+        raise HTTPError(401, {'message': 'Token has expired!', 'code': 'TOKEN_EXPIRED'})
+    except Exception as e:
+        raise HTTPError(401, {'message': f'Token is invalid! {str(e)}'})
+
+
+async def authenticated(db, user_id, *reads):
+    """
+    Run the user lookup of token_required concurrently with the endpoint's own
+    independent reads and return (current_user, *read_results).
+    """
+    user_doc, *results = await asyncio.gather(db.collection('users').document(user_id).get(), *reads)
+
+    if not user_doc.exists:
+        raise HTTPError(401, {'message': 'User not found!'})
+
+    current_user = user_doc.to_dict()
+    current_user['id'] = user_id
+    return (current_user, *results)
+
+
+def sync_reference(snapshot):
+    """The synchronous client's reference to a document read with the async client"""
+    return get_db().document(snapshot.reference.path)
+
+
+async def get_patients(db, user_id):
+    current_user, patient_docs = await authenticated(
+        db, user_id, db.collection('patients').where('doctor_id', '==', user_id).get()
+    )
+
+    patients = []
+    for doc in patient_docs:
+        schedule_reencryption(doc, ENCRYPTED_PATIENT_FIELDS, reference=sync_reference(doc))
+        patients.append(serialize_patient(doc.id, doc.to_dict()))
+
+    return 200, {
+        'patients': patients,
+        'count': len(patients)
+    }
+
+
+async def get_patient(db, user_id, patient_id):
+    current_user, patient_ref = await authenticated(
+        db, user_id, db.collection('patients').document(patient_id).get()
+    )
+
+    if not patient_ref.exists:
+        return 404, {'message': 'Patient not found'}
+
+    patient_data = patient_ref.to_dict()
+    if patient_data.get('doctor_id') != current_user['id']:
+        return 403, {'message': 'Unauthorized access to patient record'}
+
+    schedule_reencryption(patient_ref, ENCRYPTED_PATIENT_FIELDS, reference=sync_reference(patient_ref))
+
+    return 200, serialize_patient(patient_id, patient_data)
+
+
+async def get_patient_session_notes(db, user_id, patient_id):
+    # The note list doesn't depend on the patient document, so both are read at once
+    current_user, patient_ref, note_docs = await authenticated(
+        db, user_id,
+        db.collection('patients').document(patient_id).get(),
+        db.collection('session_notes').where('patient_id', '==', patient_id).select(SESSION_NOTE_LIST_SELECT).get()
+    )
+
+    if not patient_ref.exists:
+        return 404, {'message': 'Patient not found'}
+
+    patient_data = patient_ref.to_dict()
+    if patient_data.get('doctor_id') != current_user['id']:
+        return 403, {'message': 'Unauthorized access to patient record'}
+
+    session_notes = list_session_notes(note_docs)
+
+    return 200, {
+        'session_notes': session_notes,
+        'count': len(session_notes)
+    }
+
+
+async def get_session_note(db, user_id, session_id):
+    current_user, session_ref = await authenticated(
+        db, user_id, db.collection('session_notes').document(session_id).get()
+    )
+
+    if not session_ref.exists:
+        return 404, {'message': 'Session note not found'}
+
+    session_data = session_ref.to_dict()
+    if session_data.get('doctor_id') != current_user['id']:
+        return 403, {'message': 'Unauthorized access to session note'}
+
+    # Decrypt the note while the patient document is being fetched
+    patient_read = asyncio.ensure_future(
+        db.collection('patients').document(session_data.get('patient_id')).get()
+    )
+    session_data['note'] = decrypt_data(session_data.get('note'))  # Decrypted
+    schedule_reencryption(session_ref, ENCRYPTED_NOTE_FIELDS, binary=True, reference=sync_reference(session_ref))
+    overlay_draft(session_id, session_data)
+    patient_ref = await patient_read
+
+    if not patient_ref.exists:
+        return 404, {'message': 'Patient not found'}
+
+    session_data['patient_name'] = decrypt_data(patient_ref.to_dict().get('name'))
+
+    return 200, session_data
+
+
+async def get_chat_sessions(db, user_id):
+    sessions_query = db.collection('chat_sessions') \
+        .where('user_id', '==', user_id) \
+        .order_by('updated_at', direction='DESCENDING').get()
+    current_user, session_docs = await authenticated(db, user_id, sessions_query)
+
+    return 200, [serialize_chat_session(session) for session in session_docs]
+
+
+# Natively async routes: (method, Flask rule, path pattern, handler)
+ASYNC_ROUTES = [
+    ('GET', '/api/patients', re.compile(r'^/api/patients$'), get_patients),
+    ('GET', '/api/patients/<patient_id>', re.compile(r'^/api/patients/(?P<patient_id>(?!search$|stats$)[^/]+)$'), get_patient),
+    ('GET', '/api/patients/<patient_id>/session-notes', re.compile(r'^/api/patients/(?P<patient_id>[^/]+)/session-notes$'), get_patient_session_notes),
+    ('GET', '/api/session-notes/<session_id>', re.compile(r'^/api/session-notes/(?P<session_id>[^/]+)$'), get_session_note),
+    ('GET', '/api/chat/sessions', re.compile(r'^/api/chat/sessions$'), get_chat_sessions),
+]
+
+
+def match_async_route(scope):
+    for method, rule, pattern, handler in ASYNC_ROUTES:
+        if scope['method'] != method:
+            continue
+        match = pattern.match(scope['path'])
+        if match:
+            return rule, handler, match.groupdict()
+    return None, None, None
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Open the async client's channel before the first request
+            try:
+                await get_async_db().collection('_health').document('ping').get()
+            except Exception as e:
+                logger.error("Async Firestore warm-up failed: %s", e)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return await wsgi_application(scope, receive, send)
+
+    rule, handler, params = match_async_route(scope)
+
+    # Requests with query parameters use options only the Flask routes implement
+    if handler is None or parse_qs(scope.get('query_string', b'').decode()):
+        return await wsgi_application(scope, receive, send)
+
+    # Traced like the Flask routes, see tracing.before_request
+    if tracing.exporter is None:
+        root = None
+    else:
+        headers = dict(scope['headers'])
+        root = tracing.request_span(scope['method'], rule, scope['path'], headers.get(b'traceparent', b'').decode())
+        token = tracing.current_span.set(root)
+
+    try:
+        try:
+            user_id = decode_token(scope)
+            status, body = await handler(get_async_db(), user_id, **params)
+        except HTTPError as e:
+            status, body = e.status, e.body
+        if root is not None:
+            root.set_attribute('http.status_code', status)
+    except Exception as e:
+        if root is not None:
+            root.record_error(e)
+        raise
+    finally:
+        if root is not None:
+            root.end()
+            tracing.current_span.reset(token)
+
+    await send_json(send, status, body, root)
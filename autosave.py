@@ -0,0 +1,169 @@
+from google.api_core.exceptions import NotFound
+from datetime import datetime
+import atexit
+import logging
+import os
+import threading
+import time
+
+from doc_cache import documents
+
+# Coalesced autosave of session notes. Drafts are acknowledged straight away
+# and held in worker memory, already encrypted; a background flusher writes
+# only the latest draft of each note once edits pause for AUTOSAVE_DEBOUNCE
+# seconds, and at least every AUTOSAVE_MAX_DELAY seconds while editing goes on.
+# A draft that has waited AUTOSAVE_MAX_DELAY is also written by the autosave
+# request that finds it, so edits are saved on schedule even where background
+# threads don't run between requests (e.g. a frozen serverless instance). The
+# acknowledgement reports the last saved version; clients call flush when the
+# editor closes. Drafts live in the worker that received them, so autosave
+# needs sticky sessions when several workers serve the API.
+
+AUTOSAVE_DEBOUNCE = float(os.environ.get('AUTOSAVE_DEBOUNCE', 3))
+AUTOSAVE_MAX_DELAY = float(os.environ.get('AUTOSAVE_MAX_DELAY', 30))
+AUTOSAVE_FLUSH_INTERVAL = 1
+
+# Flushed drafts are dropped after this long without edits
+AUTOSAVE_IDLE_EVICT = 600
+
+logger = logging.getLogger(__name__)
+
+
+class Draft:
+    def __init__(self, note_id, doctor_id, version):
+        self.note_id = note_id
+        self.doctor_id = doctor_id
+        self.version = version
+        self.saved_version = version
+        self.note = None
+        self.first_change = None
+        self.last_change = None
+        # Serializes writes of this note so an older draft never lands last
+        self.write_lock = threading.Lock()
+
+    @property
+    def dirty(self):
+        return self.version > self.saved_version
+
+
+class AutosaveBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.drafts = {}
+        self.flusher = None
+        self.db = None
+
+    def get(self, note_id):
+        with self.lock:
+            return self.drafts.get(note_id)
+
+    def accept(self, db, note_id, doctor_id, stored_version, encrypted_note):
+        """Record the latest draft of a note; returns its version and the last saved version"""
+        with self.lock:
+            draft = self.drafts.get(note_id)
+            if draft is None:
+                draft = self.drafts[note_id] = Draft(note_id, doctor_id, stored_version)
+            now = time.monotonic()
+            if not draft.dirty:
+                draft.first_change = now
+            draft.last_change = now
+            draft.note = encrypted_note
+            draft.version += 1
+            version = draft.version
+            overdue = now - draft.first_change >= AUTOSAVE_MAX_DELAY
+            self.db = db
+            self.start()
+        if overdue:
+            try:
+                self.persist(db, draft)
+            except Exception as e:
+                # Left dirty, so the flusher or the next autosave retries it
+                logger.error("Error autosaving session note %s: %s", note_id, e)
+        return version, draft.saved_version
+
+    def discard(self, note_id):
+        """Forget a note's pending draft"""
+        with self.lock:
+            self.drafts.pop(note_id, None)
+
+    def supersede(self, note_id, write):
+        """Drop a note's pending draft and run write(), so no older autosave can land after it"""
+        draft = self.get(note_id)
+        if draft is None:
+            return write()
+        with draft.write_lock:
+            self.discard(note_id)
+            return write()
+
+    def persist(self, db, draft):
+        """Write a draft to Firestore if it has unsaved changes; returns the saved version"""
+        with draft.write_lock:
+            with self.lock:
+                if self.drafts.get(draft.note_id) is not draft:
+                    return None
+                if not draft.dirty:
+                    return draft.saved_version
+                version, note = draft.version, draft.note
+            try:
+                db.collection('session_notes').document(draft.note_id).update({
+                    'note': note,
+                    'version': version,
+                    'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                })
+            except NotFound:
+                # Deleted through another worker
+                self.discard(draft.note_id)
+                return None
+            documents.invalidate(f'session_notes/{draft.note_id}')
+            with self.lock:
+                draft.saved_version = max(draft.saved_version, version)
+            return version
+
+    def flush(self, db, note_id):
+        """Persist a note's pending draft now; returns the saved version or None without a draft"""
+        draft = self.get(note_id)
+        if draft is None:
+            return None
+        return self.persist(db, draft)
+
+    def due(self):
+        now = time.monotonic()
+        with self.lock:
+            for note_id, draft in list(self.drafts.items()):
+                if draft.dirty:
+                    if now - draft.last_change >= AUTOSAVE_DEBOUNCE or now - draft.first_change >= AUTOSAVE_MAX_DELAY:
+                        yield draft
+                elif now - (draft.last_change or 0) >= AUTOSAVE_IDLE_EVICT:
+                    del self.drafts[note_id]
+
+    def flush_due(self):
+        for draft in list(self.due()):
+            try:
+                self.persist(self.db, draft)
+            except Exception as e:
+                # Left dirty, so it is retried on the next pass
+                logger.error("Error autosaving session note %s: %s", draft.note_id, e)
+
+    def flush_all(self):
+        with self.lock:
+            drafts = [draft for draft in self.drafts.values() if draft.dirty]
+        for draft in drafts:
+            try:
+                self.persist(self.db, draft)
+            except Exception as e:
+                logger.error("Error autosaving session note %s: %s", draft.note_id, e)
+
+    def run(self):
+        while True:
+            time.sleep(AUTOSAVE_FLUSH_INTERVAL)
+            self.flush_due()
+
+    def start(self):
+        # Called with the lock held
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self.run, name='autosave-flusher', daemon=True)
+            self.flusher.start()
+            atexit.register(self.flush_all)
+
+
+drafts = AutosaveBuffer()
@@ -0,0 +1,168 @@
+from flask import Blueprint, request, jsonify, current_app
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.test import EnvironBuilder
+from functools import wraps
+import json
+import logging
+import os
+
+import tracing
+from tracing import propagate
+
+# Batch API: several API calls in one HTTP request. POST /api/batch takes a list
+# of sub-requests against the existing routes and answers with their responses
+# in the same order. The batch is authenticated once; its sub-requests carry the
+# authenticated user in the WSGI environ under BATCH_USER_ENVIRON_KEY, which the
+# token_required decorators pick up through batch_user() instead of decoding
+# the token again. Sub-requests can't be batches themselves.
+# Admission control and tracing apply to every sub-request as usual.
+#
+# Runs of consecutive GET sub-requests are dispatched concurrently. Any other
+# method runs on its own, after everything before it finished, so a write is
+# always seen by the sub-requests that follow it.
+
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', 20))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 8))
+
+# Only the server sets this key; request headers end up under HTTP_* keys
+BATCH_USER_ENVIRON_KEY = 'medi.batch_user'
+
+# Headers of the batch request passed on to every sub-request
+FORWARDED_HEADERS = ('Authorization', 'User-Agent')
+
+ALLOWED_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+logger = logging.getLogger(__name__)
+
+batch_bp = Blueprint('batch', __name__)
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+
+
+def batch_user():
+    """The user a batch request authenticated for the current sub-request, or None outside a batch"""
+    current_user = request.environ.get(BATCH_USER_ENVIRON_KEY)
+    return dict(current_user) if current_user is not None else None
+
+
+# Re-implement the token_required decorator to be used in this blueprint
+def token_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        from app import token_required as app_token_required
+        return app_token_required(f)(*args, **kwargs)
+    return decorated
+
+
+def validate_sub_request(item):
+    """Return an error message for a malformed sub-request, or None"""
+    if not isinstance(item, dict):
+        return 'Each request must be an object'
+    path = item.get('path')
+    if not isinstance(path, str) or not path.startswith('/api/'):
+        return 'path must be an API path starting with /api/'
+    if str(item.get('method', 'GET')).upper() not in ALLOWED_METHODS:
+        return f"method must be one of {', '.join(ALLOWED_METHODS)}"
+    return None
+
+
+def is_batch_path(environ):
+    # Checked on the decoded path the router sees, so /api/%62atch is caught too
+    return environ['PATH_INFO'].rstrip('/') == '/api/batch'
+
+
+def build_environ(item, current_user):
+    headers = {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+    # Sub-request spans join the batch's trace
+    parent = tracing.current_span.get()
+    if parent is not None:
+        headers['traceparent'] = f'00-{parent.trace_id}-{parent.span_id}-01'
+
+    builder = EnvironBuilder(
+        path=item['path'],
+        method=str(item.get('method', 'GET')).upper(),
+        headers=headers,
+        json=item['body'] if item.get('body') is not None else None,
+        environ_base={
+            'REMOTE_ADDR': request.remote_addr,
+            BATCH_USER_ENVIRON_KEY: current_user
+        }
+    )
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def dispatch(app, environ):
+    """Run one sub-request through the app; returns its status and decoded body"""
+    try:
+        # A fresh app context keeps g apart from the batch request and the other sub-requests
+        with app.app_context(), app.request_context(environ):
+            response = app.full_dispatch_request()
+            # Streamed bodies (exports) are buffered whole
+            try:
+                data = response.get_data()
+            finally:
+                response.close()
+    except Exception as e:
+        logger.exception("Error running batch sub-request %s: %s", environ.get('PATH_INFO'), e)
+        return {'status': 500, 'body': {'message': 'An error occurred while processing the request'}}
+
+    if response.is_json:
+        try:
+            body = json.loads(data)
+        except ValueError:
+            body = data.decode('utf-8', errors='replace')
+    else:
+        body = data.decode('utf-8', errors='replace')
+    return {'status': response.status_code, 'body': body}
+
+
+def run_batch(app, environs):
+    """Dispatch sub-requests, GET runs concurrently and everything else one at a time"""
+    results = [None] * len(environs)
+    pending = []
+
+    def wait():
+        for index, future in pending:
+            results[index] = future.result()
+        pending.clear()
+
+    for index, environ in enumerate(environs):
+        if environ['REQUEST_METHOD'] == 'GET':
+            pending.append((index, batch_executor.submit(propagate(dispatch), app, environ)))
+            continue
+        wait()
+        results[index] = dispatch(app, environ)
+    wait()
+    return results
+
+
+@batch_bp.route('/api/batch', methods=['POST'])
+@token_required
+def batch(current_user):
+    """Run several API calls in one request"""
+    if BATCH_USER_ENVIRON_KEY in request.environ:
+        return jsonify({'message': 'Batches cannot be nested'}), 400
+
+    data = request.get_json(silent=True) or {}
+    items = data.get('requests')
+
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'requests must be a non-empty list'}), 400
+    if len(items) > BATCH_MAX_REQUESTS:
+        return jsonify({'message': f'A batch can contain at most {BATCH_MAX_REQUESTS} requests'}), 400
+
+    for position, item in enumerate(items):
+        error = validate_sub_request(item)
+        if error:
+            return jsonify({'message': f'Request {position}: {error}'}), 400
+
+    environs = [build_environ(item, current_user) for item in items]
+    for position, environ in enumerate(environs):
+        if is_batch_path(environ):
+            return jsonify({'message': f'Request {position}: Batches cannot be nested'}), 400
+
+    results = run_batch(current_app._get_current_object(), environs)
+    return jsonify({'responses': results}), 200
@@ -0,0 +1,87 @@
+from flask import Blueprint, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.datastructures import MultiDict
+import logging
+import os
+
+from database import get_db
+from singleflight import reads, request_key
+from tracing import propagate
+from patient_routes import token_required, load_patients
+from chat import load_chat_sessions
+
+# Post-login prefetch of a doctor's working set. Right after a successful
+# verify_login the patient list and chat session list are loaded in the
+# background. They are retained in the single-flight group under the
+# same keys the list endpoints use, so the first GET /api/patients and
+# GET /api/chat/sessions after login either join the prefetch still in flight
+# or pick up its result. GET /api/bootstrap returns both with the profile.
+
+PREFETCH_ON_LOGIN = os.environ.get('PREFETCH_ON_LOGIN', 'True').lower() == 'true'
+
+# Seconds a prefetched list waits to be picked up. It is only dropped on writes
+# made by the same worker, so a write through another worker can be missed for
+# this long; keep it short.
+PREFETCH_TTL = float(os.environ.get('PREFETCH_TTL', 10))
+
+logger = logging.getLogger(__name__)
+
+bootstrap_bp = Blueprint('bootstrap', __name__)
+
+prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='login-prefetch')
+
+# Plain list requests carry no query string
+NO_ARGS = MultiDict()
+
+
+def patients_key(user_id):
+    return request_key('patients', user_id, NO_ARGS)
+
+
+def chat_sessions_key(user_id):
+    return request_key('chat_sessions', user_id, NO_ARGS)
+
+
+def run_prefetch(name, fn):
+    try:
+        fn()
+    except Exception as e:
+        logger.warning("Login prefetch of %s failed: %s", name, e)
+
+
+def prefetch_working_set(db, user_id):
+    """Start loading a user's patients and chat sessions in the background"""
+    if not PREFETCH_ON_LOGIN:
+        return
+    loads = {
+        'patients': lambda: reads.do(patients_key(user_id), lambda: load_patients(db, user_id), retain=PREFETCH_TTL),
+        'chat sessions': lambda: reads.do(chat_sessions_key(user_id), lambda: load_chat_sessions(db, user_id), retain=PREFETCH_TTL),
+    }
+    for name, fn in loads.items():
+        prefetch_executor.submit(propagate(run_prefetch), name, fn)
+
+
+@bootstrap_bp.route('/api/bootstrap', methods=['GET'])
+@token_required
+def bootstrap(current_user):
+    """
+    Everything the first screen after login needs: the profile, the patient
+    list and the chat session list
+    """
+    db = get_db()
+    user_id = current_user['id']
+
+    # Both lists load concurrently, reusing the login prefetch when it ran
+    patients = prefetch_executor.submit(propagate(reads.do), patients_key(user_id), lambda: load_patients(db, user_id))
+    chat_sessions = prefetch_executor.submit(propagate(reads.do), chat_sessions_key(user_id), lambda: load_chat_sessions(db, user_id))
+
+    return jsonify({
+        'user': {
+            'id': user_id,
+            'email': current_user['email'],
+            'name': current_user.get('name', ''),
+            'role': current_user.get('role', 'doctor')
+        },
+        'patients': patients.result(),
+        'chat_sessions': chat_sessions.result()
+    }), 200
@@ -1,9 +1,22 @@
 from flask import Blueprint, request, jsonify
 import datetime
 from functools import wraps
+import click
+
+from database import get_db
+from singleflight import reads, request_key
+from chat_search import get_index, index_message, record_search
+from chat_archive import load_messages, schedule_compaction, compact_session, CHAT_COMPACT_THRESHOLD
+from firebase_admin import firestore
+from doc_cache import documents
+from fieldsets import requested_fields, wants, select, pick
 
 chat_bp = Blueprint('chat', __name__)
 
+# Fields that can be requested with ?fields= (see fieldsets.py)
+CHAT_SESSION_LIST_FIELDS = ('id', 'title', 'created_at', 'updated_at')
+CHAT_SESSION_FIELDS = CHAT_SESSION_LIST_FIELDS + ('messages',)
+
 # Re-implement the token_required decorator to be used in this blueprint
 def token_required(f):
     @wraps(f)
@@ -27,7 +40,6 @@ def create_session(current_user):
     data = request.get_json()
     title = data.get('title', 'New Conversation')
     
-    from app import get_db
     db = get_db()
     
     # Create a new session
@@ -40,6 +52,7 @@ def create_session(current_user):
     
     # Add session to Firestore
     session_ref = db.collection('chat_sessions').add(new_session)
+    reads.forget('chat_sessions', current_user['id'])
     session_id = session_ref[1].id
     
     return jsonify({
@@ -49,27 +62,43 @@ def create_session(current_user):
         'updated_at': format_timestamp(new_session['updated_at'])
     }), 201
 
+def load_chat_sessions(db, user_id, fields=None):
+    """
+    All chat sessions of a user, most recent first, optionally only some fields
+    """
+    query = db.collection('chat_sessions').where('user_id', '==', user_id).order_by('updated_at', direction='DESCENDING')
+    sessions_ref = select(query, fields, CHAT_SESSION_LIST_FIELDS[1:]).get()
+    
+    return [serialize_chat_session(session, fields) for session in sessions_ref]
+
+def serialize_chat_session(session, fields=None):
+    """The chat session list entry of a session document"""
+    session_data = session.to_dict()
+    return pick({
+        'id': session.id,
+        'title': session_data.get('title', 'New Conversation'),
+        'created_at': format_timestamp(session_data.get('created_at')),
+        'updated_at': format_timestamp(session_data.get('updated_at'))
+    }, fields)
+
 @chat_bp.route('/api/chat/sessions', methods=['GET'])
 @token_required
 def get_chat_sessions(current_user):
     """
     Get all chat sessions for the current user
     """
-    from app import get_db
     db = get_db()
     
-    # Get all sessions for the current user, ordered by most recent first
-    sessions_ref = db.collection('chat_sessions').where('user_id', '==', current_user['id']).order_by('updated_at', direction='DESCENDING').get()
+    try:
+        fields = requested_fields(CHAT_SESSION_LIST_FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
     
-    sessions = []
-    for session in sessions_ref:
-        session_data = session.to_dict()
-        sessions.append({
-            'id': session.id,
-            'title': session_data.get('title', 'New Conversation'),
-            'created_at': format_timestamp(session_data.get('created_at')),
-            'updated_at': format_timestamp(session_data.get('updated_at'))
-        })
+    # Identical requests arriving together (e.g. several open tabs) share one query
+    sessions = reads.do(
+        request_key('chat_sessions', current_user['id'], request.args),
+        lambda: load_chat_sessions(db, current_user['id'], fields)
+    )
     
     return jsonify(sessions), 200
 
@@ -79,11 +108,15 @@ def get_chat_session(current_user, session_id):
     """
     Get a specific chat session and its messages
     """
-    from app import get_db
     db = get_db()
     
+    try:
+        fields = requested_fields(CHAT_SESSION_FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    
     # Check if session exists and belongs to current user
-    session_ref = db.collection('chat_sessions').document(session_id).get()
+    session_ref = documents.get(db.collection('chat_sessions').document(session_id))
     if not session_ref.exists:
         return jsonify({'message': 'Chat session not found'}), 404
         
@@ -91,18 +124,16 @@ def get_chat_session(current_user, session_id):
     if session_data.get('user_id') != current_user['id']:
         return jsonify({'message': 'Unauthorized access to chat session'}), 403
     
-    # Get messages for this session
-    messages_ref = db.collection('chat_sessions').document(session_id).collection('messages').order_by('timestamp').get()
-    
+    # Get messages for this session, archived chunks followed by the live tail
     messages = []
-    for message in messages_ref:
-        message_data = message.to_dict()
-        messages.append({
-            'id': message.id,
-            'sender': message_data.get('sender'),
-            'content': message_data.get('content'),
-            'timestamp': format_timestamp(message_data.get('timestamp'))
-        })
+    if wants(fields, 'messages'):
+        for message in load_messages(db, session_id):
+            messages.append({
+                'id': message['id'],
+                'sender': message['sender'],
+                'content': message['content'],
+                'timestamp': format_timestamp(message['timestamp'])
+            })
     
     # Create the complete session data
     complete_session = {
@@ -113,7 +144,7 @@ def get_chat_session(current_user, session_id):
         'messages': messages
     }
     
-    return jsonify(complete_session), 200
+    return jsonify(pick(complete_session, fields)), 200
 
 @chat_bp.route('/api/chat/sessions/<session_id>/messages', methods=['POST'])
 @token_required
@@ -126,11 +157,10 @@ def save_message(current_user, session_id):
     if not data or not data.get('content') or not data.get('sender'):
         return jsonify({'message': 'Message content and sender are required'}), 400
         
-    from app import get_db
     db = get_db()
     
     # Check if session exists and belongs to current user
-    session_ref = db.collection('chat_sessions').document(session_id).get()
+    session_ref = documents.get(db.collection('chat_sessions').document(session_id))
     if not session_ref.exists:
         return jsonify({'message': 'Chat session not found'}), 404
         
@@ -149,10 +179,18 @@ def save_message(current_user, session_id):
     message_ref = db.collection('chat_sessions').document(session_id).collection('messages').add(message_data)
     message_id = message_ref[1].id
     
-    # Update session timestamp
+    # Update session timestamp and live message count
     db.collection('chat_sessions').document(session_id).update({
-        'updated_at': datetime.datetime.now()
+        'updated_at': datetime.datetime.now(),
+        'live_messages': firestore.Increment(1)
     })
+    documents.invalidate(session_ref.reference)
+    
+    # Fold older messages into archive chunks once the live collection grows long
+    if session_data.get('live_messages', 0) + 1 >= CHAT_COMPACT_THRESHOLD:
+        schedule_compaction(db, session_id)
+    reads.forget('chat_sessions', current_user['id'])
+    index_message(current_user['id'], session_id, message_id, message_data['sender'], message_data['content'], message_data['timestamp'])
     
     return jsonify({
         'id': message_id,
@@ -161,6 +199,29 @@ def save_message(current_user, session_id):
         'timestamp': format_timestamp(message_data['timestamp'])
     }), 201
 
+@chat_bp.route('/api/chat/search', methods=['GET'])
+@token_required
+def search_messages(current_user):
+    """
+    Full-text search over the current user's chat messages
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'message': 'Search query is required'}), 400
+    
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+    except ValueError:
+        return jsonify({'message': 'limit must be an integer'}), 400
+    
+    # Messages saved by other workers are picked up in the background
+    indexed = record_search(get_db(), current_user['id'])
+    
+    results = get_index().search(current_user['id'], query, limit=limit, session_id=request.args.get('session_id'))
+    
+    # While the first backfill runs, results only cover messages saved by this worker
+    return jsonify({'query': query, 'results': results, 'indexing': not indexed}), 200
+
 # @chat_bp.route('/api/chat/sessions/<session_id>', methods=['DELETE'])
 # @token_required
 # def delete_chat_session(current_user, session_id):
@@ -201,11 +262,10 @@ def update_session_title(current_user, session_id):
     
     new_title = data.get('title')
     
-    from app import get_db
     db = get_db()
     
     # Check if session exists and belongs to current user
-    session_ref = db.collection('chat_sessions').document(session_id).get()
+    session_ref = documents.get(db.collection('chat_sessions').document(session_id))
     if not session_ref.exists:
         return jsonify({'message': 'Chat session not found'}), 404
         
@@ -218,6 +278,8 @@ def update_session_title(current_user, session_id):
         'title': new_title,
         'updated_at': datetime.datetime.now()
     })
+    documents.invalidate(session_ref.reference)
+    reads.forget('chat_sessions', current_user['id'])
     
     return jsonify({'message': 'Session title updated successfully'}), 200
 # @chat_bp.route('/api/chat/sessions/batch-delete', methods=['POST'])
@@ -278,4 +340,45 @@ def update_session_title(current_user, session_id):
 #     return jsonify({
 #         'message': f"Successfully deleted {len(results['successful'])} sessions, {len(results['failed'])} failed",
 #         'results': results
-#     }), 200
\ No newline at end of file
+#     }), 200
+
+
+@chat_bp.cli.command('reindex')
+@click.option('--user-id', help='Only rebuild the index of this user')
+def reindex_command(user_id):
+    """Rebuild the local chat search index from Firestore"""
+    db = get_db()
+    search_index = get_index()
+
+    if user_id:
+        user_ids = [user_id]
+    else:
+        user_ids = sorted({doc.to_dict().get('user_id') for doc in db.collection('chat_sessions').select(['user_id']).stream()} - {None})
+
+    indexed = 0
+    for uid in user_ids:
+        search_index.clear_user(uid)
+        indexed += search_index.sync_user(db, uid, full=True)
+
+    click.echo(f'Indexed {indexed} messages for {len(user_ids)} users')
+
+
+@chat_bp.cli.command('compact')
+@click.option('--session-id', help='Only compact this session')
+def compact_command(session_id):
+    """Fold older messages of long chat sessions into archive chunks"""
+    db = get_db()
+
+    if session_id:
+        session_ids = [session_id]
+    else:
+        session_ids = [doc.id for doc in db.collection('chat_sessions').select([]).stream()]
+
+    archived = 0
+    for sid in session_ids:
+        count = compact_session(db, sid)
+        if count:
+            click.echo(f'Archived {count} messages of session {sid}')
+        archived += count
+
+    click.echo(f'Archived {archived} messages in total')
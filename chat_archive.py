@@ -0,0 +1,198 @@
+from concurrent.futures import ThreadPoolExecutor
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+import datetime
+import json
+import logging
+import os
+import threading
+import zlib
+
+from doc_cache import documents
+
+# Compaction of long chat sessions. Older messages are folded into compressed
+# chunk documents in 'chat_sessions/<id>/chunks', about CHAT_CHUNK_SIZE messages
+# each, and removed from 'chat_sessions/<id>/messages' in the same batch. The
+# newest messages always stay live, so appending never touches a chunk.
+# load_messages merges the chunks with the live tail, so opening a session reads
+# at most CHAT_LIVE_TAIL + CHAT_CHUNK_SIZE - 1 message documents plus one chunk
+# document per CHAT_CHUNK_SIZE archived messages; 1000 messages take under 90 reads.
+#
+# Chunks are written with create(), so when two workers compact the same session
+# only the first to commit a sequence number wins. The loser's batch, including
+# its message deletes, fails as a whole and no message is lost.
+
+CHAT_CHUNK_SIZE = int(os.environ.get('CHAT_CHUNK_SIZE', 50))
+
+# Messages always left in the live collection
+CHAT_LIVE_TAIL = int(os.environ.get('CHAT_LIVE_TAIL', 20))
+
+# Compaction is triggered from save_message once this many messages are live
+CHAT_COMPACT_THRESHOLD = CHAT_LIVE_TAIL + CHAT_CHUNK_SIZE
+
+# Stay well below Firestore's 1 MiB document limit
+MAX_CHUNK_BYTES = 900 * 1024
+
+logger = logging.getLogger(__name__)
+
+compaction_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='chat-compaction')
+
+# Sessions with a compaction queued or running in this worker
+compacting = set()
+compacting_lock = threading.Lock()
+
+
+def encode_chunk(messages):
+    records = [
+        {
+            'id': message['id'],
+            'sender': message.get('sender'),
+            'content': message.get('content'),
+            'timestamp': message['timestamp'].isoformat() if isinstance(message.get('timestamp'), datetime.datetime) else message.get('timestamp')
+        }
+        for message in messages
+    ]
+    return zlib.compress(json.dumps(records, separators=(',', ':')).encode('utf-8'), 6)
+
+
+def decode_chunk(data):
+    messages = json.loads(zlib.decompress(data).decode('utf-8'))
+    for message in messages:
+        if message.get('timestamp'):
+            message['timestamp'] = datetime.datetime.fromisoformat(message['timestamp'])
+    return messages
+
+
+def message_from_snapshot(snapshot):
+    data = snapshot.to_dict()
+    return {
+        'id': snapshot.id,
+        'sender': data.get('sender'),
+        'content': data.get('content'),
+        'timestamp': data.get('timestamp')
+    }
+
+
+def load_messages(db, session_id, since=None):
+    """
+    All messages of a session in timestamp order, archived chunks followed by
+    the live tail. With since, only messages newer than it.
+    """
+    session_ref = db.collection('chat_sessions').document(session_id)
+
+    live_query = session_ref.collection('messages').order_by('timestamp')
+    chunks_query = session_ref.collection('chunks').order_by('seq')
+    if since is not None:
+        live_query = live_query.where('timestamp', '>', since)
+        chunks_query = session_ref.collection('chunks').where('last_timestamp', '>', since).order_by('last_timestamp')
+
+    # Live messages are read first: a compaction committing in between then
+    # shows its messages twice rather than not at all, and duplicates are dropped
+    live = [message_from_snapshot(message) for message in live_query.get()]
+
+    messages = []
+    seen = set()
+    for chunk in chunks_query.get():
+        for message in decode_chunk(chunk.get('data')):
+            if since is not None and message['timestamp'] is not None and not comparable_after(message['timestamp'], since):
+                continue
+            seen.add(message['id'])
+            messages.append(message)
+
+    messages.extend(message for message in live if message['id'] not in seen)
+    return messages
+
+
+def comparable_after(timestamp, since):
+    # Firestore returns aware UTC datetimes while the app writes naive ones
+    if (timestamp.tzinfo is None) != (since.tzinfo is None):
+        timestamp = timestamp.replace(tzinfo=None) if since.tzinfo is None else timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp > since
+
+
+def split_chunks(messages):
+    """Split messages into runs of CHAT_CHUNK_SIZE, halving any run that compresses too large"""
+    pending = [messages[i:i + CHAT_CHUNK_SIZE] for i in range(0, len(messages), CHAT_CHUNK_SIZE)]
+    while pending:
+        run = pending.pop(0)
+        data = encode_chunk(run)
+        if len(data) > MAX_CHUNK_BYTES and len(run) > 1:
+            middle = len(run) // 2
+            pending[:0] = [run[:middle], run[middle:]]
+            continue
+        yield run, data
+
+
+def compact_session(db, session_id):
+    """Archive all but the newest CHAT_LIVE_TAIL messages of a session; returns the number archived"""
+    session_ref = db.collection('chat_sessions').document(session_id)
+    session = session_ref.get()
+    if not session.exists:
+        return 0
+
+    live = [
+        (message.reference, message_from_snapshot(message))
+        for message in session_ref.collection('messages').order_by('timestamp').get()
+    ]
+    # Only full chunks are archived
+    archivable = (len(live) - CHAT_LIVE_TAIL) // CHAT_CHUNK_SIZE * CHAT_CHUNK_SIZE
+    if archivable <= 0:
+        return 0
+
+    session_data = session.to_dict()
+    seq = session_data.get('chunk_count', 0)
+    # Sessions from before message counting get an exact count instead of a delta
+    counted = 'live_messages' in session_data
+    remaining = len(live)
+    references = {message['id']: reference for reference, message in live[:archivable]}
+    archived = 0
+    for run, data in split_chunks([message for _, message in live[:archivable]]):
+        # Chunk write, message deletes and session update commit together
+        batch = db.batch()
+        batch.create(session_ref.collection('chunks').document(f'{seq:06d}'), {
+            'seq': seq,
+            'count': len(run),
+            'first_timestamp': run[0]['timestamp'],
+            'last_timestamp': run[-1]['timestamp'],
+            'data': data
+        })
+        for message in run:
+            batch.delete(references[message['id']])
+        remaining -= len(run)
+        batch.update(session_ref, {
+            'chunk_count': seq + 1,
+            'live_messages': firestore.Increment(-len(run)) if counted else remaining,
+            'compacted_until': run[-1]['timestamp']
+        })
+        try:
+            batch.commit()
+        except AlreadyExists:
+            # Another worker compacted the session at the same time; none of this batch was written
+            logger.info("Chat session %s is being compacted elsewhere, stopping", session_id)
+            documents.invalidate(session_ref)
+            break
+        documents.invalidate(session_ref)
+        counted = True
+        seq += 1
+        archived += len(run)
+
+    return archived
+
+
+def run_compaction(db, session_id):
+    try:
+        compact_session(db, session_id)
+    except Exception as e:
+        logger.error("Error compacting chat session %s: %s", session_id, e)
+    finally:
+        with compacting_lock:
+            compacting.discard(session_id)
+
+
+def schedule_compaction(db, session_id):
+    """Compact a session in the background unless that is already under way"""
+    with compacting_lock:
+        if session_id in compacting:
+            return
+        compacting.add(session_id)
+    compaction_executor.submit(run_compaction, db, session_id)
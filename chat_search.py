@@ -0,0 +1,377 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+import math
+import os
+import re
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+
+from chat_archive import load_messages
+
+# Full-text search over chat messages. Each worker keeps an inverted index in a
+# local SQLite file; Firestore stays the source of truth. Messages are indexed
+# as they are saved. Messages saved by other workers or instances are picked up
+# in the background: a search whose user's index is older than the sync
+# interval schedules a catch-up with sessions updated since the last sync, and
+# users who searched recently are caught up every interval. Searches never wait
+# for Firestore; a user's history is backfilled after their first search.
+
+# The index holds message plaintext. By default it lives in a directory of the
+# temp dir (writable on serverless platforms, where the app directory isn't)
+# that only the app's user may enter; the file itself is created 0600.
+CHAT_SEARCH_INDEX_DIR = os.path.join(tempfile.gettempdir(), 'chat_search')
+CHAT_SEARCH_INDEX_PATH = os.environ.get('CHAT_SEARCH_INDEX_PATH', os.path.join(CHAT_SEARCH_INDEX_DIR, 'chat_search.sqlite3'))
+
+# Seconds a user's index may lag behind Firestore before it is caught up
+CHAT_SEARCH_SYNC_INTERVAL = int(os.environ.get('CHAT_SEARCH_SYNC_INTERVAL', 60))
+
+# Users who searched within this many seconds are caught up periodically
+CHAT_SEARCH_ACTIVE_WINDOW = int(os.environ.get('CHAT_SEARCH_ACTIVE_WINDOW', 3600))
+
+# Re-read this much history before a user's last sync, to cover clock skew
+# between instances. Re-indexing a message is idempotent.
+SYNC_OVERLAP = datetime.timedelta(minutes=5)
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+SNIPPET_LENGTH = 160
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is', 'it',
+    'of', 'on', 'or', 'so', 'that', 'the', 'their', 'then', 'there', 'these', 'they', 'this', 'to',
+    'was', 'will', 'with'
+))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    doc INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    sender TEXT,
+    content TEXT NOT NULL,
+    timestamp TEXT,
+    length INTEGER NOT NULL,
+    UNIQUE (session_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id);
+CREATE TABLE IF NOT EXISTS postings (
+    user_id TEXT NOT NULL,
+    term TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (user_id, term, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+CREATE TABLE IF NOT EXISTS synced_users (
+    user_id TEXT PRIMARY KEY,
+    synced_at TEXT NOT NULL
+);
+"""
+
+
+def tokenize(text):
+    """Lowercase word tokens with stopwords removed"""
+    return [token for token in TOKEN_PATTERN.findall((text or '').lower()) if token not in STOPWORDS]
+
+
+def prepare_index_file(path):
+    """
+    Create the index file readable by the app's user only, refusing a default
+    directory that someone else created or opened up in the shared temp dir.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if directory == os.path.abspath(CHAT_SEARCH_INDEX_DIR):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or (hasattr(os, 'getuid') and info.st_uid != os.getuid()):
+            raise RuntimeError(f'Chat search index directory {directory} is not owned by this user')
+        if info.st_mode & 0o077:
+            os.chmod(directory, 0o700)
+    os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+    os.chmod(path, 0o600)
+
+
+def format_timestamp(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.isoformat()
+    return timestamp
+
+
+class ChatSearchIndex:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.sync_lock = threading.Lock()
+        self.syncing = {}
+        prepare_index_file(path)
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self):
+        """One connection per thread; WAL lets several workers share the file"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def add_messages(self, user_id, messages):
+        """Index (session_id, message_id, sender, content, timestamp) tuples, replacing earlier versions"""
+        conn = self.connection()
+        with conn:
+            for session_id, message_id, sender, content, timestamp in messages:
+                tokens = tokenize(content)
+                existing = conn.execute(
+                    'SELECT doc FROM messages WHERE session_id = ? AND message_id = ?', (session_id, message_id)
+                ).fetchone()
+                if existing:
+                    conn.execute('DELETE FROM postings WHERE doc = ?', existing)
+                    conn.execute('DELETE FROM messages WHERE doc = ?', existing)
+                doc = conn.execute(
+                    'INSERT INTO messages (user_id, session_id, message_id, sender, content, timestamp, length) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (user_id, session_id, message_id, sender, content or '', format_timestamp(timestamp), len(tokens))
+                ).lastrowid
+                counts = {}
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+                conn.executemany(
+                    'INSERT INTO postings (user_id, term, doc, tf) VALUES (?, ?, ?, ?)',
+                    [(user_id, term, doc, tf) for term, tf in counts.items()]
+                )
+
+    def last_sync(self, user_id):
+        row = self.connection().execute('SELECT synced_at FROM synced_users WHERE user_id = ?', (user_id,)).fetchone()
+        return datetime.datetime.fromisoformat(row[0]) if row else None
+
+    def mark_synced(self, user_id, synced_at):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO synced_users (user_id, synced_at) VALUES (?, ?)',
+                (user_id, synced_at.isoformat())
+            )
+
+    def sync_user(self, db, user_id, full=False):
+        """
+        Index the user's messages saved since the last sync, or all of them on
+        the first sync or when full is set. Returns the number of messages read.
+        """
+        # Concurrent searches by the same user wait for one sync
+        with self.sync_lock:
+            lock = self.syncing.setdefault(user_id, threading.Lock())
+        with lock:
+            started = datetime.datetime.now()
+            since = None if full else self.last_sync(user_id)
+            if since is not None:
+                since -= SYNC_OVERLAP
+
+            sessions = db.collection('chat_sessions').where('user_id', '==', user_id)
+            if since is not None:
+                sessions = sessions.where('updated_at', '>', since)
+
+            indexed = 0
+            for session in sessions.stream():
+                batch = [
+                    (session.id, message['id'], message['sender'], message['content'], message['timestamp'])
+                    for message in load_messages(db, session.id, since=since)
+                ]
+                self.add_messages(user_id, batch)
+                indexed += len(batch)
+
+            self.mark_synced(user_id, started)
+            return indexed
+
+    def search(self, user_id, query, limit=20, session_id=None):
+        """Rank the user's messages against query with BM25"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        conn = self.connection()
+        total, average_length = conn.execute(
+            'SELECT COUNT(*), AVG(length) FROM messages WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if not total:
+            return []
+        average_length = average_length or 1
+
+        placeholders = ','.join('?' for _ in terms)
+        rows = conn.execute(
+            f'SELECT p.term, p.doc, p.tf, m.length FROM postings p JOIN messages m ON m.doc = p.doc '
+            f'WHERE p.user_id = ? AND p.term IN ({placeholders})' + (' AND m.session_id = ?' if session_id else ''),
+            [user_id] + terms + ([session_id] if session_id else [])
+        ).fetchall()
+
+        document_frequency = {}
+        for term, _, _, _ in rows:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+
+        scores = {}
+        for term, doc, tf, length in rows:
+            df = document_frequency[term]
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            scores[doc] = scores.get(doc, 0) + idf * tf * (BM25_K1 + 1) / norm
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        if not ranked:
+            return []
+
+        docs = [doc for doc, _ in ranked]
+        messages = {
+            row[0]: row[1:] for row in conn.execute(
+                f"SELECT doc, session_id, message_id, sender, content, timestamp FROM messages "
+                f"WHERE doc IN ({','.join('?' for _ in docs)})", docs
+            )
+        }
+
+        results = []
+        for doc, score in ranked:
+            session, message_id, sender, content, timestamp = messages[doc]
+            snippet, highlights = make_snippet(content, terms)
+            results.append({
+                'session_id': session,
+                'message_id': message_id,
+                'sender': sender,
+                'timestamp': timestamp,
+                'score': round(score, 4),
+                'snippet': snippet,
+                'highlights': highlights
+            })
+        return results
+
+    def clear_user(self, user_id):
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM postings WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM synced_users WHERE user_id = ?', (user_id,))
+
+
+def make_snippet(content, terms):
+    """
+    Cut a window of the message around the densest group of matching words.
+    Returns the snippet and the [start, end) offsets of the matches within it.
+    """
+    terms = set(terms)
+    matches = [m.span() for m in TOKEN_PATTERN.finditer(content) if m.group().lower() in terms]
+
+    if len(content) <= SNIPPET_LENGTH:
+        start, end = 0, len(content)
+    else:
+        # Start the window at the match followed by the most matches within the window
+        best = max(
+            matches or [(0, 0)],
+            key=lambda span: sum(1 for other in matches if span[0] <= other[0] and other[1] <= span[0] + SNIPPET_LENGTH)
+        )
+        start = max(0, min(best[0] - SNIPPET_LENGTH // 4, len(content) - SNIPPET_LENGTH))
+        # Don't cut words in half
+        while start > 0 and content[start - 1].isalnum():
+            start -= 1
+        end = min(len(content), start + SNIPPET_LENGTH)
+        while end < len(content) and content[end].isalnum():
+            end += 1
+
+    snippet = content[start:end]
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if end < len(content) else ''
+    offset = len(prefix) - start
+    highlights = [[s + offset, e + offset] for s, e in matches if s >= start and e <= end]
+    return prefix + snippet + suffix, highlights
+
+
+index = None
+index_lock = threading.Lock()
+
+sync_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='chat-search-sync')
+
+# Users with a sync queued or running in this worker
+pending_syncs = set()
+# User id -> monotonic time of their last search in this worker
+active_users = {}
+sync_lock = threading.Lock()
+catch_up_thread = None
+
+
+def get_index():
+    global index
+    if index is None:
+        with index_lock:
+            if index is None:
+                index = ChatSearchIndex(CHAT_SEARCH_INDEX_PATH)
+    return index
+
+
+def index_message(user_id, session_id, message_id, sender, content, timestamp):
+    """Add a newly saved message to the local index; failures never affect the save"""
+    try:
+        get_index().add_messages(user_id, [(session_id, message_id, sender, content, timestamp)])
+    except Exception as e:
+        logger.error("Error indexing chat message %s: %s", message_id, e)
+
+
+def run_sync(db, user_id):
+    try:
+        get_index().sync_user(db, user_id)
+    except Exception as e:
+        logger.error("Error syncing chat search index of user %s: %s", user_id, e)
+    finally:
+        with sync_lock:
+            pending_syncs.discard(user_id)
+
+
+def schedule_sync(db, user_id):
+    """Catch a user's index up in the background unless it is recent or a sync is under way"""
+    synced = get_index().last_sync(user_id)
+    if synced is not None and datetime.datetime.now() - synced < datetime.timedelta(seconds=CHAT_SEARCH_SYNC_INTERVAL):
+        return
+    with sync_lock:
+        if user_id in pending_syncs:
+            return
+        pending_syncs.add(user_id)
+    sync_executor.submit(run_sync, db, user_id)
+
+
+def catch_up(db):
+    """Keep the indexes of recently active users caught up, every sync interval"""
+    while True:
+        time.sleep(CHAT_SEARCH_SYNC_INTERVAL)
+        cutoff = time.monotonic() - CHAT_SEARCH_ACTIVE_WINDOW
+        with sync_lock:
+            for user_id in [user_id for user_id, searched in active_users.items() if searched < cutoff]:
+                del active_users[user_id]
+            user_ids = list(active_users)
+        for user_id in user_ids:
+            try:
+                schedule_sync(db, user_id)
+            except Exception as e:
+                logger.error("Error scheduling chat search sync of user %s: %s", user_id, e)
+
+
+def record_search(db, user_id):
+    """
+    Note a search by a user: their index is caught up in the background from
+    now on. Returns False while their history hasn't been indexed yet.
+    """
+    global catch_up_thread
+    with sync_lock:
+        active_users[user_id] = time.monotonic()
+        if catch_up_thread is None:
+            catch_up_thread = threading.Thread(target=catch_up, args=(db,), name='chat-search-catch-up', daemon=True)
+            catch_up_thread.start()
+    schedule_sync(db, user_id)
+    return get_index().last_sync(user_id) is not None
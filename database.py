@@ -0,0 +1,208 @@
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.api_core import exceptions as google_exceptions
+from google.api_core.gapic_v1 import client_info
+from google.cloud import firestore as cloud_firestore
+from google.cloud.firestore_v1.services.firestore import client as firestore_api_client
+from google.cloud.firestore_v1.services.firestore.transports import grpc as firestore_grpc
+import asyncio
+import grpc
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+import tracing
+
+# Single, process-wide registry for the Firestore client. Every module gets the
+# client from get_db() so the gRPC channel is created and warmed up once per
+# worker instead of lazily on the first user request.
+
+# gRPC channel configuration. Keepalive pings without active calls keep an idle
+# channel (and the connection behind it) open between requests.
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', int(os.environ.get('FIRESTORE_KEEPALIVE_MS', 30000))),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.max_send_message_length', -1),
+    ('grpc.max_receive_message_length', -1),
+]
+
+# Firestore endpoint the channel connects to
+FIRESTORE_HOST = os.environ.get('FIRESTORE_HOST', firestore_api_client.FirestoreClient.DEFAULT_ENDPOINT)
+
+# Identifies the client library in the request headers, as the library's own channel does
+CLIENT_INFO = client_info.ClientInfo(client_library_version=cloud_firestore.__version__)
+
+# Minimum seconds between channel rebuilds. Every failing request asks for a
+# reconnect; only the first one in an interval rebuilds the channel.
+RECONNECT_INTERVAL = float(os.environ.get('FIRESTORE_RECONNECT_INTERVAL', 30))
+
+# Timeout of the warm-up and health check RPCs, in seconds
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('FIRESTORE_HEALTH_CHECK_TIMEOUT', 5))
+
+# Errors that mean the channel is broken and should be rebuilt
+CONNECTION_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+)
+
+logger = logging.getLogger(__name__)
+
+client = None
+client_lock = threading.Lock()
+
+# Monotonic time of the last channel rebuild, None before the first
+last_reconnect = None
+
+# Async clients are bound to the event loop they were created on
+async_clients = weakref.WeakKeyDictionary()
+
+
+def init_firebase():
+    # Firebase initialization
+    if not firebase_admin._apps:
+        if 'FIREBASE_CREDENTIALS' in os.environ:
+            # For production (Vercel)
+            cred_dict = json.loads(os.environ.get('FIREBASE_CREDENTIALS'))
+            cred = credentials.Certificate(cred_dict)
+        else:
+            # For local development
+            cred = credentials.Certificate('serviceAccountKey.json')
+
+        firebase_admin.initialize_app(cred)
+
+    return firebase_admin.get_app()
+
+
+def configure_channel(db):
+    """
+    Open the client's gRPC channel now, with CHANNEL_OPTIONS instead of the
+    library defaults. A channel the client already had is closed.
+    """
+    if os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        # The emulator uses its own insecure channel
+        return
+    transport_class = firestore_grpc.FirestoreGrpcTransport
+    channel = transport_class.create_channel(
+        FIRESTORE_HOST,
+        credentials=init_firebase().credential.get_credential(),
+        options=CHANNEL_OPTIONS
+    )
+    # Every RPC records a span in the trace of the request that issued it
+    channel = grpc.intercept_channel(channel, tracing.FirestoreTracingInterceptor())
+    api = firestore_api_client.FirestoreClient(
+        transport=transport_class(host=FIRESTORE_HOST, channel=channel),
+        client_info=CLIENT_INFO
+    )
+    # The client creates its API client lazily on first use unless one is set
+    # here; it has no public way to pass channel options.
+    previous = db._firestore_api_internal
+    db._firestore_api_internal = api
+    if previous is not None:
+        # Calls still running on the old channel are cancelled; it is broken anyway
+        previous.transport.close()
+
+
+def create_client():
+    app = init_firebase()
+    project = app.project_id
+    if not project:
+        raise ValueError('Project ID is required to access Firestore')
+    db = firestore.Client(credentials=app.credential.get_credential(), project=project)
+    configure_channel(db)
+    return db
+
+
+def get_db():
+    """Return the shared Firestore client, creating it on first use"""
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                client = create_client()
+    return client
+
+
+def get_async_db():
+    """Return the async Firestore client for the running event loop, used by the ASGI serving mode"""
+    loop = asyncio.get_running_loop()
+    db = async_clients.get(loop)
+    if db is None:
+        app = init_firebase()
+        db = firestore.AsyncClient(credentials=app.credential.get_credential(), project=app.project_id)
+        async_clients[loop] = db
+    return db
+
+
+def set_async_client(db, loop=None):
+    """Replace the async client of an event loop, e.g. with an in-memory stand-in"""
+    async_clients[loop or asyncio.get_running_loop()] = db
+
+
+def set_client(db):
+    """Replace the shared client, e.g. with an in-memory stand-in for local load tests"""
+    global client
+    with client_lock:
+        client = db
+
+
+def reconnect():
+    """
+    Rebuild the gRPC channel of the shared client after a connection failure.
+    Returns False without rebuilding within RECONNECT_INTERVAL of the last rebuild.
+    """
+    global last_reconnect
+    db = get_db()
+    if not isinstance(db, firestore.Client):
+        return False
+    with client_lock:
+        now = time.monotonic()
+        if last_reconnect is not None and now - last_reconnect < RECONNECT_INTERVAL:
+            return False
+        last_reconnect = now
+        logger.warning("Reconnecting Firestore gRPC channel")
+        configure_channel(db)
+    return True
+
+
+def ping(timeout=HEALTH_CHECK_TIMEOUT):
+    """Issue a single cheap read and return its latency in milliseconds"""
+    started = time.perf_counter()
+    get_db().collection('_health').document('ping').get(timeout=timeout)
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def warm_up():
+    """
+    Establish the Firestore connection before the first user request.
+
+    The first RPC on a channel pays for DNS, TLS and HTTP/2 setup as well as
+    fetching an access token; doing it at worker start keeps that out of
+    request latency. Failures are logged, not raised, so a worker still boots.
+    """
+    try:
+        latency = ping()
+        logger.info("Firestore warm-up completed in %s ms", latency)
+        return True
+    except Exception as e:
+        logger.error("Firestore warm-up failed: %s", e)
+        return False
+
+
+def health_check():
+    """Check Firestore connectivity, rebuilding the channel once if it is broken"""
+    try:
+        return {'status': 'ok', 'latency_ms': ping()}
+    except CONNECTION_ERRORS:
+        reconnect()
+    except Exception as e:
+        return {'status': 'error', 'error': str(e)}
+
+    try:
+        return {'status': 'ok', 'latency_ms': ping(), 'reconnected': True}
+    except Exception as e:
+        return {'status': 'error', 'error': str(e), 'reconnected': True}
@@ -0,0 +1,162 @@
+from concurrent.futures import ThreadPoolExecutor
+from firebase_admin import firestore
+import datetime
+import logging
+import os
+
+from autosave import drafts
+from doc_cache import documents
+from singleflight import reads
+
+# Background cascade deletion of patients together with their session notes.
+# Job state is kept in the 'deletion_jobs' collection so any worker can report it.
+# Every deleted patient leaves a tombstone in 'patient_tombstones', which delta
+# syncs of the patient list (GET /api/patients?updated_since=) report to clients.
+
+# Notes deleted per batched write (Firestore's batch write limit)
+DELETE_PAGE_SIZE = 500
+
+# Days tombstones are kept. They carry an expire_at field for a Firestore TTL
+# policy; clients that last synced longer ago than this must resync in full.
+PATIENT_TOMBSTONE_RETENTION_DAYS = int(os.environ.get('PATIENT_TOMBSTONE_RETENTION_DAYS', 30))
+
+# Minutes without progress after which a pending or running job is taken as
+# interrupted, e.g. its worker was stopped or frozen after answering the request
+DELETION_JOB_STALE_AFTER = datetime.timedelta(minutes=int(os.environ.get('DELETION_JOB_STALE_MINUTES', 10)))
+
+logger = logging.getLogger(__name__)
+
+# Runs whole deletion jobs, so a delete request never blocks a request worker
+job_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cascade-delete')
+
+# Commits the batched writes of running jobs in parallel
+batch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='cascade-delete-batch')
+
+
+def start_patient_deletion(db, patient_id, doctor_id):
+    """Record a deletion job for a patient, start it in the background and return its id"""
+    job_ref = db.collection('deletion_jobs').document()
+    job_ref.set({
+        'patient_id': patient_id,
+        'doctor_id': doctor_id,
+        'status': 'pending',
+        'deleted_notes': 0,
+        'created_at': datetime.datetime.now(),
+        'updated_at': datetime.datetime.now()
+    })
+
+    job_executor.submit(run_patient_deletion, db, job_ref.id)
+
+    return job_ref.id
+
+
+def run_patient_deletion(db, job_id):
+    """Execute a deletion job and keep its status document up to date"""
+    job_ref = db.collection('deletion_jobs').document(job_id)
+    job = job_ref.get().to_dict()
+
+    job_ref.update({'status': 'running', 'updated_at': datetime.datetime.now()})
+
+    def report_progress(deleted_notes):
+        job_ref.update({'deleted_notes': deleted_notes, 'updated_at': datetime.datetime.now()})
+
+    try:
+        deleted_notes = delete_patient_cascade(db, job['patient_id'], job['doctor_id'], on_progress=report_progress)
+    except Exception as e:
+        logger.error("Patient deletion job %s failed: %s", job_id, e)
+        job_ref.update({
+            'status': 'failed',
+            'error': str(e),
+            'updated_at': datetime.datetime.now()
+        })
+        return
+
+    job_ref.update({
+        'status': 'completed',
+        'deleted_notes': deleted_notes,
+        'completed_at': datetime.datetime.now(),
+        'updated_at': datetime.datetime.now()
+    })
+
+
+def is_stale(job, stale_after=DELETION_JOB_STALE_AFTER):
+    """Whether a job needs to be re-run: it failed, or stopped reporting progress"""
+    if job.get('status') == 'failed':
+        return True
+    if job.get('status') not in ('pending', 'running'):
+        return False
+    updated_at = job.get('updated_at')
+    if updated_at is None:
+        return True
+    # Written as naive local times; Firestore returns them labelled UTC
+    return updated_at.replace(tzinfo=None) < datetime.datetime.now() - stale_after
+
+
+def stale_deletion_jobs(db, stale_after=DELETION_JOB_STALE_AFTER):
+    """Ids of the jobs that failed or were interrupted and should be re-run"""
+    for status in ('pending', 'running', 'failed'):
+        for doc in db.collection('deletion_jobs').where('status', '==', status).stream():
+            if is_stale(doc.to_dict(), stale_after):
+                yield doc.id
+
+
+def delete_note_batch(db, note_refs):
+    batch = db.batch()
+    for note_ref in note_refs:
+        batch.delete(note_ref)
+    batch.commit()
+    documents.invalidate(*note_refs)
+    # Pending autosave drafts of the notes must not outlive them
+    for note_ref in note_refs:
+        drafts.discard(note_ref.id)
+    return len(note_refs)
+
+
+def delete_patient_cascade(db, patient_id, doctor_id, on_progress=None):
+    """
+    Delete every session note of a patient and then the patient itself.
+
+    Notes are read one page of ids at a time while the batched deletes of
+    earlier pages are committed in parallel. The patient document goes last,
+    together with writing its tombstone, so an interrupted job leaves the
+    patient visible and can simply be re-run. Returns the number of notes deleted.
+    """
+    notes_query = db.collection('session_notes') \
+        .where('patient_id', '==', patient_id) \
+        .select([]) \
+        .limit(DELETE_PAGE_SIZE)
+
+    futures = []
+    last_doc = None
+    while True:
+        page = notes_query.start_after(last_doc) if last_doc else notes_query
+        docs = list(page.stream())
+        if docs:
+            futures.append(batch_executor.submit(delete_note_batch, db, [doc.reference for doc in docs]))
+        if len(docs) < DELETE_PAGE_SIZE:
+            break
+        last_doc = docs[-1]
+
+    deleted_notes = 0
+    for future in futures:
+        deleted_notes += future.result()
+        if on_progress:
+            on_progress(deleted_notes)
+
+    patient_ref = db.collection('patients').document(patient_id)
+    batch = db.batch()
+    batch.delete(patient_ref)
+    batch.set(db.collection('patient_tombstones').document(patient_id), {
+        'patient_id': patient_id,
+        'doctor_id': doctor_id,
+        'deleted_at': firestore.SERVER_TIMESTAMP,
+        'expire_at': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=PATIENT_TOMBSTONE_RETENTION_DAYS)
+    })
+    batch.commit()
+    documents.invalidate(patient_ref)
+    reads.forget('patients', doctor_id)
+    # Imported here, patient_routes imports this module
+    from patient_routes import forget_stats
+    forget_stats(doctor_id)
+
+    return deleted_notes
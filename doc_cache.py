@@ -0,0 +1,231 @@
+from cryptography.fernet import Fernet, InvalidToken
+from collections import OrderedDict
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from encryption import get_encryption_key
+
+# Read-through cache of individual Firestore documents (patients, session notes,
+# chat sessions), mostly serving the ownership checks that precede nearly every
+# handler. Entries expire after DOC_CACHE_TTL seconds and are dropped explicitly
+# by every write path of the app. Documents are stored Fernet-encrypted, so PHI
+# is never held in the cache in the clear.
+#
+# DOC_CACHE_BACKEND=memory keeps a bounded LRU per worker. DOC_CACHE_BACKEND=sqlite
+# shares one cache between the workers of a host through DOC_CACHE_PATH, so an
+# invalidation by one worker is seen by all. DOC_CACHE_BACKEND=off disables it.
+
+DOC_CACHE_BACKEND = os.environ.get('DOC_CACHE_BACKEND', 'memory').lower()
+DOC_CACHE_TTL = float(os.environ.get('DOC_CACHE_TTL', 60))
+DOC_CACHE_SIZE = int(os.environ.get('DOC_CACHE_SIZE', 10000))
+DOC_CACHE_PATH = os.environ.get('DOC_CACHE_PATH', 'doc_cache.sqlite3')
+
+logger = logging.getLogger(__name__)
+
+
+def cache_fernet():
+    # Derived from the encryption key so every worker sharing a cache file agrees on it
+    key = hmac.new(get_encryption_key().encode(), b'document-cache', hashlib.sha256).digest()
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode()}
+    raise TypeError(f'Cannot cache value of type {type(value).__name__}')
+
+
+def decode_value(value):
+    if '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    if '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+def seal(value):
+    """Encrypt a JSON-serializable value for keeping in memory"""
+    return documents.get_fernet().encrypt(json.dumps(value, default=encode_value).encode())
+
+
+def unseal(token):
+    return json.loads(documents.get_fernet().decrypt(token), object_hook=decode_value)
+
+
+class CachedSnapshot:
+    """Stands in for a DocumentSnapshot of an existing document"""
+
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = True
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+    def get(self, field):
+        return self._data.get(field)
+
+
+class MemoryBackend:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # path -> time of the last invalidation, to reject fills that read before it
+        self.invalidated = OrderedDict()
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return None
+            expires, token = entry
+            if expires < time.time():
+                del self.entries[path]
+                return None
+            self.entries.move_to_end(path)
+            return token
+
+    def put(self, path, token, read_started):
+        with self.lock:
+            if self.invalidated.get(path, 0) >= read_started:
+                return
+            self.entries[path] = (time.time() + DOC_CACHE_TTL, token)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+            self.invalidated[path] = time.time()
+            self.invalidated.move_to_end(path)
+            # Only invalidations younger than a read in flight matter
+            while self.invalidated and next(iter(self.invalidated.values())) < time.time() - DOC_CACHE_TTL:
+                self.invalidated.popitem(last=False)
+
+
+class SQLiteBackend:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.local = threading.local()
+        self.puts = 0
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS documents ('
+                'path TEXT PRIMARY KEY, token BLOB, expires REAL NOT NULL, invalidated REAL NOT NULL DEFAULT 0)'
+            )
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self.local.conn = conn
+        return conn
+
+    def get(self, path):
+        row = self.connection().execute(
+            'SELECT token FROM documents WHERE path = ? AND expires >= ? AND token IS NOT NULL', (path, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, path, token, read_started):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                'INSERT INTO documents (path, token, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET token = excluded.token, expires = excluded.expires '
+                'WHERE documents.invalidated < ?',
+                (path, token, time.time() + DOC_CACHE_TTL, read_started)
+            )
+            self.puts += 1
+            if self.puts % 1000 == 0:
+                self.evict(conn)
+
+    def evict(self, conn):
+        now = time.time()
+        conn.execute('DELETE FROM documents WHERE expires < ? AND invalidated < ?', (now, now - DOC_CACHE_TTL))
+        conn.execute(
+            'DELETE FROM documents WHERE path IN (SELECT path FROM documents WHERE token IS NOT NULL '
+            'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.size,)
+        )
+
+    def invalidate(self, path):
+        conn = self.connection()
+        now = time.time()
+        with conn:
+            conn.execute(
+                'INSERT INTO documents (path, token, expires, invalidated) VALUES (?, NULL, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET token = NULL, invalidated = excluded.invalidated',
+                (path, now + DOC_CACHE_TTL, now)
+            )
+
+
+class DocumentCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.fernet = None
+
+    def get_fernet(self):
+        if self.fernet is None:
+            self.fernet = cache_fernet()
+        return self.fernet
+
+    def get(self, doc_ref):
+        """Return the snapshot of doc_ref from the cache, or read it from Firestore and cache it"""
+        if self.backend is None:
+            return doc_ref.get()
+
+        token = self.backend.get(doc_ref.path)
+        if token is not None:
+            try:
+                entry = unseal(token)
+                return CachedSnapshot(doc_ref, entry['data'], entry['update_time'])
+            except (InvalidToken, ValueError, KeyError):
+                pass
+
+        read_started = time.time()
+        snapshot = doc_ref.get()
+        # Missing documents aren't cached; a later create must be seen at once
+        if snapshot.exists:
+            try:
+                token = seal({'data': snapshot.to_dict(), 'update_time': snapshot.update_time})
+                self.backend.put(doc_ref.path, token, read_started)
+            except Exception as e:
+                logger.warning("Error caching document %s: %s", doc_ref.path, e)
+        return snapshot
+
+    def invalidate(self, *doc_refs):
+        """Drop documents after they were written or deleted"""
+        if self.backend is None:
+            return
+        for doc_ref in doc_refs:
+            self.backend.invalidate(doc_ref if isinstance(doc_ref, str) else doc_ref.path)
+
+
+def create_backend():
+    if DOC_CACHE_BACKEND == 'sqlite':
+        return SQLiteBackend(DOC_CACHE_PATH, DOC_CACHE_SIZE)
+    if DOC_CACHE_BACKEND == 'memory':
+        return MemoryBackend(DOC_CACHE_SIZE)
+    return None
+
+
+documents = DocumentCache(create_backend())
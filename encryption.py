@@ -0,0 +1,345 @@
+from cryptography.fernet import Fernet
+from firebase_admin import firestore
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import base64
+import struct
+import threading
+import zlib
+import logging
+import os
+
+from tracing import traced
+
+# Envelope encryption for PHI.
+#
+# Every encrypted value gets its own random data key. The value is encrypted
+# with the data key and the data key is wrapped (encrypted) with a master key:
+#
+#     env1:<master key id>:<wrapped data key>:<ciphertext>
+#
+# Rotating the master key therefore only requires rewrapping data keys, which
+# can happen lazily as records are read or in a throttled background sweep.
+#
+# Master keys are configured in ENCRYPTION_KEYS as comma separated
+# "key_id:fernet_key" pairs and ENCRYPTION_KEY_ID selects the one used for new
+# data. The original ENCRYPTION_KEY is always available as key id 'default' and
+# still decrypts values written before envelope encryption.
+#
+# Session notes use a compact binary form of the same envelope, stored in a
+# Firestore bytes field instead of base64 text. The plaintext is compressed
+# before encryption and both Fernet tokens are stored as raw bytes:
+#
+#     version (1 byte) | flags (1 byte) | key id length (1 byte) | key id |
+#     wrapped key length (2 bytes) | wrapped data key | ciphertext
+
+ENVELOPE_PREFIX = 'env1'
+DEFAULT_KEY_ID = 'default'
+
+BINARY_FORMAT_VERSION = 1
+BINARY_HEADER = struct.Struct('>BBB')
+WRAPPED_KEY_LENGTH = struct.Struct('>H')
+FLAG_ZLIB = 0x01
+
+# Number of unwrapped data keys kept in memory
+DATA_KEY_CACHE_SIZE = int(os.environ.get('DATA_KEY_CACHE_SIZE', 1024))
+
+# Rewrap records to the active master key when they are read
+LAZY_REENCRYPTION = os.environ.get('LAZY_REENCRYPTION', 'False').lower() == 'true'
+
+logger = logging.getLogger(__name__)
+
+
+# Key management (store this securely, not in your code!)
+def get_encryption_key():
+    # In production, retrieve from secure key management service
+    # For development, you could use environment variable
+    key = os.environ.get('ENCRYPTION_KEY')
+
+    return key
+
+@lru_cache(maxsize=16)
+def fernet_for_key(key):
+    # Building a Fernet instance derives its signing and encryption keys, so reuse it
+    return Fernet(key.encode() if isinstance(key, str) else key)
+
+@lru_cache(maxsize=4)
+def parse_master_keys(configured, legacy_key):
+    master_keys = {}
+    if legacy_key:
+        master_keys[DEFAULT_KEY_ID] = legacy_key
+    for entry in (configured or '').split(','):
+        if entry.strip():
+            key_id, key = entry.strip().split(':', 1)
+            master_keys[key_id.strip()] = key.strip()
+    return master_keys
+
+def get_master_keys():
+    return parse_master_keys(os.environ.get('ENCRYPTION_KEYS'), get_encryption_key())
+
+def get_active_key_id():
+    return os.environ.get('ENCRYPTION_KEY_ID', DEFAULT_KEY_ID)
+
+def get_master_fernet(key_id):
+    key = get_master_keys().get(key_id)
+    if not key:
+        raise KeyError(f'Unknown master key id: {key_id}')
+    return fernet_for_key(key)
+
+
+class DataKeyCache:
+    """Thread-safe, bounded LRU of unwrapped data keys, keyed by wrapped key"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+data_key_cache = DataKeyCache(DATA_KEY_CACHE_SIZE)
+
+
+def wrap_data_key(data_key, key_id):
+    return get_master_fernet(key_id).encrypt(data_key).decode()
+
+def unwrap_data_key(key_id, wrapped_key):
+    """Return a Fernet instance for a wrapped data key, unwrapping it at most once while cached"""
+    cache_key = (key_id, wrapped_key)
+    data_fernet = data_key_cache.get(cache_key)
+    if data_fernet is None:
+        data_key = get_master_fernet(key_id).decrypt(wrapped_key.encode())
+        data_fernet = Fernet(data_key)
+        data_key_cache.put(cache_key, data_fernet)
+    return data_fernet
+
+def parse_envelope(value):
+    """Split an envelope into (key_id, wrapped_key, ciphertext), or None for legacy values"""
+    if not isinstance(value, str) or not value.startswith(ENVELOPE_PREFIX + ':'):
+        return None
+    _, key_id, wrapped_key, ciphertext = value.split(':', 3)
+    return key_id, wrapped_key, ciphertext
+
+
+# Encryption/decryption utilities
+@traced('crypto.encrypt')
+def encrypt_data(data):
+    if not data:
+        return None
+    key_id = get_active_key_id()
+    data_key = Fernet.generate_key()
+    wrapped_key = wrap_data_key(data_key, key_id)
+    data_fernet = Fernet(data_key)
+    data_key_cache.put((key_id, wrapped_key), data_fernet)
+    ciphertext = data_fernet.encrypt(data.encode()).decode()
+    return f"{ENVELOPE_PREFIX}:{key_id}:{wrapped_key}:{ciphertext}"
+
+@traced('crypto.decrypt')
+def decrypt_text(encrypted_data):
+    """Decrypt a text value, raising when it can't be decrypted"""
+    envelope = parse_envelope(encrypted_data)
+    if envelope:
+        key_id, wrapped_key, ciphertext = envelope
+        return unwrap_data_key(key_id, wrapped_key).decrypt(ciphertext.encode()).decode()
+    # Values written before envelope encryption use the master key directly
+    return fernet_for_key(get_encryption_key()).decrypt(encrypted_data.encode()).decode()
+
+def decrypt_data(encrypted_data):
+    if not encrypted_data:
+        return None
+    if isinstance(encrypted_data, bytes):
+        return decrypt_binary(encrypted_data)
+    try:
+        return decrypt_text(encrypted_data)
+    except Exception as e:
+        logger.warning("Decryption failed: %s", e)
+        # If decryption fails, return the original data
+        # This assumes the data might not be encrypted
+        return encrypted_data
+
+
+# Compact binary storage
+def pack_binary(flags, key_id, wrapped_key, ciphertext):
+    key_id_bytes = key_id.encode()
+    return b''.join([
+        BINARY_HEADER.pack(BINARY_FORMAT_VERSION, flags, len(key_id_bytes)),
+        key_id_bytes,
+        WRAPPED_KEY_LENGTH.pack(len(wrapped_key)),
+        wrapped_key,
+        ciphertext
+    ])
+
+def unpack_binary(blob):
+    """Split a binary envelope into (flags, key_id, wrapped_key, ciphertext), all Fernet tokens raw"""
+    version, flags, key_id_length = BINARY_HEADER.unpack_from(blob)
+    if version != BINARY_FORMAT_VERSION:
+        raise ValueError(f'Unsupported encrypted data version: {version}')
+    offset = BINARY_HEADER.size
+    key_id = blob[offset:offset + key_id_length].decode()
+    offset += key_id_length
+    (wrapped_length,) = WRAPPED_KEY_LENGTH.unpack_from(blob, offset)
+    offset += WRAPPED_KEY_LENGTH.size
+    wrapped_key = blob[offset:offset + wrapped_length]
+    return flags, key_id, wrapped_key, blob[offset + wrapped_length:]
+
+@traced('crypto.encrypt_binary')
+def encrypt_binary(data):
+    """Compress and encrypt text into the compact binary envelope format"""
+    if not data:
+        return None
+    plaintext = data.encode()
+    flags = 0
+    compressed = zlib.compress(plaintext)
+    if len(compressed) < len(plaintext):
+        plaintext = compressed
+        flags |= FLAG_ZLIB
+
+    key_id = get_active_key_id()
+    data_key = Fernet.generate_key()
+    wrapped_key = base64.urlsafe_b64decode(wrap_data_key(data_key, key_id))
+    data_fernet = Fernet(data_key)
+    data_key_cache.put((key_id, wrapped_key), data_fernet)
+    ciphertext = base64.urlsafe_b64decode(data_fernet.encrypt(plaintext))
+    return pack_binary(flags, key_id, wrapped_key, ciphertext)
+
+@traced('crypto.decrypt_binary')
+def decrypt_binary(blob):
+    try:
+        flags, key_id, wrapped_key, ciphertext = unpack_binary(blob)
+        data_fernet = data_key_cache.get((key_id, wrapped_key))
+        if data_fernet is None:
+            data_key = get_master_fernet(key_id).decrypt(base64.urlsafe_b64encode(wrapped_key))
+            data_fernet = Fernet(data_key)
+            data_key_cache.put((key_id, wrapped_key), data_fernet)
+        plaintext = data_fernet.decrypt(base64.urlsafe_b64encode(ciphertext))
+        if flags & FLAG_ZLIB:
+            plaintext = zlib.decompress(plaintext)
+        return plaintext.decode()
+    except Exception as e:
+        logger.warning("Decryption failed: %s", e)
+        return None
+
+# Session notes are stored in the binary format; older string tokens still decrypt
+encrypt_note = encrypt_binary
+
+
+# Key rotation
+def stored_key_id(value):
+    """Return the master key id protecting a stored value, or None for legacy values"""
+    if isinstance(value, bytes):
+        return unpack_binary(value)[1]
+    envelope = parse_envelope(value)
+    return envelope[0] if envelope else None
+
+def is_plaintext(value):
+    """
+    Check whether a stored text value was never encrypted, i.e. is neither an
+    envelope nor a Fernet token (version byte, timestamp, IV, AES blocks, HMAC).
+    """
+    if not isinstance(value, str) or not value or parse_envelope(value):
+        return False
+    try:
+        token = base64.b64decode(value, altchars=b'-_', validate=True)
+    except ValueError:
+        return True
+    return not (len(token) >= 73 and token[0] == 0x80 and (len(token) - 57) % 16 == 0)
+
+def needs_reencryption(value, binary=False):
+    """
+    Check whether a stored value is not yet wrapped with the active master key.
+    With binary=True, text values also need rewriting into the binary format.
+    """
+    if not value:
+        return False
+    if binary and not isinstance(value, bytes):
+        return True
+    return stored_key_id(value) != get_active_key_id()
+
+def reencrypt(value, binary=False):
+    """
+    Return a stored value protected by the active master key.
+
+    Envelopes only have their data key rewrapped, the ciphertext is kept as is.
+    Legacy values, and text values when binary=True, are decrypted and
+    encrypted into a new envelope. Plaintext stored before the field was
+    encrypted is encrypted as is. Raises for ciphertext that doesn't decrypt,
+    which is left as it is rather than encrypted a second time.
+    """
+    active_key_id = get_active_key_id()
+
+    if isinstance(value, bytes):
+        flags, key_id, wrapped_key, ciphertext = unpack_binary(value)
+        if key_id == active_key_id:
+            return value
+        data_key = get_master_fernet(key_id).decrypt(base64.urlsafe_b64encode(wrapped_key))
+        rewrapped = base64.urlsafe_b64decode(wrap_data_key(data_key, active_key_id))
+        return pack_binary(flags, active_key_id, rewrapped, ciphertext)
+
+    envelope = parse_envelope(value)
+    if envelope is None or binary:
+        if is_plaintext(value):
+            plaintext = value
+        else:
+            try:
+                plaintext = decrypt_text(value)
+            except Exception as e:
+                raise ValueError(f'Stored value does not decrypt: {e}') from e
+        return (encrypt_binary if binary else encrypt_data)(plaintext)
+
+    key_id, wrapped_key, ciphertext = envelope
+    if key_id == active_key_id:
+        return value
+
+    data_key = get_master_fernet(key_id).decrypt(wrapped_key.encode())
+    return f"{ENVELOPE_PREFIX}:{active_key_id}:{wrap_data_key(data_key, active_key_id)}:{ciphertext}"
+
+def reencrypt_fields(data, fields, binary=False):
+    """Return the updates needed to move the given fields of a document to the active master key"""
+    return {
+        field: reencrypt(data[field], binary=binary)
+        for field in fields
+        if needs_reencryption(data.get(field), binary=binary)
+    }
+
+# Lazy re-encryption writes happen off the request path
+rewrap_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='lazy-reencrypt')
+
+def schedule_reencryption(snapshot, fields, binary=False, reference=None):
+    """
+    When lazy re-encryption is enabled, rewrap stale fields of a document that
+    was just read. reference is the document to write to when the snapshot's
+    own can't be used from a thread, i.e. it was read with the async client.
+    """
+    if not LAZY_REENCRYPTION:
+        return
+    data = snapshot.to_dict() or {}
+    if not any(needs_reencryption(data.get(field), binary=binary) for field in fields):
+        return
+
+    def rewrap():
+        try:
+            updates = reencrypt_fields(data, fields, binary=binary)
+            if updates:
+                # Skip the rewrap if the document changed since it was read
+                option = firestore.Client.write_option(last_update_time=snapshot.update_time)
+                target = reference or snapshot.reference
+                target.update(updates, option=option)
+                from doc_cache import documents
+                documents.invalidate(target)
+        except Exception as e:
+            logger.error("Lazy re-encryption of %s failed: %s", snapshot.reference.path, e)
+
+    rewrap_executor.submit(rewrap)
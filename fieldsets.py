@@ -0,0 +1,49 @@
+from flask import request
+
+# Sparse fieldsets. List and detail endpoints accept ?fields=a,b,c to return only
+# the named fields. List queries push the selection down to Firestore as a
+# select() projection, so unrequested fields are never read; detail endpoints
+# serve their ownership check from the document cache and skip decrypting, and
+# any extra reads for, the fields left out. The document id is always returned.
+
+# Projection returning no fields but the document name
+DOCUMENT_NAME_ONLY = ['__name__']
+
+
+def requested_fields(allowed):
+    """
+    The set of fields named by the fields query parameter, or None when it is
+    absent. Raises ValueError for fields the endpoint doesn't return.
+    """
+    value = request.args.get('fields')
+    if value is None:
+        return None
+    fields = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = fields - set(allowed)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}. Available: {', '.join(allowed)}")
+    return fields
+
+
+def wants(fields, name):
+    return fields is None or name in fields
+
+
+def projection(fields, stored_fields):
+    """Firestore field paths to select for the requested fields; None selects everything"""
+    if fields is None:
+        return None
+    return sorted(field for field in stored_fields if field in fields) or DOCUMENT_NAME_ONLY
+
+
+def select(query, fields, stored_fields):
+    """Apply the projection for the requested fields to a query"""
+    field_paths = projection(fields, stored_fields)
+    return query if field_paths is None else query.select(field_paths)
+
+
+def pick(data, fields, always=('id',)):
+    """Drop the fields of a serialized document that weren't requested"""
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields or key in always}
@@ -0,0 +1,255 @@
+"""
+Offline load test for the API.
+
+Boots the app against an in-memory Firestore stand-in and a local fake SMTP
+server, drives realistic scenarios from concurrent virtual users and reports
+p50/p95/p99 latency and throughput per endpoint.
+
+    python -m loadtest --users 20 --duration 60 --firestore-latency-ms 15 --smtp-latency-ms 80
+"""
+from cryptography.fernet import Fernet
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+
+from loadtest.fake_firestore import FakeFirestore
+from loadtest.fake_smtp import FakeSMTPSink
+
+SCENARIOS = ('login', 'patients', 'notes', 'chat')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.statuses = {}
+
+    def record(self, name, status, seconds):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+            counts = self.statuses.setdefault(name, {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def report(self, elapsed):
+        rows = []
+        for name in sorted(self.samples):
+            latencies = sorted(self.samples[name])
+            statuses = self.statuses[name]
+            errors = sum(count for status, count in statuses.items() if status >= 400)
+            rows.append({
+                'endpoint': name,
+                'requests': len(latencies),
+                'errors': errors,
+                'statuses': {str(status): count for status, count in sorted(statuses.items())},
+                'throughput_rps': round(len(latencies) / elapsed, 2),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            })
+        return rows
+
+
+class VirtualUser:
+    def __init__(self, index, app, sink, recorder, scenarios, messages_per_chat):
+        self.client = app.test_client()
+        self.sink = sink
+        self.recorder = recorder
+        self.scenarios = scenarios
+        self.messages_per_chat = messages_per_chat
+        self.email = f'loadtest-{index}-{uuid.uuid4().hex[:8]}@example.com'
+        self.password = uuid.uuid4().hex
+        # Each virtual user connects from its own address, so admission control
+        # sees separate clients
+        self.client.environ_base['REMOTE_ADDR'] = f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}'
+        self.headers = {}
+        self.token = None
+
+    def call(self, name, method, path, json_body=None):
+        headers = dict(self.headers)
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        started = time.perf_counter()
+        response = self.client.open(path, method=method, headers=headers, json=json_body)
+        # Streamed responses are only complete once fully read
+        data = response.get_data()
+        self.recorder.record(name, response.status_code, time.perf_counter() - started)
+        if response.is_json and data:
+            return response.status_code, response.get_json()
+        return response.status_code, None
+
+    def register(self):
+        status, body = self.call('POST /api/register', 'POST', '/api/register', {
+            'email': self.email, 'password': self.password, 'name': 'Load Test'
+        })
+        if status != 200:
+            return False
+        status, _ = self.call('POST /api/verify-registration', 'POST', '/api/verify-registration', {
+            'verification_id': body['verification_id'], 'totp': self.sink.latest_code(self.email)
+        })
+        return status == 201
+
+    def login(self):
+        self.token = None
+        status, body = self.call('POST /api/login', 'POST', '/api/login', {
+            'email': self.email, 'password': self.password
+        })
+        if status != 200:
+            return False
+        status, body = self.call('POST /api/verify-login', 'POST', '/api/verify-login', {
+            'verification_id': body['verification_id'], 'totp': self.sink.latest_code(self.email)
+        })
+        if status != 200:
+            return False
+        self.token = body['token']
+        self.call('GET /api/user', 'GET', '/api/user')
+        return True
+
+    def patients(self):
+        status, body = self.call('POST /api/patients', 'POST', '/api/patients', {
+            'name': random.choice(['Alex', 'Sam', 'Jordan', 'Taylor']) + ' ' + uuid.uuid4().hex[:6],
+            'age': random.randint(1, 95),
+            'gender': random.choice(['male', 'female', 'other'])
+        })
+        if status != 201:
+            return None
+        patient_id = body['patient_id']
+        self.call('GET /api/patients', 'GET', '/api/patients')
+        self.call('GET /api/patients/<id>', 'GET', f'/api/patients/{patient_id}')
+        self.call('PUT /api/patients/<id>', 'PUT', f'/api/patients/{patient_id}', {'age': random.randint(1, 95)})
+        return patient_id
+
+    def notes(self, patient_id):
+        note = 'Patient reports steady improvement. ' * random.randint(5, 40)
+        status, body = self.call('POST /api/patients/<id>/session-note', 'POST',
+                                 f'/api/patients/{patient_id}/session-note', {'note': note})
+        if status != 201:
+            return
+        session_id = body['session_id']
+        self.call('PUT /api/session-notes/<id>', 'PUT', f'/api/session-notes/{session_id}',
+                  {'note': note + 'Follow-up scheduled.'})
+        self.call('GET /api/session-notes/<id>', 'GET', f'/api/session-notes/{session_id}')
+        self.call('GET /api/patients/<id>/session-notes', 'GET', f'/api/patients/{patient_id}/session-notes')
+
+    def chat(self):
+        status, body = self.call('POST /api/chat/sessions', 'POST', '/api/chat/sessions', {'title': 'Load test'})
+        if status != 201:
+            return
+        session_id = body['session_id']
+        for index in range(self.messages_per_chat):
+            self.call('POST /api/chat/sessions/<id>/messages', 'POST', f'/api/chat/sessions/{session_id}/messages', {
+                'sender': 'user' if index % 2 == 0 else 'assistant',
+                'content': f'Message {index} about dosage and follow-up care.'
+            })
+        self.call('GET /api/chat/sessions/<id>', 'GET', f'/api/chat/sessions/{session_id}')
+        self.call('GET /api/chat/sessions', 'GET', '/api/chat/sessions')
+
+    def run(self, deadline):
+        if not self.register():
+            return
+        while time.monotonic() < deadline:
+            if 'login' in self.scenarios or not self.token:
+                if not self.login():
+                    time.sleep(1)
+                    continue
+            patient_id = None
+            if 'patients' in self.scenarios or 'notes' in self.scenarios:
+                patient_id = self.patients()
+            if 'notes' in self.scenarios and patient_id:
+                self.notes(patient_id)
+            if 'chat' in self.scenarios:
+                self.chat()
+            if patient_id:
+                self.call('DELETE /api/patients/<id>', 'DELETE', f'/api/patients/{patient_id}')
+
+
+def configure_environment(args, sink):
+    """Point the app at the fake SMTP server; must run before the app is imported"""
+    os.environ.setdefault('SECRET_KEY', 'loadtest-secret-key')
+    os.environ.setdefault('ENCRYPTION_KEY', Fernet.generate_key().decode())
+    os.environ['MAIL_SERVER'] = sink.host
+    os.environ['MAIL_PORT'] = str(sink.port)
+    os.environ['MAIL_USE_SSL'] = 'False'
+    os.environ['MAIL_USE_TLS'] = 'False'
+    os.environ['MAIL_USERNAME'] = 'loadtest@example.com'
+    os.environ['MAIL_DEFAULT_SENDER'] = 'loadtest@example.com'
+    os.environ['ADMISSION_CONTROL'] = 'True' if args.admission_control else 'False'
+
+
+def print_report(rows, elapsed, total):
+    header = f"{'endpoint':45} {'reqs':>7} {'errs':>6} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['endpoint']:45} {row['requests']:>7} {row['errors']:>6} {row['throughput_rps']:>8} "
+              f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+    print('-' * len(header))
+    print(f"{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test against in-memory Firestore and a fake SMTP server')
+    parser.add_argument('--users', type=int, default=10, help='Concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='Test duration in seconds')
+    parser.add_argument('--ramp-up', type=float, default=2, help='Seconds over which users are started')
+    parser.add_argument('--firestore-latency-ms', type=float, default=10, help='Latency added to every Firestore call')
+    parser.add_argument('--smtp-latency-ms', type=float, default=50, help='Latency added to every email delivery')
+    parser.add_argument('--messages-per-chat', type=int, default=4)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"Comma separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument('--no-admission-control', dest='admission_control', action='store_false',
+                        help='Disable rate limiting of the auth routes during the test')
+    parser.add_argument('--json', dest='json_output', help='Also write the report to this JSON file')
+    args = parser.parse_args()
+
+    scenarios = {name.strip() for name in args.scenarios.split(',') if name.strip()}
+    unknown = scenarios - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    sink = FakeSMTPSink(latency=args.smtp_latency_ms / 1000).start()
+    configure_environment(args, sink)
+
+    import database
+    database.set_client(FakeFirestore(latency=args.firestore_latency_ms / 1000))
+    from app import app
+
+    recorder = Recorder()
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = []
+    for index in range(args.users):
+        user = VirtualUser(index, app, sink, recorder, scenarios, args.messages_per_chat)
+        thread = threading.Thread(target=user.run, args=(deadline,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        if args.users > 1:
+            time.sleep(args.ramp_up / args.users)
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    sink.stop()
+
+    rows = recorder.report(elapsed)
+    total = sum(row['requests'] for row in rows)
+    print_report(rows, elapsed, total)
+
+    if args.json_output:
+        with open(args.json_output, 'w') as f:
+            json.dump({'elapsed_seconds': round(elapsed, 2), 'total_requests': total, 'endpoints': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+from google.api_core.exceptions import FailedPrecondition, AlreadyExists, NotFound
+from google.cloud.firestore_v1 import transforms
+import copy
+import datetime
+import threading
+import time
+import uuid
+
+# In-memory stand-in for the Firestore client, covering the subset of the API
+# the app uses. Every RPC-like call sleeps for the configured latency so load
+# tests see realistic I/O waits without a network.
+
+
+class FakeFirestore:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.RLock()
+        # Full document path -> document data
+        self.documents = {}
+        self.update_times = {}
+
+    def rpc(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def document(self, path):
+        return DocumentReference(self, path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    # Storage helpers, always called with the lock held
+    def write(self, path, data, merge=False):
+        existing = self.documents.get(path) if merge else None
+        self.documents[path] = apply_fields(copy.deepcopy(existing) if existing else {}, data, merge=merge)
+        self.update_times[path] = now()
+
+    def update(self, path, data):
+        if path not in self.documents:
+            raise NotFound(f'No document to update: {path}')
+        document = self.documents[path]
+        for field, value in data.items():
+            target = document
+            parts = field.split('.')
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            set_field(target, parts[-1], value)
+        self.update_times[path] = now()
+
+    def delete(self, path):
+        self.documents.pop(path, None)
+        self.update_times.pop(path, None)
+
+    def check_exists(self, path):
+        if path not in self.documents:
+            raise NotFound(f'No document to update: {path}')
+
+    def check_missing(self, path):
+        if path in self.documents:
+            raise AlreadyExists(f'Document already exists: {path}')
+
+    def check_option(self, path, option):
+        # Only last_update_time preconditions are used by the app
+        last_update_time = getattr(option, '_last_update_time', None)
+        if last_update_time is not None and self.update_times.get(path) != last_update_time:
+            raise FailedPrecondition(f'Document changed since it was read: {path}')
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def set_field(target, name, value):
+    if value is transforms.DELETE_FIELD:
+        target.pop(name, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        target[name] = now()
+    elif isinstance(value, transforms.Increment):
+        target[name] = (target.get(name) or 0) + value.value
+    elif isinstance(value, dict):
+        target[name] = apply_fields({}, value)
+    else:
+        target[name] = copy.deepcopy(value)
+
+
+def apply_fields(document, data, merge=False):
+    for name, value in data.items():
+        if merge and isinstance(value, dict) and isinstance(document.get(name), dict):
+            apply_fields(document[name], value, merge=True)
+        else:
+            set_field(document, name, value)
+    return document
+
+
+def get_path(data, field):
+    value = data
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, update_time, field_paths=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        if data is not None and field_paths is not None:
+            data = {field: data[field] for field in field_paths if field in data}
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return copy.deepcopy(get_path(self._data or {}, field))
+
+
+class DocumentReference:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return CollectionReference(self.db, f'{self.path}/{name}')
+
+    def get(self, field_paths=None, timeout=None, **kwargs):
+        self.db.rpc()
+        with self.db.lock:
+            data = copy.deepcopy(self.db.documents.get(self.path))
+            return DocumentSnapshot(self, data, self.db.update_times.get(self.path), field_paths)
+
+    def set(self, data, merge=False):
+        self.db.rpc()
+        with self.db.lock:
+            self.db.write(self.path, data, merge=merge)
+
+    def create(self, data):
+        self.db.rpc()
+        with self.db.lock:
+            self.db.check_missing(self.path)
+            self.db.write(self.path, data)
+
+    def update(self, data, option=None):
+        self.db.rpc()
+        with self.db.lock:
+            self.db.check_option(self.path, option)
+            self.db.update(self.path, data)
+
+    def delete(self, option=None):
+        self.db.rpc()
+        with self.db.lock:
+            self.db.check_option(self.path, option)
+            self.db.delete(self.path)
+
+
+OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a is not None and a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+    'array_contains_any': lambda a, b: isinstance(a, list) and any(v in a for v in b),
+}
+
+
+def matches_filter(data, field, op, value):
+    try:
+        return OPERATORS[op](comparable(get_path(data, field)), comparable(value))
+    except TypeError:
+        # Values of different types never match range filters
+        return False
+
+
+def comparable(value):
+    # Mixed naive and aware datetimes are compared as UTC, like Firestore does
+    if isinstance(value, datetime.datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+class Query:
+    def __init__(self, db, path, filters=(), orders=(), limit_count=None, cursor=None, fields=None):
+        self.db = db
+        self.path = path
+        self.filters = tuple(filters)
+        self.orders = tuple(orders)
+        self.limit_count = limit_count
+        self.cursor = cursor
+        self.fields = fields
+
+    def copy(self, **changes):
+        options = dict(filters=self.filters, orders=self.orders, limit_count=self.limit_count,
+                       cursor=self.cursor, fields=self.fields)
+        options.update(changes)
+        return Query(self.db, self.path, **options)
+
+    def where(self, field, op, value):
+        return self.copy(filters=self.filters + ((field, op, value),))
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self.copy(orders=self.orders + ((field, direction),))
+
+    def limit(self, count):
+        return self.copy(limit_count=count)
+
+    def start_after(self, cursor):
+        return self.copy(cursor=cursor)
+
+    def select(self, field_paths):
+        return self.copy(fields=list(field_paths))
+
+    def sort_key(self, doc_id, data):
+        return tuple(comparable(get_path(data, field)) for field, _ in self.orders) + (doc_id,)
+
+    def run(self):
+        with self.db.lock:
+            prefix = self.path + '/'
+            matches = []
+            for path, data in self.db.documents.items():
+                if not path.startswith(prefix) or '/' in path[len(prefix):]:
+                    continue
+                if not all(matches_filter(data, field, op, value) for field, op, value in self.filters):
+                    continue
+                # Documents without an ordered field are left out, as in Firestore
+                if any(get_path(data, field) is None for field, _ in self.orders):
+                    continue
+                matches.append((path, copy.deepcopy(data), self.db.update_times.get(path)))
+
+        # Stable sorts, least significant first; ties are ordered by document id
+        matches.sort(key=lambda m: m[0])
+        for field, direction in reversed(self.orders):
+            matches.sort(key=lambda m: comparable(get_path(m[1], field)), reverse=direction == 'DESCENDING')
+
+        if self.cursor is not None:
+            if isinstance(self.cursor, DocumentSnapshot):
+                cursor_path = self.cursor.reference.path
+                positions = [i for i, m in enumerate(matches) if m[0] == cursor_path]
+                if positions:
+                    matches = matches[positions[0] + 1:]
+                else:
+                    cursor_data = self.cursor.to_dict() or {}
+                    cursor_key = self.sort_key(self.cursor.id, cursor_data)
+                    matches = [m for m in matches if self.after(m, cursor_key)]
+            else:
+                cursor_key = self.sort_key('', self.cursor)
+                matches = [m for m in matches if self.after(m, cursor_key)]
+
+        if self.limit_count is not None:
+            matches = matches[:self.limit_count]
+
+        return [
+            DocumentSnapshot(DocumentReference(self.db, path), data, update_time, self.fields)
+            for path, data, update_time in matches
+        ]
+
+    def after(self, match, cursor_key):
+        key = self.sort_key(match[0].rsplit('/', 1)[-1], match[1])
+        for (_, direction), value, cursor_value in zip(self.orders, key, cursor_key):
+            if value == cursor_value:
+                continue
+            return value < cursor_value if direction == 'DESCENDING' else value > cursor_value
+        return key[-1] > cursor_key[-1]
+
+    def get(self, timeout=None, **kwargs):
+        self.db.rpc()
+        return self.run()
+
+    def stream(self, timeout=None, **kwargs):
+        self.db.rpc()
+        return iter(self.run())
+
+    def count(self, alias=None):
+        return AggregationQuery(self).count(alias)
+
+    def sum(self, field, alias=None):
+        return AggregationQuery(self).sum(field, alias)
+
+    def avg(self, field, alias=None):
+        return AggregationQuery(self).avg(field, alias)
+
+
+class AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class AggregationQuery:
+    def __init__(self, query):
+        self.query = query
+        self.aggregations = []
+
+    def count(self, alias=None):
+        self.aggregations.append((alias or 'count', 'count', None))
+        return self
+
+    def sum(self, field, alias=None):
+        self.aggregations.append((alias or 'sum', 'sum', field))
+        return self
+
+    def avg(self, field, alias=None):
+        self.aggregations.append((alias or 'avg', 'avg', field))
+        return self
+
+    def get(self, timeout=None, **kwargs):
+        self.query.db.rpc()
+        docs = self.query.run()
+        results = []
+        for alias, kind, field in self.aggregations:
+            if kind == 'count':
+                value = len(docs)
+            else:
+                numbers = [doc.get(field) for doc in docs if isinstance(doc.get(field), (int, float))]
+                if kind == 'sum':
+                    value = sum(numbers)
+                else:
+                    value = sum(numbers) / len(numbers) if numbers else None
+            results.append(AggregationResult(alias, value))
+        return [results]
+
+
+class CollectionReference(Query):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, doc_id=None):
+        return DocumentReference(self.db, f'{self.path}/{doc_id or uuid.uuid4().hex[:20]}')
+
+    def add(self, data):
+        doc_ref = self.document()
+        doc_ref.set(data)
+        return now(), doc_ref
+
+
+class WriteBatch:
+    """Commits atomically: every precondition is checked before any write is applied"""
+
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, doc_ref, data, merge=False):
+        self.writes.append((None, lambda: self.db.write(doc_ref.path, data, merge=merge)))
+
+    def create(self, doc_ref, data):
+        self.writes.append((lambda: self.db.check_missing(doc_ref.path), lambda: self.db.write(doc_ref.path, data)))
+
+    def update(self, doc_ref, data, option=None):
+        def check():
+            self.db.check_exists(doc_ref.path)
+            self.db.check_option(doc_ref.path, option)
+        self.writes.append((check, lambda: self.db.update(doc_ref.path, data)))
+
+    def delete(self, doc_ref, option=None):
+        self.writes.append((lambda: self.db.check_option(doc_ref.path, option), lambda: self.db.delete(doc_ref.path)))
+
+    def commit(self, timeout=None, **kwargs):
+        self.db.rpc()
+        with self.db.lock:
+            for check, _ in self.writes:
+                if check:
+                    check()
+            for _, write in self.writes:
+                write()
+        self.writes = []
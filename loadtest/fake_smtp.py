@@ -0,0 +1,103 @@
+import email
+import re
+import socketserver
+import threading
+import time
+
+# Minimal SMTP sink for load tests. It speaks just enough SMTP for smtplib and
+# Flask-Mail to deliver messages, keeps the latest verification code sent to
+# each recipient, and can add latency to every delivery.
+
+TOTP_PATTERN = re.compile(r'verification code is: (\d+)')
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        sink = self.server.sink
+        self.reply('220 fake-smtp ready')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if verb == 'EHLO':
+                self.reply('250-fake-smtp')
+                self.reply('250-AUTH PLAIN')
+                self.reply('250 8BITMIME')
+            elif verb == 'HELO':
+                self.reply('250 fake-smtp')
+            elif verb == 'AUTH':
+                # Any credentials are accepted
+                self.reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip().strip('<>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                sink.deliver(recipients, b''.join(lines))
+                self.reply('250 OK: queued')
+            elif verb == 'RSET':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class ThreadingSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeSMTPSink:
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.codes = {}
+        self.delivered = 0
+        self.server = ThreadingSMTPServer((host, port), SMTPHandler)
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def deliver(self, recipients, raw_message):
+        if self.latency:
+            time.sleep(self.latency)
+        message = email.message_from_bytes(raw_message)
+        body = message.get_payload(decode=True) or b''
+        match = TOTP_PATTERN.search(body.decode(errors='replace'))
+        with self.lock:
+            self.delivered += 1
+            if match:
+                for recipient in recipients:
+                    self.codes[recipient] = match.group(1)
+
+    def latest_code(self, recipient):
+        with self.lock:
+            return self.codes.get(recipient)
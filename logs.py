@@ -1,20 +1,34 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from functools import wraps
 import datetime
 from flask import current_app
 import jwt
 from firebase_admin import firestore
+import base64
+import csv
+import io
+import json
+import os
+import heapq
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import click
+
+from database import get_db
+from tracing import propagate
+from batch import batch_user
 
 # Create a blueprint for logs-related routes
 logs_bp = Blueprint('logs', __name__)
 
-def get_db():
-    from firebase_admin import firestore
-    return firestore.client()
-
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
+        # Sub-requests of /api/batch were authenticated once by the batch request
+        current_user = batch_user()
+        if current_user is not None:
+            return f(current_user, *args, **kwargs)
+
         token = None
         
         if 'Authorization' in request.headers:
@@ -46,6 +60,61 @@ def token_required(f):
     
     return decorated
 
+# Audit logs are spread over several collections so that the monotonically
+# increasing timestamp index is not a single write hotspot. The shard count
+# may be increased later, but must never be lowered.
+AUDIT_LOG_SHARDS = int(os.environ.get('AUDIT_LOG_SHARDS', 8))
+
+# Collection used before sharding; read alongside the shards until migrated
+LEGACY_AUDIT_LOG_COLLECTION = 'audit_logs'
+READ_LEGACY_AUDIT_LOGS = os.environ.get('AUDIT_LOG_READ_LEGACY', 'True').lower() == 'true'
+
+def audit_log_shard(log_id):
+    """Return the name of the shard collection a log document belongs to"""
+    return f"audit_logs_{zlib.crc32(log_id.encode()) % AUDIT_LOG_SHARDS:02d}"
+
+def audit_log_collections():
+    """Return every collection that may hold audit logs"""
+    collections = [f"audit_logs_{shard:02d}" for shard in range(AUDIT_LOG_SHARDS)]
+    if READ_LEGACY_AUDIT_LOGS:
+        collections.append(LEGACY_AUDIT_LOG_COLLECTION)
+    return collections
+
+# Shared by all requests so fan-in reads don't pay thread start-up costs
+shard_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='audit-log-shard')
+
+def fan_in(fetch, collections):
+    """Run fetch(collection) for every collection concurrently and return the results in order"""
+    return list(shard_executor.map(propagate(fetch), collections))
+
+def rollup_doc_id(user_id, period):
+    return f"{user_id}_{period}"
+
+def log_day(timestamp):
+    """The UTC day a log is counted under; naive timestamps are taken as UTC, as Firestore stores them"""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc)
+    return timestamp.strftime('%Y-%m-%d')
+
+def increment_rollup(batch, db, log_entry):
+    """
+    Add the rollup updates for a log entry to a write batch.
+
+    Rollup documents live in 'audit_log_rollups', one per user per day, and in
+    'audit_log_monthly_rollups', one per user per month. Both hold a total plus a
+    per action_type count map, all maintained with atomic increments.
+    """
+    day = log_day(log_entry['timestamp'])
+    month = day[:7]
+    counts = {
+        'total': firestore.Increment(1),
+        'counts': {log_entry['action_type']: firestore.Increment(1)}
+    }
+    rollup_ref = db.collection('audit_log_rollups').document(rollup_doc_id(log_entry['user_id'], day))
+    batch.set(rollup_ref, {'user_id': log_entry['user_id'], 'date': day, **counts}, merge=True)
+    monthly_ref = db.collection('audit_log_monthly_rollups').document(rollup_doc_id(log_entry['user_id'], month))
+    batch.set(monthly_ref, {'user_id': log_entry['user_id'], 'month': month, **counts}, merge=True)
+
 @logs_bp.route('/api/logs', methods=['POST'])
 @token_required
 def create_audit_log(current_user):
@@ -69,19 +138,24 @@ def create_audit_log(current_user):
     log_entry = {
         'user_id': current_user['id'],
         'user_email': current_user['email'],
-        'timestamp': datetime.datetime.now(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc),
         'action_type': data.get('action_type'),
         'location': data.get('location', ''),
         'device': data.get('device', ''),
         'details': data.get('details', {})
     }
     
-    # Add log to database
-    log_ref = db.collection('audit_logs').add(log_entry)
+    # Add log to its shard together with its daily and monthly rollup increments
+    log_id = db.collection(LEGACY_AUDIT_LOG_COLLECTION).document().id
+    log_ref = db.collection(audit_log_shard(log_id)).document(log_id)
+    batch = db.batch()
+    batch.set(log_ref, log_entry)
+    increment_rollup(batch, db, log_entry)
+    batch.commit()
     
     return jsonify({
         'message': 'Audit log created successfully',
-        'log_id': log_ref[1].id
+        'log_id': log_ref.id
     }), 201
 
 @logs_bp.route('/api/logs', methods=['GET'])
@@ -96,52 +170,60 @@ def get_audit_logs(current_user):
     - action_type: Optional action type for filtering
     - limit: Optional limit on number of results (default: 100)
     
-    Note: This API requires a composite index in Firestore. If you get an error, follow the URL
-    in the error message to create the necessary index.
+    Logs are read from every shard collection concurrently and merged by timestamp.
+    
+    Note: This API requires a composite index in Firestore for each shard collection. If you get
+    an error, follow the URL in the error message to create the necessary index.
     """
     db = get_db()
     
-    # Start with basic query filtered by user_id
-    query = db.collection('audit_logs').where('user_id', '==', current_user['id'])
-    
-    # Order by timestamp (descending) first - this is important for Firestore composite indexes
-    query = query.order_by('timestamp', direction=firestore.Query.DESCENDING)
-    
-    # Apply action_type filter if provided
-    action_type = request.args.get('action_type')
-    if action_type:
-        query = query.where('action_type', '==', action_type)
-    
     # Apply date filters if provided
-    # Note: We need to be careful with the order of operations for Firestore queries
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    start_datetime = None
+    end_datetime = None
     
     if start_date:
         try:
             start_datetime = datetime.datetime.fromisoformat(start_date)
-            # For descending order, the "start" date becomes the "<=" condition
-            query = query.where('timestamp', '>=', start_datetime)
         except ValueError:
             return jsonify({'message': 'Invalid start_date format'}), 400
     
     if end_date:
         try:
             end_datetime = datetime.datetime.fromisoformat(end_date)
-            # For descending order, the "end" date becomes the ">=" condition
-            query = query.where('timestamp', '<=', end_datetime)
         except ValueError:
             return jsonify({'message': 'Invalid end_date format'}), 400
     
     # Apply limit
     try:
         limit = int(request.args.get('limit', 100))
-        query = query.limit(limit)
     except ValueError:
         return jsonify({'message': 'Invalid limit parameter'}), 400
     
-    # Execute query
-    results = query.get()
+    action_type = request.args.get('action_type')
+    
+    def fetch_shard(collection):
+        # Start with basic query filtered by user_id
+        query = db.collection(collection).where('user_id', '==', current_user['id'])
+        
+        # Order by timestamp (descending) first - this is important for Firestore composite indexes
+        query = query.order_by('timestamp', direction=firestore.Query.DESCENDING)
+        
+        if action_type:
+            query = query.where('action_type', '==', action_type)
+        if start_datetime:
+            query = query.where('timestamp', '>=', start_datetime)
+        if end_datetime:
+            query = query.where('timestamp', '<=', end_datetime)
+        
+        # Every shard may hold the newest entries, so each one is asked for the full limit
+        return query.limit(limit).get()
+    
+    # Execute the query on every shard and merge the newest entries
+    shard_results = fan_in(fetch_shard, audit_log_collections())
+    merged = heapq.merge(*shard_results, key=lambda doc: doc.get('timestamp'), reverse=True)
+    results = [doc for _, doc in zip(range(limit), merged)]
     
     # Format results
     logs = []
@@ -160,6 +242,415 @@ def get_audit_logs(current_user):
         'count': len(logs)
     }), 200
 
+def next_month(day):
+    return (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+def summary_ranges(start, end):
+    """
+    Split an optional [start, end] day range into the whole months it covers and
+    the partial months at either edge.
+
+    Returns (months_from, months_until, edges): the first day of the first whole
+    month and of the month after the last one (None for an open end), plus the
+    (first_day, last_day) edge ranges that have to be read from the daily rollups.
+    """
+    months_from = start if start is None or start.day == 1 else next_month(start)
+    if end is None:
+        months_until = None
+    elif (end + datetime.timedelta(days=1)).day == 1:
+        months_until = next_month(end)
+    else:
+        months_until = end.replace(day=1)
+
+    if months_from and months_until and months_from >= months_until:
+        return None, None, [(start, end)]
+
+    edges = []
+    if start and start < months_from:
+        edges.append((start, months_from - datetime.timedelta(days=1)))
+    if end and months_until <= end:
+        edges.append((months_until, end))
+    return months_from, months_until, edges
+
+@logs_bp.route('/api/logs/summary', methods=['GET'])
+@token_required
+def get_audit_log_summary(current_user):
+    """
+    API to retrieve per month or per day, per action_type audit log counts for a user
+
+    Query parameters:
+    - start_date: Optional first day to include (ISO format)
+    - end_date: Optional last day to include (ISO format)
+    - action_type: Optional action type to restrict the counts to
+    - granularity: 'month' (default) or 'day'
+
+    Months the range covers whole are read from the monthly rollups and only the
+    partial months at either edge from the daily rollups, so a year long summary
+    costs a few dozen reads at most. Per day summaries read one daily rollup per
+    day with activity.
+
+    Note: This API requires composite indexes on (user_id, date) in 'audit_log_rollups'
+    and on (user_id, month) in 'audit_log_monthly_rollups'.
+    """
+    db = get_db()
+
+    try:
+        start = parse_date_arg(request.args.get('start_date'), 'start_date')
+        end = parse_date_arg(request.args.get('end_date'), 'end_date')
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    start = start.date() if start else None
+    end = end.date() if end else None
+
+    granularity = request.args.get('granularity', 'month')
+    if granularity not in ('month', 'day'):
+        return jsonify({'message': 'granularity must be month or day'}), 400
+
+    def daily_rollups(first_day, last_day):
+        query = db.collection('audit_log_rollups').where('user_id', '==', current_user['id'])
+        if first_day:
+            query = query.where('date', '>=', first_day.strftime('%Y-%m-%d'))
+        if last_day:
+            query = query.where('date', '<=', last_day.strftime('%Y-%m-%d'))
+        return [doc.to_dict() for doc in query.order_by('date').stream()]
+
+    if granularity == 'day':
+        rollups = [(rollup['date'], rollup) for rollup in daily_rollups(start, end)]
+    else:
+        months_from, months_until, edges = summary_ranges(start, end)
+        rollups = []
+        if months_from is not None or months_until is not None or not edges:
+            query = db.collection('audit_log_monthly_rollups').where('user_id', '==', current_user['id'])
+            if months_from:
+                query = query.where('month', '>=', months_from.strftime('%Y-%m'))
+            if months_until:
+                query = query.where('month', '<', months_until.strftime('%Y-%m'))
+            rollups.extend((doc.to_dict()['month'], doc.to_dict()) for doc in query.stream())
+        for first_day, last_day in edges:
+            rollups.extend((rollup['date'][:7], rollup) for rollup in daily_rollups(first_day, last_day))
+
+    action_type = request.args.get('action_type')
+
+    periods = {}
+    totals = {}
+    for period, rollup in rollups:
+        counts = rollup.get('counts', {})
+        if action_type:
+            counts = {action_type: counts[action_type]} if action_type in counts else {}
+            if not counts:
+                continue
+        period_counts = periods.setdefault(period, {})
+        for name, count in counts.items():
+            period_counts[name] = period_counts.get(name, 0) + count
+            totals[name] = totals.get(name, 0) + count
+
+    key, list_key = ('date', 'days') if granularity == 'day' else ('month', 'months')
+    return jsonify({
+        list_key: [
+            {key: period, 'total': sum(counts.values()), 'counts': counts}
+            for period, counts in sorted(periods.items())
+        ],
+        'totals': totals,
+        'total': sum(totals.values())
+    }), 200
+
+@logs_bp.cli.command('rebuild-rollups')
+@click.option('--user-id', default=None, help='Only rebuild rollups for this user')
+def rebuild_rollups_command(user_id):
+    """
+    Recompute daily and monthly audit log rollups from the raw audit logs.
+
+    Rollups are overwritten with the recomputed counts and rollups for periods
+    without any logs are deleted. Logs written while the command runs are counted
+    by their increment and then overwritten, so stop audit log writes (or the
+    affected user's sessions) for the duration of the rebuild.
+    """
+    db = get_db()
+
+    def iter_logs():
+        for collection in audit_log_collections():
+            query = db.collection(collection)
+            if user_id:
+                query = query.where('user_id', '==', user_id)
+            yield from query.select(['user_id', 'timestamp', 'action_type']).stream()
+
+    rollups = {'audit_log_rollups': {}, 'audit_log_monthly_rollups': {}}
+    for doc in iter_logs():
+        log_data = doc.to_dict()
+        if not log_data.get('timestamp') or not log_data.get('action_type'):
+            continue
+        day = log_day(log_data['timestamp'])
+        for collection, field, period in (('audit_log_rollups', 'date', day), ('audit_log_monthly_rollups', 'month', day[:7])):
+            rollup = rollups[collection].setdefault(rollup_doc_id(log_data['user_id'], period), {
+                'user_id': log_data['user_id'],
+                field: period,
+                'total': 0,
+                'counts': {}
+            })
+            rollup['total'] += 1
+            rollup['counts'][log_data['action_type']] = rollup['counts'].get(log_data['action_type'], 0) + 1
+
+    batch = db.batch()
+    pending = 0
+    deleted = 0
+    for collection, collection_rollups in rollups.items():
+        writes = [(doc_id, rollup) for doc_id, rollup in collection_rollups.items()]
+        # Rollups left over from logs that no longer exist
+        query = db.collection(collection)
+        if user_id:
+            query = query.where('user_id', '==', user_id)
+        for doc in query.select(['user_id']).stream():
+            if doc.id not in collection_rollups:
+                writes.append((doc.id, None))
+                deleted += 1
+
+        for doc_id, rollup in writes:
+            rollup_ref = db.collection(collection).document(doc_id)
+            if rollup is None:
+                batch.delete(rollup_ref)
+            else:
+                batch.set(rollup_ref, rollup)
+            pending += 1
+            if pending == 500:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+    if pending:
+        batch.commit()
+
+    rebuilt = sum(len(collection_rollups) for collection_rollups in rollups.values())
+    click.echo(f'Rebuilt {rebuilt} audit log rollups, deleted {deleted} stale rollups')
+
+@logs_bp.cli.command('migrate-shards')
+@click.option('--page-size', default=250, help='Logs moved per batch (each log costs two writes)')
+def migrate_shards_command(page_size):
+    """
+    Move audit logs from the legacy 'audit_logs' collection into the shard collections.
+
+    Documents keep their ids, so the migration can be interrupted and re-run safely.
+    Once it completes, set AUDIT_LOG_READ_LEGACY=false to stop reading the legacy collection.
+    """
+    db = get_db()
+    legacy = db.collection(LEGACY_AUDIT_LOG_COLLECTION)
+
+    moved = 0
+    while True:
+        docs = list(legacy.order_by('__name__').limit(page_size).stream())
+        if not docs:
+            break
+
+        batch = db.batch()
+        for doc in docs:
+            batch.set(db.collection(audit_log_shard(doc.id)).document(doc.id), doc.to_dict())
+            batch.delete(doc.reference)
+        batch.commit()
+
+        moved += len(docs)
+        click.echo(f'Moved {moved} audit logs')
+
+    click.echo(f'Migration complete, {moved} audit logs moved into {AUDIT_LOG_SHARDS} shards')
+
+# Number of audit log documents fetched per Firestore page while exporting
+EXPORT_PAGE_SIZE = 500
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+EXPORT_CSV_FIELDS = ['id', 'timestamp', 'action_type', 'user_id', 'user_email',
+                     'location', 'device', 'details', 'cursor']
+
+def encode_export_cursor(timestamp, log_id):
+    """Build an opaque checkpoint token pointing at an exported log entry"""
+    payload = json.dumps({'ts': timestamp.isoformat(), 'id': log_id})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_export_cursor(token):
+    """Return the (timestamp, log_id) pair encoded in a checkpoint token"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return datetime.datetime.fromisoformat(payload['ts']), payload['id']
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f'Invalid cursor: {str(e)}')
+
+def iter_audit_logs(db, user_id, start=None, end=None, cursor=None, page_size=EXPORT_PAGE_SIZE):
+    """
+    Yield (log_id, log_data) for a user's audit logs in ascending timestamp order.
+
+    Logs are read one page at a time per shard using query cursors and the shards
+    are merged lazily, so memory use stays constant regardless of the size of the
+    date range. When a checkpoint token is given, iteration resumes right after
+    the entry it points at.
+    """
+    resume_after = decode_export_cursor(cursor) if cursor else None
+
+    if resume_after:
+        resume_ts = resume_after[0]
+        if not start or resume_ts.replace(tzinfo=None) > start.replace(tzinfo=None):
+            start = resume_ts
+
+    shards = [
+        iter_collection_logs(db, collection, user_id, start, end, resume_after, page_size)
+        for collection in audit_log_collections()
+    ]
+    # Within a shard entries sharing a timestamp are ordered by document id
+    for log_id, log_data in heapq.merge(*shards, key=lambda entry: (entry[1].get('timestamp'), entry[0])):
+        yield log_id, log_data
+
+def iter_collection_logs(db, collection, user_id, start, end, resume_after, page_size):
+    """Page through the audit logs of a single collection in ascending timestamp order"""
+    query = db.collection(collection).where('user_id', '==', user_id)
+
+    if start:
+        query = query.where('timestamp', '>=', start)
+    if end:
+        query = query.where('timestamp', '<=', end)
+
+    query = query.order_by('timestamp').limit(page_size)
+
+    last_doc = None
+    while True:
+        page = query.start_after(last_doc) if last_doc else query
+        docs = list(page.stream())
+
+        for doc in docs:
+            log_data = doc.to_dict()
+            if resume_after and (log_data.get('timestamp'), doc.id) <= resume_after:
+                continue
+            yield doc.id, log_data
+
+        if len(docs) < page_size:
+            return
+        last_doc = docs[-1]
+
+def serialize_audit_log(log_id, log_data):
+    """Convert an audit log document into a JSON-serializable export record"""
+    record = dict(log_data)
+    record['id'] = log_id
+    timestamp = log_data.get('timestamp')
+    if timestamp:
+        record['timestamp'] = timestamp.isoformat()
+        record['cursor'] = encode_export_cursor(timestamp, log_id)
+    return record
+
+def generate_export(records, export_format, include_header=True):
+    """Yield NDJSON lines or CSV rows for an iterable of export records"""
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_FIELDS, extrasaction='ignore')
+        if include_header:
+            writer.writeheader()
+        for record in records:
+            row = dict(record)
+            row['details'] = json.dumps(row.get('details', {}), default=str)
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        if include_header and buffer.getvalue():
+            # Header of an empty export
+            yield buffer.getvalue()
+    else:
+        for record in records:
+            yield json.dumps(record, default=str) + '\n'
+
+def parse_date_arg(value, name):
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Invalid {name} format')
+
+@logs_bp.route('/api/logs/export', methods=['GET'])
+@token_required
+def export_audit_logs(current_user):
+    """
+    API to stream all audit logs for a user within a date range
+
+    Query parameters:
+    - start_date: Optional start date for filtering (ISO format)
+    - end_date: Optional end date for filtering (ISO format)
+    - format: 'ndjson' (default) or 'csv'
+    - cursor: Optional checkpoint token to resume an interrupted export
+
+    Every exported record carries a 'cursor' value. Passing the cursor of the
+    last record received resumes the export right after it.
+
+    Note: This API requires a composite index on (user_id, timestamp ascending).
+    """
+    export_format = request.args.get('format', 'ndjson').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'message': 'Invalid format, expected ndjson or csv'}), 400
+
+    try:
+        start = parse_date_arg(request.args.get('start_date'), 'start_date')
+        end = parse_date_arg(request.args.get('end_date'), 'end_date')
+        cursor = request.args.get('cursor')
+        if cursor:
+            decode_export_cursor(cursor)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    db = get_db()
+    logs = iter_audit_logs(db, current_user['id'], start=start, end=end, cursor=cursor)
+    records = (serialize_audit_log(log_id, log_data) for log_id, log_data in logs)
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(
+        stream_with_context(generate_export(records, export_format)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=audit_logs.{export_format}'}
+    )
+
+@logs_bp.cli.command('export')
+@click.option('--user-id', required=True, help='User whose audit logs are exported')
+@click.option('--start-date', default=None, help='Start date (ISO format)')
+@click.option('--end-date', default=None, help='End date (ISO format)')
+@click.option('--format', 'export_format', type=click.Choice(EXPORT_FORMATS), default='ndjson')
+@click.option('--output', required=True, type=click.Path(dir_okay=False), help='File to write the export to')
+@click.option('--checkpoint', default=None, type=click.Path(dir_okay=False),
+              help='File holding the last exported cursor; an existing checkpoint resumes the export')
+def export_audit_logs_command(user_id, start_date, end_date, export_format, output, checkpoint):
+    """Export audit logs for a user to an NDJSON or CSV file"""
+    start = parse_date_arg(start_date, 'start_date')
+    end = parse_date_arg(end_date, 'end_date')
+
+    cursor = None
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            cursor = f.read().strip() or None
+
+    # A resumed export appends to the existing file and skips the CSV header
+    resuming = cursor is not None and os.path.exists(output)
+
+    db = get_db()
+    logs = iter_audit_logs(db, user_id, start=start, end=end, cursor=cursor)
+
+    exported = 0
+    last_record = {}
+
+    def tracked_records():
+        nonlocal exported, last_record
+        for log_id, log_data in logs:
+            last_record = serialize_audit_log(log_id, log_data)
+            exported += 1
+            yield last_record
+
+    with open(output, 'a' if resuming else 'w', newline='') as out:
+        for chunk in generate_export(tracked_records(), export_format, include_header=not resuming):
+            out.write(chunk)
+            if checkpoint and last_record.get('cursor') and exported % EXPORT_PAGE_SIZE == 0:
+                out.flush()
+                save_checkpoint(checkpoint, last_record['cursor'])
+
+    if checkpoint and last_record.get('cursor'):
+        save_checkpoint(checkpoint, last_record['cursor'])
+
+    click.echo(f'Exported {exported} audit logs to {output}')
+
+def save_checkpoint(path, cursor):
+    with open(path, 'w') as f:
+        f.write(cursor)
+
 # To register this blueprint in your main app, add the following code to your app.py:
 # from logs import logs_bp
 # app.register_blueprint(logs_bp)
\ No newline at end of file
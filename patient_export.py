@@ -0,0 +1,146 @@
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import zipfile
+
+from database import get_db
+from doc_cache import documents
+from tracing import propagate
+from patient_routes import token_required, decrypt_data, serialize_patient
+
+# Full-record export of a patient: demographics plus every decrypted session note
+export_bp = Blueprint('patient_export', __name__)
+
+# Session notes fetched per Firestore page
+EXPORT_PAGE_SIZE = 200
+
+EXPORT_FORMATS = ('ndjson', 'zip')
+
+# Decrypts notes and prefetches the next page while the current one is streamed
+export_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='patient-export')
+
+
+def iter_note_pages(db, patient_id):
+    """Yield a patient's session note documents one page at a time"""
+    query = db.collection('session_notes') \
+        .where('patient_id', '==', patient_id) \
+        .limit(EXPORT_PAGE_SIZE)
+
+    last_doc = None
+    while True:
+        page = query.start_after(last_doc) if last_doc else query
+        docs = list(page.stream())
+        if docs:
+            yield docs
+        if len(docs) < EXPORT_PAGE_SIZE:
+            return
+        last_doc = docs[-1]
+
+
+def serialize_note(doc):
+    note_data = doc.to_dict()
+    note_data['note'] = decrypt_data(note_data.get('note'))  # Decrypted
+    return note_data
+
+
+def iter_decrypted_notes(db, patient_id):
+    """
+    Yield decrypted session notes, decrypting each page in parallel while the
+    next page is already being fetched from Firestore.
+    """
+    pages = iter_note_pages(db, patient_id)
+    # The page reads and decryption are traced as part of the export request
+    fetch_page = propagate(lambda: next(pages, None))
+    decrypt_note = propagate(serialize_note)
+    next_page = export_executor.submit(fetch_page)
+    while True:
+        page = next_page.result()
+        if page is None:
+            return
+        next_page = export_executor.submit(fetch_page)
+        yield from export_executor.map(decrypt_note, page)
+
+
+def generate_ndjson(patient, notes):
+    yield json.dumps({'type': 'patient', 'data': patient}, default=str) + '\n'
+    for note in notes:
+        yield json.dumps({'type': 'session_note', 'data': note}, default=str) + '\n'
+
+
+class ZipStream(io.RawIOBase):
+    """Write-only, non-seekable buffer that lets a zip archive be streamed as it is built"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def generate_zip(patient, notes):
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('patient.json', json.dumps(patient, default=str, indent=2))
+        yield stream.drain()
+
+        with archive.open('session_notes.ndjson', 'w', force_zip64=True) as notes_file:
+            for note in notes:
+                notes_file.write((json.dumps(note, default=str) + '\n').encode())
+                data = stream.drain()
+                if data:
+                    yield data
+    yield stream.drain()
+
+
+@export_bp.route('/api/patients/<patient_id>/export', methods=['GET'])
+@token_required
+def export_patient(current_user, patient_id):
+    """
+    Stream a patient's full record in a single response
+
+    Query parameters:
+    - format: 'ndjson' (default) or 'zip'
+
+    NDJSON output starts with a {"type": "patient"} line followed by one
+    {"type": "session_note"} line per note. Zip output contains patient.json
+    and session_notes.ndjson.
+    """
+    export_format = request.args.get('format', 'ndjson').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'message': 'Invalid format, expected ndjson or zip'}), 400
+
+    db = get_db()
+
+    patient_ref = documents.get(db.collection('patients').document(patient_id))
+    if not patient_ref.exists:
+        return jsonify({'message': 'Patient not found'}), 404
+
+    patient_data = patient_ref.to_dict()
+    if patient_data.get('doctor_id') != current_user['id']:
+        return jsonify({'message': 'Unauthorized access to patient record'}), 403
+
+    patient = serialize_patient(patient_id, patient_data)
+    notes = iter_decrypted_notes(db, patient_id)
+
+    if export_format == 'zip':
+        body = generate_zip(patient, notes)
+        mimetype = 'application/zip'
+    else:
+        body = generate_ndjson(patient, notes)
+        mimetype = 'application/x-ndjson'
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=patient_{patient_id}.{export_format}'}
+    )
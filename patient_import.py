@@ -0,0 +1,172 @@
+from flask import Blueprint, request, jsonify
+from firebase_admin import firestore
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import io
+import json
+import os
+import click
+
+from database import get_db
+from tracing import propagate
+from singleflight import reads
+from patient_routes import token_required, encrypt_data, name_blind_index
+
+# Bulk patient import; the CLI command is registered at the top level as 'flask import-patients'
+import_bp = Blueprint('patient_import', __name__, cli_group=None)
+
+# Firestore's batch write limit
+IMPORT_BATCH_SIZE = 500
+
+# Validates and encrypts rows, and commits batches, in parallel
+import_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='patient-import')
+
+
+def parse_import_rows(content, import_format):
+    """Parse a CSV or JSON import file into a list of row dicts"""
+    if import_format == 'csv':
+        return list(csv.DictReader(io.StringIO(content)))
+
+    data = json.loads(content)
+    if isinstance(data, dict):
+        data = data.get('patients')
+    if not isinstance(data, list):
+        raise ValueError('Expected a list of patients')
+    return data
+
+
+def prepare_patient(row, doctor_id):
+    """Validate an import row and build the encrypted patient document"""
+    if not isinstance(row, dict):
+        raise ValueError('Row must be an object')
+
+    name = (row.get('name') or '').strip()
+    age = row.get('age')
+    if isinstance(age, str):
+        age = age.strip()
+        if age.isdigit():
+            age = int(age)
+
+    if not name or not age:
+        raise ValueError('Patient name and age are required')
+
+    new_patient = {
+        'name': encrypt_data(name),  # Encrypted
+        'name_index': name_blind_index(name),
+        'age': age,
+        'doctor_id': doctor_id,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+
+    if row.get('gender'):
+        new_patient['gender'] = row.get('gender')
+
+    if row.get('notes'):
+        new_patient['notes'] = row.get('notes')
+
+    return new_patient
+
+
+def import_patients(db, doctor_id, rows):
+    """
+    Import patient rows for a doctor and return a result for every row.
+
+    Rows are validated and encrypted in a worker pool and the valid ones are
+    committed in parallel Firestore batches of IMPORT_BATCH_SIZE.
+    """
+    def prepare(indexed_row):
+        index, row = indexed_row
+        try:
+            return index, prepare_patient(row, doctor_id), None
+        except Exception as e:
+            return index, None, str(e)
+
+    results = [None] * len(rows)
+    prepared = []
+    for index, patient, error in import_executor.map(propagate(prepare), enumerate(rows)):
+        if error:
+            results[index] = {'row': index, 'status': 'error', 'message': error}
+        else:
+            prepared.append((index, db.collection('patients').document(), patient))
+
+    def commit(chunk):
+        batch = db.batch()
+        for _, patient_ref, patient in chunk:
+            batch.set(patient_ref, patient)
+        try:
+            batch.commit()
+            return chunk, None
+        except Exception as e:
+            return chunk, str(e)
+
+    chunks = [prepared[i:i + IMPORT_BATCH_SIZE] for i in range(0, len(prepared), IMPORT_BATCH_SIZE)]
+    for chunk, error in import_executor.map(propagate(commit), chunks):
+        for index, patient_ref, _ in chunk:
+            if error:
+                results[index] = {'row': index, 'status': 'error', 'message': error}
+            else:
+                results[index] = {'row': index, 'status': 'created', 'patient_id': patient_ref.id}
+
+    return results
+
+
+def summarize(results):
+    imported = sum(1 for result in results if result['status'] == 'created')
+    return {
+        'imported': imported,
+        'failed': len(results) - imported,
+        'results': results
+    }
+
+
+@import_bp.route('/api/patients/import', methods=['POST'])
+@token_required
+def import_patients_route(current_user):
+    """
+    Import many patients at once
+
+    Accepts a JSON list of patients (or {"patients": [...]}), a text/csv body,
+    or a multipart upload named 'file' ending in .csv or .json. CSV files need
+    a header row with name and age columns, and optionally gender and notes.
+    """
+    try:
+        upload = request.files.get('file')
+        if upload:
+            import_format = 'csv' if upload.filename.lower().endswith('.csv') else 'json'
+            rows = parse_import_rows(upload.read().decode('utf-8-sig'), import_format)
+        elif request.mimetype == 'text/csv':
+            rows = parse_import_rows(request.get_data(as_text=True), 'csv')
+        else:
+            rows = parse_import_rows(request.get_data(as_text=True), 'json')
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'message': f'Invalid import file: {str(e)}'}), 400
+
+    if not rows:
+        return jsonify({'message': 'No patients to import'}), 400
+
+    results = import_patients(get_db(), current_user['id'], rows)
+    reads.forget('patients', current_user['id'])
+
+    return jsonify(summarize(results)), 200
+
+
+@import_bp.cli.command('import-patients')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--doctor-id', required=True, help='Doctor the patients are assigned to')
+def import_patients_command(path, doctor_id):
+    """Import patients for a doctor from a CSV or JSON file"""
+    db = get_db()
+    if not db.collection('users').document(doctor_id).get().exists:
+        raise click.ClickException(f'Doctor {doctor_id} not found')
+
+    import_format = 'csv' if os.path.splitext(path)[1].lower() == '.csv' else 'json'
+    with open(path, encoding='utf-8-sig') as f:
+        rows = parse_import_rows(f.read(), import_format)
+
+    summary = summarize(import_patients(db, doctor_id, rows))
+    for result in summary['results']:
+        if result['status'] == 'error':
+            click.echo(f"Row {result['row']}: {result['message']}")
+
+    click.echo(f"Imported {summary['imported']} patients, {summary['failed']} failed")
@@ -2,54 +2,110 @@ from flask import Blueprint, request, jsonify
 from firebase_admin import firestore
 import jwt
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import uuid
-from cryptography.fernet import Fernet
 import base64
 import os
+import hmac
+import hashlib
+import re
+import unicodedata
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
 from dotenv import load_dotenv
+from database import get_db
+from singleflight import reads, request_key
+from deletion_jobs import start_patient_deletion, run_patient_deletion, stale_deletion_jobs, \
+    PATIENT_TOMBSTONE_RETENTION_DAYS, DELETION_JOB_STALE_AFTER
+from autosave import drafts
+from tracing import propagate
+from batch import batch_user
+from doc_cache import documents
+from fieldsets import requested_fields, wants, select, pick
+from encryption import (
+    get_encryption_key, encrypt_data, decrypt_data, encrypt_note,
+    is_plaintext, needs_reencryption, reencrypt_fields, schedule_reencryption
+)
 load_dotenv()
 
 patient_bp = Blueprint('patient', __name__)
 
 
 
-# Key management (store this securely, not in your code!)
-def get_encryption_key():
-    # In production, retrieve from secure key management service
-    # For development, you could use environment variable
-    key = os.environ.get('ENCRYPTION_KEY')
-  
-    return key
-
-# Encryption/decryption utilities
-def encrypt_data(data):
-    if not data:
-        return None
-    key = get_encryption_key()
-    f = Fernet(key.encode() if isinstance(key, str) else key)
-    return f.encrypt(data.encode()).decode()
-
-def decrypt_data(encrypted_data):
-    if not encrypted_data:
-        return None
-    key = get_encryption_key()
-    f = Fernet(key.encode() if isinstance(key, str) else key)
-    try:
-        return f.decrypt(encrypted_data.encode()).decode()
-    except Exception as e:
-        print(f"Decryption failed: {str(e)}")
-        # If decryption fails, return the original data
-        # This assumes the data might not be encrypted
-        return encrypted_data
-
-def get_db():
-    return firestore.client()
-
+# Fields holding PHI encrypted with encrypt_data
+ENCRYPTED_PATIENT_FIELDS = ('name',)
+ENCRYPTED_NOTE_FIELDS = ('note',)
+
+# Fields that can be requested with ?fields= (see fieldsets.py)
+PATIENT_FIELDS = ('id', 'name', 'age', 'gender', 'notes', 'doctor_id', 'created_at', 'updated_at')
+SESSION_NOTE_FIELDS = ('id', 'patient_id', 'doctor_id', 'note', 'version', 'created_at', 'updated_at', 'patient_name')
+SESSION_NOTE_LIST_FIELDS = ('session_id', 'created_at')
+# Stored fields the session note list is built from
+SESSION_NOTE_LIST_SELECT = ['id', 'created_at']
+
+# Delta sync of the patient list (?updated_since=). The returned watermark lies
+# this far before the sync started, so writes committing while it runs and clock
+# skew between instances can't slip through; clients upsert by id, so patients
+# sent twice are harmless.
+PATIENT_SYNC_OVERLAP = timedelta(seconds=int(os.environ.get('PATIENT_SYNC_OVERLAP', 60)))
+
+# Blind index: keyed HMAC tokens of normalized names and name prefixes, stored
+# next to the ciphertext so patients can be found by name with an indexed query
+BLIND_INDEX_MIN_PREFIX = 2
+BLIND_INDEX_MAX_PREFIX = 16
+
+def get_blind_index_key():
+    # A dedicated key should be configured; otherwise derive one from the encryption key
+    key = os.environ.get('BLIND_INDEX_KEY')
+    if key:
+        return key.encode()
+    return hmac.new(get_encryption_key().encode(), b'patient-name-blind-index', hashlib.sha256).digest()
+
+def normalize_name(name):
+    """Lowercase, strip accents and punctuation, and collapse whitespace"""
+    decomposed = unicodedata.normalize('NFKD', name or '')
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^\w]+', ' ', stripped.casefold()).split())
+
+def blind_index_token(term):
+    return hmac.new(get_blind_index_key(), term.encode(), hashlib.sha256).hexdigest()[:32]
+
+def name_blind_index(name):
+    """Return the blind index tokens for every searchable prefix of a name"""
+    normalized = normalize_name(name)
+    terms = set()
+    for value in normalized.split() + [normalized]:
+        for length in range(BLIND_INDEX_MIN_PREFIX, min(len(value), BLIND_INDEX_MAX_PREFIX) + 1):
+            terms.add(value[:length])
+    return sorted(blind_index_token(term) for term in terms)
+
+def name_matches(name, query):
+    """Check a decrypted name against a normalized search query"""
+    normalized = normalize_name(name)
+    return normalized.startswith(query) or any(word.startswith(query) for word in normalized.split())
+
+def serialize_patient(patient_id, patient_data, fields=None):
+    """Decrypt and format a patient document for a JSON response, limited to fields when given"""
+    patient_data['id'] = patient_id
+    if wants(fields, 'name'):
+        patient_data['name'] = decrypt_data(patient_data.get('name'))  # Decrypted
+    patient_data.pop('name_index', None)
+    if patient_data.get('created_at'):
+        patient_data['created_at'] = patient_data['created_at'].strftime('%Y-%m-%d %H:%M:%S')
+    if patient_data.get('updated_at'):
+        patient_data['updated_at'] = patient_data['updated_at'].strftime('%Y-%m-%d %H:%M:%S')
+    return pick(patient_data, fields)
 
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
+        # Sub-requests of /api/batch were authenticated once by the batch request
+        current_user = batch_user()
+        if current_user is not None:
+            return f(current_user, *args, **kwargs)
+
         from app import app 
         
         token = None
@@ -95,6 +151,7 @@ def add_patient(current_user):
     
     new_patient = {
     'name': encrypt_data(data.get('name')),  # Encrypted
+    'name_index': name_blind_index(data.get('name')),  # Blind index for search
     'age': data.get('age'),  # Non-PHI numeric data can stay unencrypted
     'doctor_id': current_user['id'],
     'created_at': firestore.SERVER_TIMESTAMP,
@@ -109,6 +166,8 @@ def add_patient(current_user):
         new_patient['notes'] = data.get('notes')
    
     patient_ref = db.collection('patients').add(new_patient)
+    reads.forget('patients', current_user['id'])
+    forget_stats(current_user['id'])
     
   
     return jsonify({
@@ -117,25 +176,99 @@ def add_patient(current_user):
     }), 201
 
 
+def load_patients(db, doctor_id, fields=None):
+    """All patients of a doctor, decrypted and serialized, optionally only some fields"""
+    query = db.collection('patients').where('doctor_id', '==', doctor_id)
+    # The id is the document name, not a stored field
+    patients_ref = select(query, fields, PATIENT_FIELDS[1:]).get()
+    
+    patients = []
+    for doc in patients_ref:
+        schedule_reencryption(doc, ENCRYPTED_PATIENT_FIELDS)
+        patients.append(serialize_patient(doc.id, doc.to_dict(), fields))
+    return patients
+
+
+def parse_watermark(value):
+    """Parse an ISO 8601 timestamp; naive timestamps are taken as UTC"""
+    watermark = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    if watermark.tzinfo is None:
+        watermark = watermark.replace(tzinfo=timezone.utc)
+    return watermark
+
+
+def load_patient_changes(db, doctor_id, since, fields=None):
+    """
+    Patients of a doctor created or updated after since, the ids of those
+    deleted after it, and the watermark for the next sync. When since is older
+    than the tombstone retention, all patients are returned and full is set.
+
+    Note: This requires composite indexes on patients (doctor_id, updated_at)
+    and patient_tombstones (doctor_id, deleted_at).
+    """
+    started = datetime.now(timezone.utc)
+    watermark = (started - PATIENT_SYNC_OVERLAP).isoformat()
+
+    # Deletions this old may no longer have a tombstone
+    if since < started - timedelta(days=PATIENT_TOMBSTONE_RETENTION_DAYS):
+        return {'patients': load_patients(db, doctor_id, fields), 'deleted': [], 'full': True, 'watermark': watermark}
+
+    query = db.collection('patients').where('doctor_id', '==', doctor_id).where('updated_at', '>', since)
+    tombstones = db.collection('patient_tombstones') \
+        .where('doctor_id', '==', doctor_id) \
+        .where('deleted_at', '>', since) \
+        .select(['patient_id'])
+
+    patients = []
+    for doc in select(query, fields, PATIENT_FIELDS[1:]).get():
+        schedule_reencryption(doc, ENCRYPTED_PATIENT_FIELDS)
+        patients.append(serialize_patient(doc.id, doc.to_dict(), fields))
+
+    return {
+        'patients': patients,
+        'deleted': [doc.id for doc in tombstones.get()],
+        'full': False,
+        'watermark': watermark
+    }
+
+
 @patient_bp.route('/api/patients', methods=['GET'])
 @token_required
 def get_patients(current_user):
+    """
+    Get the current doctor's patients
+
+    Query parameters:
+    - fields: Comma separated fields to return
+    - updated_since: Watermark of the last sync (ISO 8601). Only patients changed
+      after it are returned, with the ids of deleted patients in 'deleted' and the
+      watermark for the next sync. When 'full' is set the client must replace its
+      copy with the returned patients.
+    """
     db = get_db()
-
-    patients_ref = db.collection('patients').where('doctor_id', '==', current_user['id']).get()
     
-    patients = []
-    for doc in patients_ref:
-        patient_data = doc.to_dict()
-        patient_data['id'] = doc.id
+    try:
+        fields = requested_fields(PATIENT_FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    
+    if request.args.get('updated_since') is not None:
+        try:
+            since = parse_watermark(request.args['updated_since'])
+        except ValueError:
+            return jsonify({'message': 'updated_since must be an ISO 8601 timestamp'}), 400
         
-        patient_data['name'] = decrypt_data(patient_data.get('name'))  # Decrypted
-        if patient_data.get('created_at'):
-            patient_data['created_at'] = patient_data['created_at'].strftime('%Y-%m-%d %H:%M:%S')
-        if patient_data.get('updated_at'):
-            patient_data['updated_at'] = patient_data['updated_at'].strftime('%Y-%m-%d %H:%M:%S')
-            
-        patients.append(patient_data)
+        changes = reads.do(
+            request_key('patients', current_user['id'], request.args),
+            lambda: load_patient_changes(db, current_user['id'], since, fields)
+        )
+        return jsonify({**changes, 'count': len(changes['patients'])}), 200
+    
+    # Identical requests arriving together (e.g. several open tabs) share one query
+    patients = reads.do(
+        request_key('patients', current_user['id'], request.args),
+        lambda: load_patients(db, current_user['id'], fields)
+    )
     
     return jsonify({
         'patients': patients,
@@ -143,12 +276,135 @@ def get_patients(current_user):
     }), 200
 
 
+@patient_bp.route('/api/patients/search', methods=['GET'])
+@token_required
+def search_patients(current_user):
+    """
+    Search the current doctor's patients by name or name prefix
+
+    Query parameters:
+    - q: Name, word or prefix to search for (at least 2 characters)
+
+    Names are encrypted, so the query is matched through the blind index.
+
+    Note: This API requires a composite index on (doctor_id, name_index array-contains).
+    """
+    query = normalize_name(request.args.get('q', ''))
+    if len(query) < BLIND_INDEX_MIN_PREFIX:
+        return jsonify({'message': f'Search query must be at least {BLIND_INDEX_MIN_PREFIX} characters'}), 400
+
+    db = get_db()
+
+    # Only prefixes up to the maximum length are indexed, longer queries are
+    # narrowed down after decryption
+    token = blind_index_token(query[:BLIND_INDEX_MAX_PREFIX])
+    patients_ref = db.collection('patients') \
+        .where('doctor_id', '==', current_user['id']) \
+        .where('name_index', 'array_contains', token).get()
+
+    patients = []
+    for doc in patients_ref:
+        patient_data = serialize_patient(doc.id, doc.to_dict())
+        if name_matches(patient_data.get('name'), query):
+            patients.append(patient_data)
+
+    return jsonify({
+        'patients': patients,
+        'count': len(patients)
+    }), 200
+
+
+# Dashboard statistics are computed with server-side aggregation queries and
+# cached per doctor for a short time. Writes drop the cache of the worker that
+# made them; other workers catch up within the TTL.
+STATS_CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL', 60))
+GENDER_VALUES = ('male', 'female', 'other')
+AGE_BUCKETS = (('0-17', 0, 18), ('18-39', 18, 40), ('40-64', 40, 65), ('65+', 65, None))
+
+stats_cache = {}
+stats_cache_lock = threading.Lock()
+stats_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='patient-stats')
+
+def forget_stats(doctor_id):
+    """Drop a doctor's cached statistics after a write that changes them"""
+    with stats_cache_lock:
+        stats_cache.pop(doctor_id, None)
+
+def run_aggregation(aggregation_query):
+    """Execute an aggregation query and return its results keyed by alias"""
+    results = aggregation_query.get()
+    return {result.alias: result.value for result in results[0]}
+
+def compute_patient_stats(db, doctor_id):
+    patients = db.collection('patients').where('doctor_id', '==', doctor_id)
+
+    queries = {'patients': patients.count(alias='count').avg('age', alias='avg_age')}
+    queries['session_notes'] = db.collection('session_notes') \
+        .where('doctor_id', '==', doctor_id).count(alias='count')
+    for gender in GENDER_VALUES:
+        queries[f'gender:{gender}'] = patients.where('gender', '==', gender).count(alias='count')
+    for label, low, high in AGE_BUCKETS:
+        bucket = patients.where('age', '>=', low)
+        if high is not None:
+            bucket = bucket.where('age', '<', high)
+        queries[f'age:{label}'] = bucket.count(alias='count')
+
+    # Every aggregation is a separate RPC, so they are run concurrently
+    names = list(queries)
+    results = dict(zip(names, stats_executor.map(propagate(lambda name: run_aggregation(queries[name])), names)))
+
+    patient_count = results['patients']['count']
+    note_count = results['session_notes']['count']
+    genders = {gender: results[f'gender:{gender}']['count'] for gender in GENDER_VALUES}
+    genders['unspecified'] = max(patient_count - sum(genders.values()), 0)
+
+    return {
+        'patient_count': patient_count,
+        'session_note_count': note_count,
+        'notes_per_patient': round(note_count / patient_count, 2) if patient_count else 0,
+        'average_age': results['patients'].get('avg_age'),
+        'gender_distribution': genders,
+        'age_distribution': {label: results[f'age:{label}']['count'] for label, _, _ in AGE_BUCKETS}
+    }
+
+
+@patient_bp.route('/api/patients/stats', methods=['GET'])
+@token_required
+def get_patient_stats(current_user):
+    """
+    Get dashboard statistics for the current doctor's patients
+
+    Counts, averages and distributions are computed by Firestore aggregation
+    queries, so no patient documents are transferred. Only numeric ages are
+    included in the age statistics.
+    """
+    doctor_id = current_user['id']
+    now = time.monotonic()
+
+    with stats_cache_lock:
+        cached = stats_cache.get(doctor_id)
+    if cached and now - cached[0] < STATS_CACHE_TTL:
+        return jsonify(cached[1]), 200
+
+    stats = compute_patient_stats(get_db(), doctor_id)
+
+    with stats_cache_lock:
+        stats_cache[doctor_id] = (now, stats)
+
+    return jsonify(stats), 200
+
+
 @patient_bp.route('/api/patients/<patient_id>', methods=['GET'])
 @token_required
 def get_patient(current_user, patient_id):
     db = get_db()
+    
+    try:
+        fields = requested_fields(PATIENT_FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
    
-    patient_ref = db.collection('patients').document(patient_id).get()
+    patient_ref = documents.get(db.collection('patients').document(patient_id))
     
    
     if not patient_ref.exists:
@@ -156,21 +412,14 @@ def get_patient(current_user, patient_id):
     
 
     patient_data = patient_ref.to_dict()
-    patient_data['name'] = decrypt_data(patient_data.get('name'))  # Decrypted
     
 
     if patient_data.get('doctor_id') != current_user['id']:
         return jsonify({'message': 'Unauthorized access to patient record'}), 403
     
-   
-    patient_data['id'] = patient_id
+    schedule_reencryption(patient_ref, ENCRYPTED_PATIENT_FIELDS)
     
-    if patient_data.get('created_at'):
-        patient_data['created_at'] = patient_data['created_at'].strftime('%Y-%m-%d %H:%M:%S')
-    if patient_data.get('updated_at'):
-        patient_data['updated_at'] = patient_data['updated_at'].strftime('%Y-%m-%d %H:%M:%S')
-    
-    return jsonify(patient_data), 200
+    return jsonify(serialize_patient(patient_id, patient_data, fields)), 200
 
 
 @patient_bp.route('/api/patients/<patient_id>', methods=['PUT'])
@@ -184,7 +433,7 @@ def update_patient(current_user, patient_id):
         
   
     patient_ref = db.collection('patients').document(patient_id)
-    patient = patient_ref.get()
+    patient = documents.get(patient_ref)
     
    
     if not patient.exists:
@@ -200,7 +449,8 @@ def update_patient(current_user, patient_id):
     update_data = {}
     
     if data.get('name'):
-        update_data['name'] = data.get('name')
+        update_data['name'] = encrypt_data(data.get('name'))  # Encrypted
+        update_data['name_index'] = name_blind_index(data.get('name'))
         
     if data.get('age'):
         update_data['age'] = data.get('age')
@@ -215,6 +465,9 @@ def update_patient(current_user, patient_id):
     
    
     patient_ref.update(update_data)
+    documents.invalidate(patient_ref)
+    reads.forget('patients', current_user['id'])
+    forget_stats(current_user['id'])
     
     return jsonify({'message': 'Patient updated successfully'}), 200
 
@@ -225,7 +478,7 @@ def delete_patient(current_user, patient_id):
     db = get_db()
  
     patient_ref = db.collection('patients').document(patient_id)
-    patient = patient_ref.get()
+    patient = documents.get(patient_ref)
 
     if not patient.exists:
         return jsonify({'message': 'Patient not found'}), 404
@@ -235,10 +488,35 @@ def delete_patient(current_user, patient_id):
     if patient_data.get('doctor_id') != current_user['id']:
         return jsonify({'message': 'Unauthorized access to patient record'}), 403
         
-   
-    patient_ref.delete()
+    # The patient and all of their session notes are deleted in the background
+    job_id = start_patient_deletion(db, patient_id, current_user['id'])
     
-    return jsonify({'message': 'Patient deleted successfully'}), 200
+    return jsonify({
+        'message': 'Patient deletion started',
+        'job_id': job_id,
+        'status_url': f'/api/patients/deletion-jobs/{job_id}'
+    }), 202
+
+
+@patient_bp.route('/api/patients/deletion-jobs/<job_id>', methods=['GET'])
+@token_required
+def get_deletion_job(current_user, job_id):
+    db = get_db()
+
+    job_ref = db.collection('deletion_jobs').document(job_id).get()
+    if not job_ref.exists:
+        return jsonify({'message': 'Deletion job not found'}), 404
+
+    job_data = job_ref.to_dict()
+    if job_data.get('doctor_id') != current_user['id']:
+        return jsonify({'message': 'Unauthorized access to deletion job'}), 403
+
+    job_data['id'] = job_id
+    for field in ('created_at', 'updated_at', 'completed_at'):
+        if job_data.get(field):
+            job_data[field] = job_data[field].strftime('%Y-%m-%d %H:%M:%S')
+
+    return jsonify(job_data), 200
 
 
 
@@ -251,7 +529,7 @@ def save_session_note(current_user, patient_id):
     if not data or not data.get('note'):
         return jsonify({'message': 'Session note is required'}), 400
     
-    patient_ref = db.collection('patients').document(patient_id).get()
+    patient_ref = documents.get(db.collection('patients').document(patient_id))
     if not patient_ref.exists:
         return jsonify({'message': 'Patient not found'}), 404
         
@@ -263,11 +541,12 @@ def save_session_note(current_user, patient_id):
         'id': str(uuid.uuid4()),  
         'patient_id': patient_id,
         'doctor_id': current_user['id'],
-        'note': encrypt_data(data.get('note')),  # Encrypted
+        'note': encrypt_note(data.get('note')),  # Encrypted, compressed binary
         'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     }
     
     db.collection('session_notes').document(session_note['id']).set(session_note)
+    forget_stats(current_user['id'])
     
     return jsonify({
         'message': 'Session note saved successfully',
@@ -286,7 +565,7 @@ def update_session_note(current_user, session_id):
     
  
     session_ref = db.collection('session_notes').document(session_id)
-    session = session_ref.get()
+    session = documents.get(session_ref)
     
     if not session.exists:
         return jsonify({'message': 'Session note not found'}), 404
@@ -298,14 +577,61 @@ def update_session_note(current_user, session_id):
         return jsonify({'message': 'Unauthorized access to session note'}), 403
     
   
-    session_ref.update({
-        'note': data.get('note'),
+    # An explicit save replaces any pending autosave draft
+    drafts.supersede(session_id, lambda: session_ref.update({
+        'note': encrypt_note(data.get('note')),  # Encrypted, compressed binary
+        'version': firestore.Increment(1),
         'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    })
+    }))
+    documents.invalidate(session_ref)
     
     return jsonify({'message': 'Session note updated successfully'}), 200
 
 
+@patient_bp.route('/api/session-notes/<session_id>/autosave', methods=['PUT'])
+@token_required
+def autosave_session_note(current_user, session_id):
+    data = request.get_json()
+  
+    if not data or not data.get('note'):
+        return jsonify({'message': 'Session note is required'}), 400
+    
+    # Ownership is checked against Firestore once; later drafts reuse the pending one
+    draft = drafts.get(session_id)
+    stored_version = None
+    if draft is None:
+        db = get_db()
+        session = documents.get(db.collection('session_notes').document(session_id))
+        if not session.exists:
+            return jsonify({'message': 'Session note not found'}), 404
+        session_data = session.to_dict()
+        if session_data.get('doctor_id') != current_user['id']:
+            return jsonify({'message': 'Unauthorized access to session note'}), 403
+        stored_version = session_data.get('version', 0)
+    elif draft.doctor_id != current_user['id']:
+        return jsonify({'message': 'Unauthorized access to session note'}), 403
+    
+    version, saved_version = drafts.accept(get_db(), session_id, current_user['id'], stored_version or 0, encrypt_note(data.get('note')))
+    
+    return jsonify({'message': 'Draft accepted', 'version': version, 'saved_version': saved_version}), 202
+
+
+@patient_bp.route('/api/session-notes/<session_id>/flush', methods=['POST'])
+@token_required
+def flush_session_note(current_user, session_id):
+    draft = drafts.get(session_id)
+    if draft is None:
+        return jsonify({'message': 'No pending draft'}), 200
+    if draft.doctor_id != current_user['id']:
+        return jsonify({'message': 'Unauthorized access to session note'}), 403
+    
+    version = drafts.flush(get_db(), session_id)
+    if version is None:
+        return jsonify({'message': 'Session note not found'}), 404
+    
+    return jsonify({'message': 'Session note saved successfully', 'version': version}), 200
+
+
 @patient_bp.route('/api/session-notes/<session_id>', methods=['DELETE'])
 @token_required
 def delete_session_note(current_user, session_id):
@@ -313,7 +639,7 @@ def delete_session_note(current_user, session_id):
     
  
     session_ref = db.collection('session_notes').document(session_id)
-    session = session_ref.get()
+    session = documents.get(session_ref)
     
     if not session.exists:
         return jsonify({'message': 'Session note not found'}), 404
@@ -325,17 +651,49 @@ def delete_session_note(current_user, session_id):
         return jsonify({'message': 'Unauthorized access to session note'}), 403
     
 
-    session_ref.delete()
+    drafts.supersede(session_id, session_ref.delete)
+    documents.invalidate(session_ref)
+    forget_stats(current_user['id'])
     
     return jsonify({'message': 'Session note deleted successfully'}), 200
 
 
+def list_session_notes(note_docs):
+    """Session note list entries of note documents, most recent first"""
+    session_notes = []
+    for doc in note_docs:
+        note_data = doc.to_dict()
+        
+        session_notes.append({
+            'session_id': note_data.get('id'),
+            'created_at': note_data.get('created_at')
+        })
+ 
+    session_notes.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+    return session_notes
+
+
+def overlay_draft(session_id, session_data, fields=None):
+    """Show the latest autosaved draft not yet written to Firestore in a session note"""
+    draft = drafts.get(session_id)
+    if draft and draft.dirty:
+        if wants(fields, 'note'):
+            session_data['note'] = decrypt_data(draft.note)
+        session_data['version'] = draft.version
+        session_data['unsaved'] = True
+
+
 @patient_bp.route('/api/patients/<patient_id>/session-notes', methods=['GET'])
 @token_required
 def get_patient_session_notes(current_user, patient_id):
     db = get_db()
+    
+    try:
+        fields = requested_fields(SESSION_NOTE_LIST_FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
   
-    patient_ref = db.collection('patients').document(patient_id).get()
+    patient_ref = documents.get(db.collection('patients').document(patient_id))
     if not patient_ref.exists:
         return jsonify({'message': 'Patient not found'}), 404
         
@@ -343,18 +701,11 @@ def get_patient_session_notes(current_user, patient_id):
     if patient_data.get('doctor_id') != current_user['id']:
         return jsonify({'message': 'Unauthorized access to patient record'}), 403
     
-    session_notes_ref = db.collection('session_notes').where('patient_id', '==', patient_id).get()
+    # Only the listed fields are read, never the encrypted note bodies
+    session_notes_ref = db.collection('session_notes').where('patient_id', '==', patient_id) \
+        .select(SESSION_NOTE_LIST_SELECT).get()
     
-    session_notes = []
-    for doc in session_notes_ref:
-        note_data = doc.to_dict()
-        
-        session_notes.append({
-            'session_id': note_data.get('id'),
-            'created_at': note_data.get('created_at')
-        })
- 
-    session_notes.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+    session_notes = [pick(note, fields, always=('session_id',)) for note in list_session_notes(session_notes_ref)]
     
     return jsonify({
         'session_notes': session_notes,
@@ -367,28 +718,134 @@ def get_patient_session_notes(current_user, patient_id):
 def get_session_note(current_user, session_id):
     db = get_db()
     
+    try:
+        fields = requested_fields(SESSION_NOTE_FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    
     # Fetch the session note
-    session_ref = db.collection('session_notes').document(session_id).get()
+    session_ref = documents.get(db.collection('session_notes').document(session_id))
     
     if not session_ref.exists:
         return jsonify({'message': 'Session note not found'}), 404
         
     session_data = session_ref.to_dict()
-    session_data['note'] = decrypt_data(session_data.get('note'))  # Decrypted
     # Check if the session belongs to the current doctor
     if session_data.get('doctor_id') != current_user['id']:
         return jsonify({'message': 'Unauthorized access to session note'}), 403
     
-    # Fetch the patient data
-    patient_id = session_data.get('patient_id')
-    patient_ref = db.collection('patients').document(patient_id).get()
+    if wants(fields, 'note'):
+        session_data['note'] = decrypt_data(session_data.get('note'))  # Decrypted
+    else:
+        session_data.pop('note', None)
     
-    if not patient_ref.exists:
-        return jsonify({'message': 'Patient not found'}), 404
+    schedule_reencryption(session_ref, ENCRYPTED_NOTE_FIELDS, binary=True)
+    overlay_draft(session_id, session_data, fields)
     
-    patient_data = patient_ref.to_dict()
-    
-    # Add patient name to the session data
-    session_data['patient_name'] =  decrypt_data(patient_data.get('name'))
+    if wants(fields, 'patient_name'):
+        # Fetch the patient data
+        patient_id = session_data.get('patient_id')
+        patient_ref = documents.get(db.collection('patients').document(patient_id))
+        
+        if not patient_ref.exists:
+            return jsonify({'message': 'Patient not found'}), 404
+        
+        patient_data = patient_ref.to_dict()
+        
+        # Add patient name to the session data
+        session_data['patient_name'] =  decrypt_data(patient_data.get('name'))
     
-    return jsonify(session_data), 200
\ No newline at end of file
+    return jsonify(pick(session_data, fields, always=('id', 'unsaved'))), 200
+
+
+@patient_bp.cli.command('reindex-names')
+def reindex_names_command():
+    """Rebuild the name blind index of every patient"""
+    db = get_db()
+
+    batch = db.batch()
+    pending = []
+    reindexed = 0
+    for doc in db.collection('patients').select(['name']).stream():
+        name = decrypt_data(doc.to_dict().get('name'))
+        if not name:
+            continue
+        batch.update(doc.reference, {'name_index': name_blind_index(name)})
+        pending.append(doc.reference)
+        reindexed += 1
+        if len(pending) == 500:
+            batch.commit()
+            documents.invalidate(*pending)
+            batch = db.batch()
+            pending = []
+    if pending:
+        batch.commit()
+        documents.invalidate(*pending)
+
+    click.echo(f'Reindexed {reindexed} patient names')
+
+
+@patient_bp.cli.command('resume-deletions')
+@click.option('--stale-minutes', type=click.IntRange(min=0), default=None,
+              help='Minutes without progress before a pending or running job is re-run (default DELETION_JOB_STALE_MINUTES)')
+def resume_deletions_command(stale_minutes):
+    """Re-run patient deletion jobs that failed or stopped making progress"""
+    db = get_db()
+    stale_after = DELETION_JOB_STALE_AFTER if stale_minutes is None else timedelta(minutes=stale_minutes)
+
+    resumed = 0
+    for job_id in list(stale_deletion_jobs(db, stale_after)):
+        click.echo(f"Resuming deletion job {job_id}")
+        run_patient_deletion(db, job_id)
+        resumed += 1
+
+    click.echo(f'Resumed {resumed} deletion jobs')
+
+
+# Documents read per page by the re-encryption sweep
+REENCRYPT_PAGE_SIZE = 200
+
+def paged(query, page_size):
+    """Yield the documents of a query one short read at a time, resuming after the last document seen"""
+    query = query.limit(page_size)
+    last_doc = None
+    while True:
+        page = list((query.start_after(last_doc) if last_doc else query).stream())
+        yield from page
+        if len(page) < page_size:
+            return
+        last_doc = page[-1]
+
+
+@patient_bp.cli.command('reencrypt')
+@click.option('--rate', default=50, type=click.IntRange(min=1), help='Maximum documents rewritten per second')
+def reencrypt_command(rate):
+    """Rewrap all encrypted patient and session note fields with the active master key, encrypting plaintext ones"""
+    db = get_db()
+
+    rewritten = 0
+    encrypted = 0
+    sweeps = (
+        ('patients', ENCRYPTED_PATIENT_FIELDS, False),
+        ('session_notes', ENCRYPTED_NOTE_FIELDS, True)  # Also converts notes to the binary format
+    )
+    for collection, fields, binary in sweeps:
+        # Paged, so the throttled sweep never holds one stream open for its whole run
+        for doc in paged(db.collection(collection).select(list(fields)), REENCRYPT_PAGE_SIZE):
+            data = doc.to_dict()
+            if not any(needs_reencryption(data.get(field), binary=binary) for field in fields):
+                continue
+            option = firestore.Client.write_option(last_update_time=doc.update_time)
+            try:
+                doc.reference.update(reencrypt_fields(data, fields, binary=binary), option=option)
+                documents.invalidate(doc.reference)
+            except Exception as e:
+                click.echo(f'Skipped {doc.reference.path}: {str(e)}')
+                continue
+            rewritten += 1
+            if any(is_plaintext(data.get(field)) for field in fields):
+                encrypted += 1
+            # Throttle the sweep so it doesn't compete with live traffic
+            time.sleep(1 / rate)
+
+    click.echo(f'Re-encrypted {rewritten} documents, {encrypted} of them with plaintext fields')
@@ -0,0 +1,181 @@
+from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+
+# Rotating refresh tokens. verify_login hands out a long-lived refresh token
+# next to the JWT, bound to the device it was issued to; POST /api/refresh-token
+# trades it for a new JWT and a new refresh token, so an expired session is
+# renewed without the password check and emailed code of a full login.
+#
+# Tokens are stored in 'refresh_tokens' under the SHA-256 of the token, never
+# the token itself. Every token descends from one login, its family, and is
+# only issued for a device id. A rotated token presented again means it was
+# copied, so the whole family is revoked; the same happens when a token is
+# presented from another device. Documents carry an expire_at field for a
+# Firestore TTL policy.
+
+REFRESH_TOKEN_TTL = datetime.timedelta(days=int(os.environ.get('REFRESH_TOKEN_TTL_DAYS', 30)))
+
+# A token rotated this recently is answered with a conflict instead of revoking
+# its family, for a client sending the same refresh twice (e.g. two tabs). Only
+# one such retry is allowed per token; the next reuse revokes the family.
+REFRESH_TOKEN_REUSE_GRACE = datetime.timedelta(seconds=int(os.environ.get('REFRESH_TOKEN_REUSE_GRACE', 10)))
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshTokenError(Exception):
+    """A refresh token was rejected; code is the HTTP status to answer with"""
+
+    def __init__(self, message, code=401):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def hash_device(device_id):
+    return hashlib.sha256(f'device:{device_id}'.encode()).hexdigest()
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def as_utc(timestamp):
+    # Firestore returns aware datetimes; tolerate naive ones as UTC
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=datetime.timezone.utc)
+
+
+def new_token_document(user_id, family_id, device_hash):
+    issued = now()
+    return {
+        'user_id': user_id,
+        'family_id': family_id,
+        'device': device_hash,
+        'created_at': issued,
+        'expires_at': issued + REFRESH_TOKEN_TTL,
+        'expire_at': issued + REFRESH_TOKEN_TTL,
+        'rotated_at': None,
+        'reuse_count': 0,
+        'revoked': False
+    }
+
+
+def issue_refresh_token(db, user_id, device_id):
+    """Start a new token family for a login on a device; returns the token"""
+    if not device_id:
+        raise ValueError('Refresh tokens are only issued for a device id')
+    token = secrets.token_urlsafe(32)
+    db.collection('refresh_tokens').document(hash_token(token)).set(
+        new_token_document(user_id, secrets.token_hex(16), hash_device(device_id))
+    )
+    return token
+
+
+def rotate_refresh_token(db, token, device_id):
+    """
+    Exchange a refresh token for a new one of the same family. Returns the
+    user id and the new token; raises RefreshTokenError if it isn't valid.
+    """
+    if not device_id:
+        raise RefreshTokenError('Missing device ID', 400)
+
+    token_ref = db.collection('refresh_tokens').document(hash_token(token))
+    snapshot = token_ref.get()
+    if not snapshot.exists:
+        raise RefreshTokenError('Invalid refresh token')
+
+    data = snapshot.to_dict()
+    if data.get('revoked'):
+        raise RefreshTokenError('Refresh token has been revoked')
+
+    if not hmac.compare_digest(data.get('device', ''), hash_device(device_id)):
+        logger.warning("Refresh token of user %s presented from another device; revoking its family", data.get('user_id'))
+        revoke_family(db, data['family_id'])
+        raise RefreshTokenError('Refresh token has been revoked')
+
+    if data.get('rotated_at') is not None:
+        if now() - as_utc(data['rotated_at']) <= REFRESH_TOKEN_REUSE_GRACE and not data.get('reuse_count'):
+            if record_reuse(token_ref, snapshot):
+                raise RefreshTokenError('Refresh token was already used', 409)
+        logger.warning("Rotated refresh token of user %s reused; revoking its family", data.get('user_id'))
+        revoke_family(db, data['family_id'])
+        raise RefreshTokenError('Refresh token has been revoked')
+
+    if now() > as_utc(data['expires_at']):
+        raise RefreshTokenError('Refresh token has expired')
+
+    successor = secrets.token_urlsafe(32)
+    batch = db.batch()
+    # Fails if the token changed since it was read, i.e. a concurrent rotation won
+    batch.update(token_ref, {'rotated_at': now()}, option=firestore.Client.write_option(last_update_time=snapshot.update_time))
+    batch.set(
+        db.collection('refresh_tokens').document(hash_token(successor)),
+        new_token_document(data['user_id'], data['family_id'], data['device'])
+    )
+    try:
+        batch.commit()
+    except FailedPrecondition:
+        raise RefreshTokenError('Refresh token was already used', 409)
+
+    return data['user_id'], successor
+
+
+def record_reuse(token_ref, snapshot):
+    """Count a retry of a rotated token; False if another one was recorded first"""
+    try:
+        token_ref.update(
+            {'reuse_count': firestore.Increment(1), 'reused_at': now()},
+            option=firestore.Client.write_option(last_update_time=snapshot.update_time)
+        )
+    except FailedPrecondition:
+        return False
+    return True
+
+
+def revoke_tokens(db, query):
+    """Mark every token matched by query as revoked; returns how many were"""
+    revoked = 0
+    batch = db.batch()
+    pending = 0
+    for doc in query.select(['revoked']).stream():
+        if doc.get('revoked'):
+            continue
+        batch.update(doc.reference, {'revoked': True})
+        pending += 1
+        revoked += 1
+        # Firestore's batch write limit
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return revoked
+
+
+def revoke_family(db, family_id):
+    return revoke_tokens(db, db.collection('refresh_tokens').where('family_id', '==', family_id))
+
+
+def revoke_refresh_token(db, token):
+    """Revoke the family of a refresh token, e.g. on logout; returns False for unknown tokens"""
+    snapshot = db.collection('refresh_tokens').document(hash_token(token)).get()
+    if not snapshot.exists:
+        return False
+    revoke_family(db, snapshot.get('family_id'))
+    return True
+
+
+def revoke_user_tokens(db, user_id):
+    """Revoke every refresh token of a user, signing out all of their devices"""
+    return revoke_tokens(db, db.collection('refresh_tokens').where('user_id', '==', user_id))
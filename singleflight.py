@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+
+from doc_cache import seal, unseal
+
+# Single-flight request coalescing: concurrent callers asking for the same key
+# share one in-flight call instead of each running their own Firestore query.
+# Results are only shared while the call is running, unless the call asked for
+# them to be retained: then the next caller within the retention period gets
+# the result once (e.g. a list prefetched at login). Retained results are kept
+# encrypted and are dropped by forget() like running calls.
+#
+# Retention is the one exception to sharing only in-flight results. forget()
+# only reaches the worker that made the write, so a result retained by another
+# worker can be up to its retention period stale. Keep retention periods short.
+
+logger = logging.getLogger(__name__)
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        # key -> (expires, sealed result)
+        self.retained = {}
+
+    def do(self, key, fn, retain=0):
+        """
+        Run fn() for key, or wait for and return the result of the call already
+        running for key. With retain, the result is also kept for the next
+        caller arriving within that many seconds.
+        """
+        with self.lock:
+            # A retaining call (a prefetch) always loads afresh and replaces the retained result
+            retained = None if retain else self.retained.pop(key, None)
+            if retained and retained[0] > time.monotonic():
+                return unseal(retained[1])
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            # Followers are released whatever happens while cleaning up
+            try:
+                sealed = self.seal_result(key, call) if retain else None
+                with self.lock:
+                    if self.calls.get(key) is call:
+                        del self.calls[key]
+                        if sealed is not None:
+                            now = time.monotonic()
+                            for expired in [k for k, (expires, _) in self.retained.items() if expires <= now]:
+                                del self.retained[expired]
+                            self.retained[key] = (now + retain, sealed)
+            finally:
+                call.done.set()
+
+        return call.result
+
+    def seal_result(self, key, call):
+        """The encrypted result of a successful call, or None when it can't be retained"""
+        if call.error is not None:
+            return None
+        try:
+            return seal(call.result)
+        except Exception as e:
+            logger.warning("Not retaining result for %s: %s", key[0], e)
+            return None
+
+    def forget(self, *prefix):
+        """
+        Stop new callers from joining running calls whose key starts with prefix.
+        Used after a write, so later reads don't share a result fetched before it.
+        """
+        with self.lock:
+            for key in [key for key in self.calls if key[:len(prefix)] == prefix]:
+                del self.calls[key]
+            for key in [key for key in self.retained if key[:len(prefix)] == prefix]:
+                del self.retained[key]
+
+
+reads = SingleFlight()
+
+
+def request_key(resource, user_id, args):
+    """Build a coalescing key from the resource, the user and the normalized query string"""
+    return (resource, user_id, tuple(sorted((name, tuple(args.getlist(name))) for name in args)))
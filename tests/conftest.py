@@ -0,0 +1,75 @@
+import datetime
+import os
+import sys
+import tempfile
+
+import pytest
+from cryptography.fernet import Fernet
+
+# The app reads its configuration at import time, so the environment is set up
+# and the in-memory Firestore installed before anything imports it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['SECRET_KEY'] = 'test-secret-key'
+os.environ['ENCRYPTION_KEY'] = Fernet.generate_key().decode()
+os.environ['FIRESTORE_WARMUP'] = 'False'
+os.environ['PREFETCH_ON_LOGIN'] = 'False'
+os.environ['TRACE_EXPORTER'] = 'none'
+os.environ['DOC_CACHE_BACKEND'] = 'memory'
+os.environ['MAIL_SERVER'] = 'localhost'
+os.environ['CHAT_SEARCH_INDEX_PATH'] = os.path.join(tempfile.mkdtemp(), 'chat_search.sqlite3')
+
+import database  # noqa: E402
+from loadtest.fake_firestore import FakeFirestore  # noqa: E402
+
+database.set_client(FakeFirestore())
+
+import jwt  # noqa: E402
+import admission  # noqa: E402
+import autosave  # noqa: E402
+import doc_cache  # noqa: E402
+import patient_routes  # noqa: E402
+import singleflight  # noqa: E402
+from app import app as flask_app  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """The in-memory Firestore, emptied along with every cache before each test"""
+    fake = database.get_db()
+    with fake.lock:
+        fake.documents.clear()
+        fake.update_times.clear()
+    doc_cache.documents.backend = doc_cache.MemoryBackend(doc_cache.DOC_CACHE_SIZE)
+    singleflight.reads.calls.clear()
+    singleflight.reads.retained.clear()
+    admission.controller = admission.AdmissionController(admission.ROUTE_LIMITS)
+    with autosave.drafts.lock:
+        autosave.drafts.drafts.clear()
+    with patient_routes.stats_cache_lock:
+        patient_routes.stats_cache.clear()
+    return fake
+
+
+@pytest.fixture
+def app(db):
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def make_user(db, user_id='doctor-1', email='doctor@example.com'):
+    db.collection('users').document(user_id).set({'email': email, 'name': 'Dr. Test', 'role': 'doctor'})
+    return user_id
+
+
+def auth_headers(user_id, secret='test-secret-key'):
+    token = jwt.encode(
+        {'user_id': user_id, 'exp': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)},
+        secret, algorithm='HS256'
+    )
+    return {'Authorization': f'Bearer {token}'}
@@ -0,0 +1,67 @@
+import jwt
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import admission
+
+from conftest import make_user, auth_headers
+
+LOGIN_BURST = 5
+
+
+def login(client, headers=None):
+    return client.post('/api/login', json={}, headers=headers or {})
+
+
+def test_login_is_rate_limited_per_client(client):
+    statuses = [login(client).status_code for _ in range(LOGIN_BURST + 1)]
+    assert statuses[:LOGIN_BURST] == [400] * LOGIN_BURST
+    assert statuses[-1] == 429
+
+
+def test_forwarded_for_header_does_not_pick_the_bucket(client):
+    statuses = [
+        login(client, {'X-Forwarded-For': f'203.0.113.{i}'}).status_code
+        for i in range(LOGIN_BURST + 1)
+    ]
+    assert statuses[-1] == 429
+
+
+def test_unsigned_token_does_not_pick_the_bucket(client):
+    statuses = []
+    for i in range(LOGIN_BURST + 1):
+        forged = jwt.encode({'user_id': f'someone-{i}'}, 'not-the-secret', algorithm='HS256')
+        statuses.append(login(client, {'Authorization': f'Bearer {forged}'}).status_code)
+    assert statuses[-1] == 429
+
+
+def test_signed_token_gets_its_own_bucket(client, db):
+    for _ in range(LOGIN_BURST + 1):
+        login(client)
+    assert login(client).status_code == 429
+    assert login(client, auth_headers(make_user(db))).status_code == 400
+
+
+def test_clients_are_told_apart_by_address(client):
+    for _ in range(LOGIN_BURST + 1):
+        login(client)
+    other = client.application.test_client()
+    other.environ_base['REMOTE_ADDR'] = '198.51.100.7'
+    assert login(other).status_code == 400
+
+
+def test_forwarded_clients_get_their_own_buckets_behind_a_trusted_proxy(client, monkeypatch):
+    app = client.application
+    monkeypatch.setattr(app, 'wsgi_app', ProxyFix(app.wsgi_app, x_for=1))
+    proxied = app.test_client()
+    proxied.environ_base['REMOTE_ADDR'] = '10.0.0.1'
+
+    first = [login(proxied, {'X-Forwarded-For': '203.0.113.1'}).status_code for _ in range(LOGIN_BURST + 1)]
+    second = login(proxied, {'X-Forwarded-For': '203.0.113.2'}).status_code
+
+    assert first[-1] == 429
+    assert second == 400
+
+
+def test_one_proxy_hop_is_trusted_on_vercel():
+    assert admission.default_proxy_hops({'VERCEL': '1'}) == 1
+    assert admission.default_proxy_hops({}) == 0
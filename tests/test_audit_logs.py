@@ -0,0 +1,176 @@
+import datetime
+
+from loadtest import fake_firestore
+
+import logs
+from conftest import make_user, auth_headers
+
+
+def add_log(db, log_id, timestamp, action_type='view', user_id='doctor-1'):
+    """Write a log and its rollup increments the way POST /api/logs does"""
+    log_entry = {'user_id': user_id, 'timestamp': timestamp, 'action_type': action_type}
+    batch = db.batch()
+    batch.set(db.collection(logs.audit_log_shard(log_id)).document(log_id), log_entry)
+    logs.increment_rollup(batch, db, log_entry)
+    batch.commit()
+
+
+def add_daily_logs(db, first_day, last_day):
+    day = first_day
+    while day <= last_day:
+        timestamp = datetime.datetime.combine(day, datetime.time(12), datetime.timezone.utc)
+        add_log(db, f'log-{day}', timestamp, action_type='view' if day.day % 2 else 'edit')
+        day += datetime.timedelta(days=1)
+
+
+def count_reads(monkeypatch):
+    """Count the documents returned by queries from now on"""
+    reads = []
+    stream = fake_firestore.Query.stream
+
+    def counted(self, *args, **kwargs):
+        docs = list(stream(self, *args, **kwargs))
+        reads.extend(docs)
+        return iter(docs)
+    monkeypatch.setattr(fake_firestore.Query, 'stream', counted)
+    return reads
+
+
+def summary(client, **params):
+    return client.get('/api/logs/summary', query_string=params, headers=auth_headers('doctor-1')).get_json()
+
+
+def rollups(db):
+    return {
+        path: data for path, data in db.documents.items()
+        if path.startswith(('audit_log_rollups/', 'audit_log_monthly_rollups/'))
+    }
+
+
+def test_summary_reads_whole_months_from_the_monthly_rollups(client, db, monkeypatch):
+    make_user(db)
+    add_daily_logs(db, datetime.date(2024, 1, 10), datetime.date(2024, 4, 20))
+    days = summary(client, start_date='2024-01-20', end_date='2024-04-05', granularity='day')
+    reads = count_reads(monkeypatch)
+
+    months = summary(client, start_date='2024-01-20', end_date='2024-04-05')
+
+    # Two monthly rollups for February and March plus 12 + 5 edge days
+    assert len(reads) == 19
+    assert [month['month'] for month in months['months']] == ['2024-01', '2024-02', '2024-03', '2024-04']
+    assert [month['total'] for month in months['months']] == [12, 29, 31, 5]
+    assert months['totals'] == days['totals']
+    assert months['total'] == days['total'] == len(days['days']) == 77
+
+
+def test_summary_within_one_month_and_open_ranges(client, db):
+    make_user(db)
+    add_daily_logs(db, datetime.date(2024, 1, 10), datetime.date(2024, 3, 20))
+
+    assert summary(client, start_date='2024-02-03', end_date='2024-02-05')['total'] == 3
+    assert summary(client, start_date='2024-02-01', end_date='2024-02-29')['total'] == 29
+    assert summary(client, start_date='2024-03-15')['total'] == 6
+    assert summary(client, end_date='2024-01-11')['total'] == 2
+    assert summary(client)['total'] == 71
+    assert summary(client, action_type='edit')['total'] == summary(client, granularity='day', action_type='edit')['total']
+
+
+def test_rebuild_restores_live_rollups_and_drops_stale_ones(app, db):
+    make_user(db)
+    add_daily_logs(db, datetime.date(2024, 1, 30), datetime.date(2024, 2, 2))
+    add_log(db, 'log-other', datetime.datetime(2024, 1, 31, tzinfo=datetime.timezone.utc), user_id='doctor-2')
+    live = rollups(db)
+
+    # A lost increment, and rollups of a log that has since been removed
+    db.collection('audit_log_rollups').document('doctor-1_2024-01-30').set({'user_id': 'doctor-1', 'date': '2024-01-30', 'total': 0, 'counts': {}})
+    add_log(db, 'log-removed', datetime.datetime(2024, 3, 1, tzinfo=datetime.timezone.utc))
+    db.collection(logs.audit_log_shard('log-removed')).document('log-removed').delete()
+
+    result = app.test_cli_runner().invoke(args=['logs', 'rebuild-rollups', '--user-id', 'doctor-1'])
+
+    assert result.exit_code == 0, result.output
+    assert 'Rebuilt 6 audit log rollups, deleted 2 stale rollups' in result.output
+    assert rollups(db) == live
+
+
+def test_export_resumes_from_a_cursor_across_shards(db):
+    start = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+    for i in range(40):
+        # Pairs of logs share a timestamp, so ties are broken by document id across shards
+        add_log(db, f'log-{i:02d}', start + datetime.timedelta(minutes=i // 2))
+    db.collection(logs.LEGACY_AUDIT_LOG_COLLECTION).document('legacy-1').set({
+        'user_id': 'doctor-1', 'timestamp': start + datetime.timedelta(minutes=5), 'action_type': 'view'
+    })
+    assert len({logs.audit_log_shard(f'log-{i:02d}') for i in range(40)}) > 1
+    expected = [log_id for log_id, _ in logs.iter_audit_logs(db, 'doctor-1')]
+    assert len(set(expected)) == 41
+
+    for stop in range(1, 41):
+        exported = []
+        for log_id, log_data in logs.iter_audit_logs(db, 'doctor-1', page_size=3):
+            exported.append(log_id)
+            cursor = logs.encode_export_cursor(log_data['timestamp'], log_id)
+            if len(exported) == stop:
+                break
+
+        exported.extend(log_id for log_id, _ in logs.iter_audit_logs(db, 'doctor-1', cursor=cursor, page_size=3))
+
+        assert exported == expected
+
+
+def add_spread_logs(db, count=40):
+    """Logs a minute apart spread over every shard, plus a few in the legacy collection"""
+    start = datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc)
+    for i in range(count):
+        timestamp = start + datetime.timedelta(minutes=i)
+        if i % 10 == 3:
+            db.collection(logs.LEGACY_AUDIT_LOG_COLLECTION).document(f'legacy-{i:02d}').set({
+                'user_id': 'doctor-1', 'timestamp': timestamp, 'action_type': 'view'
+            })
+        else:
+            add_log(db, f'log-{i:02d}', timestamp, action_type='view' if i % 2 else 'edit')
+    add_log(db, 'log-other', start + datetime.timedelta(minutes=count), user_id='doctor-2')
+    return [
+        path.rsplit('/', 1)[1] for path, data in sorted(db.documents.items(), key=lambda item: item[1].get('timestamp', start))
+        if path.startswith('audit_logs') and data['user_id'] == 'doctor-1'
+    ][::-1]
+
+
+def list_logs(client, **params):
+    response = client.get('/api/logs', query_string=params, headers=auth_headers('doctor-1'))
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['logs']
+
+
+def test_logs_are_merged_newest_first_across_shards_and_the_legacy_collection(client, db):
+    make_user(db)
+    expected = add_spread_logs(db)
+    assert len({logs.audit_log_shard(log_id) for log_id in expected if log_id.startswith('log-')}) == logs.AUDIT_LOG_SHARDS
+
+    all_logs = list_logs(client)
+
+    assert [log['id'] for log in all_logs] == expected
+    assert [log['id'] for log in list_logs(client, limit=7)] == expected[:7]
+    assert [log['id'] for log in list_logs(client, action_type='view', limit=5)] == [
+        log['id'] for log in all_logs if log['action_type'] == 'view'
+    ][:5]
+
+
+def test_logs_page_by_end_date(client, db):
+    make_user(db)
+    expected = add_spread_logs(db)
+
+    paged = []
+    params = {'limit': 6}
+    while True:
+        page = list_logs(client, **params)
+        paged.extend(log['id'] for log in page)
+        if len(page) < params['limit']:
+            break
+        # The next page ends just before the oldest entry of this one
+        oldest = datetime.datetime.fromisoformat(page[-1]['timestamp'])
+        params['end_date'] = (oldest - datetime.timedelta(microseconds=1)).isoformat()
+
+    assert paged == expected
+    window = list_logs(client, start_date='2024-06-01T00:10:00+00:00', end_date='2024-06-01T00:19:00+00:00')
+    assert [log['id'] for log in window] == expected[20:30]
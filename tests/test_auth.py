@@ -0,0 +1,12 @@
+from conftest import make_user, auth_headers
+
+
+def test_deleted_user_is_rejected_straight_away(client, db):
+    headers = auth_headers(make_user(db))
+    assert client.get('/api/patients', headers=headers).status_code == 200
+    assert client.get('/api/user', headers=headers).status_code == 200
+
+    db.collection('users').document('doctor-1').delete()
+
+    assert client.get('/api/patients', headers=headers).status_code == 401
+    assert client.get('/api/user', headers=headers).status_code == 401
@@ -0,0 +1,87 @@
+import autosave
+from conftest import make_user, auth_headers
+from encryption import encrypt_note
+
+
+def make_note(db, note_id='note-1', doctor_id='doctor-1'):
+    db.collection('patients').document('patient-1').set({'doctor_id': doctor_id, 'name': 'Jane'})
+    db.collection('session_notes').document(note_id).set({
+        'id': note_id,
+        'patient_id': 'patient-1',
+        'doctor_id': doctor_id,
+        'note': encrypt_note('Original'),
+        'version': 1
+    })
+    return note_id
+
+
+def autosave_note(client, note, note_id='note-1', user_id='doctor-1'):
+    return client.put(f'/api/session-notes/{note_id}/autosave', json={'note': note}, headers=auth_headers(user_id))
+
+
+def count_writes(db, monkeypatch):
+    """Count the documents written to the in-memory Firestore from now on"""
+    writes = []
+    write, update = db.write, db.update
+    monkeypatch.setattr(db, 'write', lambda path, *args, **kwargs: (writes.append(path), write(path, *args, **kwargs))[1])
+    monkeypatch.setattr(db, 'update', lambda path, *args, **kwargs: (writes.append(path), update(path, *args, **kwargs))[1])
+    return writes
+
+
+def test_rapid_autosaves_are_written_once(client, db, monkeypatch):
+    make_user(db)
+    make_note(db)
+    writes = count_writes(db, monkeypatch)
+
+    for i in range(20):
+        response = autosave_note(client, f'Draft {i}')
+        assert response.status_code == 202
+    assert writes == []
+    assert response.get_json() == {'message': 'Draft accepted', 'version': 21, 'saved_version': 1}
+
+    monkeypatch.setattr(autosave, 'AUTOSAVE_DEBOUNCE', 0)
+    autosave.drafts.flush_due()
+    autosave.drafts.flush_due()
+
+    assert writes == ['session_notes/note-1']
+    note = client.get('/api/session-notes/note-1', headers=auth_headers('doctor-1')).get_json()
+    assert note['note'] == 'Draft 19'
+    assert note['version'] == 21
+    assert 'unsaved' not in note
+
+
+def test_pending_draft_is_shown_unsaved(client, db):
+    make_user(db)
+    make_note(db)
+    autosave_note(client, 'Draft one')
+
+    note = client.get('/api/session-notes/note-1', headers=auth_headers('doctor-1')).get_json()
+
+    assert note['note'] == 'Draft one'
+    assert note['version'] == 2
+    assert note['unsaved'] is True
+
+
+def test_overdue_draft_is_written_by_the_autosave_request(client, db, monkeypatch):
+    make_user(db)
+    make_note(db)
+    monkeypatch.setattr(autosave, 'AUTOSAVE_MAX_DELAY', 0)
+    writes = count_writes(db, monkeypatch)
+
+    response = autosave_note(client, 'Draft one')
+
+    assert response.get_json()['saved_version'] == 2
+    assert writes == ['session_notes/note-1']
+
+
+def test_flush_writes_the_pending_draft(client, db, monkeypatch):
+    make_user(db)
+    make_note(db)
+    for i in range(5):
+        autosave_note(client, f'Draft {i}')
+    writes = count_writes(db, monkeypatch)
+
+    response = client.post('/api/session-notes/note-1/flush', headers=auth_headers('doctor-1'))
+
+    assert response.get_json()['version'] == 6
+    assert writes == ['session_notes/note-1']
@@ -0,0 +1,66 @@
+import jwt
+
+from conftest import make_user, auth_headers
+
+
+def run_batch(client, headers, requests):
+    return client.post('/api/batch', headers=headers, json={'requests': requests})
+
+
+def test_responses_come_back_in_order(client, db):
+    headers = auth_headers(make_user(db))
+    response = run_batch(client, headers, [
+        {'path': '/api/patients'},
+        {'path': '/api/patients/missing'},
+        {'path': '/api/chat/sessions'},
+        {'path': '/api/patients', 'method': 'POST', 'body': {}},
+    ])
+    assert response.status_code == 200
+    statuses = [entry['status'] for entry in response.get_json()['responses']]
+    assert statuses == [200, 404, 200, 400]
+
+
+def test_writes_are_seen_by_later_requests(client, db):
+    headers = auth_headers(make_user(db))
+    response = run_batch(client, headers, [
+        {'path': '/api/patients', 'method': 'POST', 'body': {'name': 'Jane Roe', 'age': 40}},
+        {'path': '/api/patients?fields=id,name'},
+    ])
+    created, listed = response.get_json()['responses']
+    assert created['status'] == 201
+    assert listed['body']['patients'] == [{'id': created['body']['patient_id'], 'name': 'Jane Roe'}]
+
+
+def test_token_is_verified_once(client, db, monkeypatch):
+    headers = auth_headers(make_user(db))
+    decodes = []
+    real_decode = jwt.decode
+
+    def counting_decode(*args, **kwargs):
+        # Admission control only decodes for its limited routes, none of these
+        decodes.append(1)
+        return real_decode(*args, **kwargs)
+
+    monkeypatch.setattr(jwt, 'decode', counting_decode)
+    response = run_batch(client, headers, [{'path': '/api/patients'}] * 5)
+    assert [entry['status'] for entry in response.get_json()['responses']] == [200] * 5
+    assert len(decodes) == 1
+
+
+def test_batch_requires_a_token(client, db):
+    assert run_batch(client, {}, [{'path': '/api/patients'}]).status_code == 401
+
+
+def test_batches_cannot_be_nested(client, db):
+    headers = auth_headers(make_user(db))
+    for path in ('/api/batch', '/api/batch/', '/api/%62atch', '/api/b%61tch?x=1'):
+        response = run_batch(client, headers, [{'path': path, 'method': 'POST', 'body': {'requests': []}}])
+        assert response.status_code == 400, path
+        assert 'nested' in response.get_json()['message']
+
+
+def test_sub_requests_cannot_be_forged_through_headers(client, db):
+    # Only the server can set the batch user; a header lands under HTTP_* instead
+    make_user(db)
+    response = client.get('/api/patients', headers={'medi.batch_user': 'doctor-1'})
+    assert response.status_code == 401
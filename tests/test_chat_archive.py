@@ -0,0 +1,57 @@
+import datetime
+
+from chat_archive import CHAT_CHUNK_SIZE, CHAT_LIVE_TAIL, compact_session, encode_chunk, load_messages
+
+START = datetime.datetime(2024, 1, 1, 9, 0, 0)
+
+
+def make_session(db, count, session_id='session-1'):
+    session_ref = db.collection('chat_sessions').document(session_id)
+    session_ref.set({'user_id': 'doctor-1', 'title': 'Long', 'live_messages': count})
+    for i in range(count):
+        session_ref.collection('messages').document(f'm{i:04d}').set({
+            'sender': 'user' if i % 2 else 'assistant',
+            'content': f'message {i}',
+            'timestamp': START + datetime.timedelta(seconds=i)
+        })
+    return session_ref
+
+
+def live_count(session_ref):
+    return len(session_ref.collection('messages').get())
+
+
+def test_compaction_keeps_every_message(db):
+    session_ref = make_session(db, 3 * CHAT_CHUNK_SIZE + CHAT_LIVE_TAIL + 7)
+    before = load_messages(db, 'session-1')
+
+    archived = compact_session(db, 'session-1')
+
+    assert archived == 3 * CHAT_CHUNK_SIZE
+    assert live_count(session_ref) == CHAT_LIVE_TAIL + 7
+    assert load_messages(db, 'session-1') == before
+    session = session_ref.get().to_dict()
+    assert session['chunk_count'] == 3
+    assert session['live_messages'] == CHAT_LIVE_TAIL + 7
+
+
+def test_short_sessions_are_left_alone(db):
+    session_ref = make_session(db, CHAT_LIVE_TAIL + CHAT_CHUNK_SIZE - 1)
+    assert compact_session(db, 'session-1') == 0
+    assert live_count(session_ref) == CHAT_LIVE_TAIL + CHAT_CHUNK_SIZE - 1
+
+
+def test_losing_a_concurrent_compaction_deletes_nothing(db):
+    count = CHAT_CHUNK_SIZE + CHAT_LIVE_TAIL
+    session_ref = make_session(db, count)
+    # Another worker committed chunk 0 after this one read chunk_count
+    session_ref.collection('chunks').document('000000').set({
+        'seq': 0, 'count': 1, 'first_timestamp': START, 'last_timestamp': START,
+        'data': encode_chunk([{'id': 'm0000', 'sender': 'assistant', 'content': 'message 0', 'timestamp': START}])
+    })
+
+    assert compact_session(db, 'session-1') == 0
+    assert live_count(session_ref) == count
+    chunk = session_ref.collection('chunks').document('000000').get().to_dict()
+    assert chunk['count'] == 1
+    assert [m['id'] for m in load_messages(db, 'session-1')] == [f'm{i:04d}' for i in range(count)]
@@ -0,0 +1,30 @@
+import os
+import stat
+
+import chat_search
+
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_default_index_is_private(tmp_path, monkeypatch):
+    directory = tmp_path / 'chat_search'
+    monkeypatch.setattr(chat_search, 'CHAT_SEARCH_INDEX_DIR', str(directory))
+    path = directory / 'chat_search.sqlite3'
+
+    index = chat_search.ChatSearchIndex(str(path))
+    index.add_messages('doctor-1', [('session-1', 'message-1', 'user', 'Chest pain since Monday', None)])
+
+    assert mode(directory) == 0o700
+    assert mode(path) == 0o600
+
+
+def test_existing_index_files_are_made_private(tmp_path):
+    path = tmp_path / 'chat_search.sqlite3'
+    path.touch()
+    os.chmod(path, 0o644)
+
+    chat_search.ChatSearchIndex(str(path))
+
+    assert mode(path) == 0o600
@@ -0,0 +1,29 @@
+import autosave
+import deletion_jobs
+from conftest import make_user, auth_headers
+from encryption import encrypt_note
+
+
+def test_patient_is_deleted_with_its_notes_and_pending_drafts(client, db, monkeypatch):
+    make_user(db)
+    db.collection('patients').document('patient-1').set({'doctor_id': 'doctor-1', 'name': 'Jane'})
+    db.collection('session_notes').document('note-1').set({
+        'id': 'note-1', 'patient_id': 'patient-1', 'doctor_id': 'doctor-1', 'note': encrypt_note('Original'), 'version': 1
+    })
+    headers = auth_headers('doctor-1')
+    client.put('/api/session-notes/note-1/autosave', json={'note': 'Draft'}, headers=headers)
+    # Run the job in the request, so it has finished when the response arrives
+    monkeypatch.setattr(deletion_jobs.job_executor, 'submit', lambda fn, *args: fn(*args))
+
+    response = client.delete('/api/patients/patient-1', headers=headers)
+
+    job = client.get(f"/api/patients/deletion-jobs/{response.get_json()['job_id']}", headers=headers).get_json()
+    assert job['status'] == 'completed'
+    assert job['deleted_notes'] == 1
+    assert autosave.drafts.get('note-1') is None
+    monkeypatch.setattr(autosave, 'AUTOSAVE_DEBOUNCE', 0)
+    autosave.drafts.flush_all()
+    remaining = {path for path in db.documents if not path.startswith(('users/', 'deletion_jobs/', 'patient_tombstones/'))}
+    assert remaining == set()
+    assert db.collection('patient_tombstones').document('patient-1').get().exists
+    assert client.get('/api/session-notes/note-1', headers=headers).status_code == 404
@@ -0,0 +1,87 @@
+import pytest
+
+import patient_routes
+from conftest import make_user, auth_headers
+from fieldsets import DOCUMENT_NAME_ONLY
+from loadtest import fake_firestore
+
+
+@pytest.fixture
+def projections(monkeypatch):
+    """The field paths of every select() projection from now on"""
+    selected = []
+    select = fake_firestore.Query.select
+
+    def recorded(self, field_paths):
+        selected.append(list(field_paths))
+        return select(self, field_paths)
+    monkeypatch.setattr(fake_firestore.Query, 'select', recorded)
+    return selected
+
+
+def get(client, url, fields):
+    return client.get(url, query_string={'fields': fields}, headers=auth_headers('doctor-1'))
+
+
+def add_patients(client):
+    for name, age in (('Jane Roe', 40), ('John Doe', 52)):
+        client.post('/api/patients', json={'name': name, 'age': age, 'gender': 'other', 'notes': 'Allergic to penicillin'},
+                    headers=auth_headers('doctor-1'))
+
+
+def test_list_fields_limit_the_projection_and_the_body(client, db, projections):
+    make_user(db)
+    add_patients(client)
+
+    response = get(client, '/api/patients', 'name,age')
+
+    assert projections == [['age', 'name']]
+    patients = sorted(response.get_json()['patients'], key=lambda patient: patient['name'])
+    assert [set(patient) for patient in patients] == [{'id', 'name', 'age'}] * 2
+    assert [(patient['name'], patient['age']) for patient in patients] == [('Jane Roe', 40), ('John Doe', 52)]
+
+
+def test_id_only_list_reads_just_the_document_names(client, db, projections):
+    make_user(db)
+    add_patients(client)
+
+    response = get(client, '/api/patients', 'id')
+
+    assert projections == [DOCUMENT_NAME_ONLY]
+    patients = response.get_json()['patients']
+    assert len(patients) == 2
+    assert all(set(patient) == {'id'} for patient in patients)
+
+
+def test_delta_sync_honours_fields(client, db, projections):
+    make_user(db)
+    add_patients(client)
+
+    response = client.get('/api/patients', query_string={'fields': 'age', 'updated_since': '2000-01-01T00:00:00Z'},
+                          headers=auth_headers('doctor-1'))
+
+    assert ['age'] in projections
+    assert all(set(patient) == {'id', 'age'} for patient in response.get_json()['patients'])
+
+
+def test_detail_fields_skip_decryption(client, db, monkeypatch):
+    make_user(db)
+    add_patients(client)
+    patient_id = get(client, '/api/patients', 'id').get_json()['patients'][0]['id']
+    monkeypatch.setattr(patient_routes, 'decrypt_data', lambda value: pytest.fail('name was decrypted'))
+
+    response = get(client, f'/api/patients/{patient_id}', 'age,gender')
+
+    patient = response.get_json()
+    assert set(patient) == {'id', 'age', 'gender'}
+    assert (patient['id'], patient['gender']) == (patient_id, 'other')
+    assert patient['age'] in (40, 52)
+
+
+def test_unknown_fields_are_rejected(client, db):
+    make_user(db)
+
+    response = get(client, '/api/patients', 'name,ssn')
+
+    assert response.status_code == 400
+    assert 'ssn' in response.get_json()['message']
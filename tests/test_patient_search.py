@@ -0,0 +1,82 @@
+from conftest import make_user, auth_headers
+from encryption import encrypt_data
+from patient_routes import normalize_name
+
+
+def add_patient(client, name, user_id='doctor-1'):
+    response = client.post('/api/patients', json={'name': name, 'age': 40}, headers=auth_headers(user_id))
+    return response.get_json()['patient_id']
+
+
+def search(client, query, user_id='doctor-1'):
+    response = client.get('/api/patients/search', query_string={'q': query}, headers=auth_headers(user_id))
+    assert response.status_code == 200, response.get_json()
+    return sorted(patient['name'] for patient in response.get_json()['patients'])
+
+
+def test_normalize_name():
+    assert normalize_name('  José   MARÍA ') == 'jose maria'
+    assert normalize_name('Núñez-García') == 'nunez garcia'
+    assert normalize_name(None) == ''
+
+
+def test_search_matches_name_and_word_prefixes(client, db):
+    make_user(db)
+    make_user(db, 'doctor-2', 'other@example.com')
+    add_patient(client, 'José María Núñez-García')
+    add_patient(client, 'Mark Jones')
+    add_patient(client, 'Marcus Other', user_id='doctor-2')
+
+    assert search(client, 'jo') == ['José María Núñez-García', 'Mark Jones']
+    assert search(client, 'mar') == ['José María Núñez-García', 'Mark Jones']
+    assert search(client, 'garc') == ['José María Núñez-García']
+    assert search(client, 'jose mar') == ['José María Núñez-García']
+    assert search(client, 'ones') == []
+    assert search(client, 'mar', user_id='doctor-2') == ['Marcus Other']
+
+
+def test_search_normalizes_case_accents_and_whitespace(client, db):
+    make_user(db)
+    add_patient(client, 'José María Núñez-García')
+
+    assert search(client, '  JOSÉ ') == ['José María Núñez-García']
+    assert search(client, 'NUNEZ') == ['José María Núñez-García']
+    assert search(client, 'Jose   Maria') == ['José María Núñez-García']
+    assert client.get('/api/patients/search', query_string={'q': ' J '}, headers=auth_headers('doctor-1')).status_code == 400
+
+
+def test_queries_longer_than_the_indexed_prefix_are_checked_after_decryption(client, db):
+    make_user(db)
+    add_patient(client, 'Konstantinopoulos Alexandros')
+
+    assert search(client, 'konstantinopoulos') == ['Konstantinopoulos Alexandros']
+    # Shares the indexed 16 character prefix, but not the name
+    assert search(client, 'konstantinopoulox') == []
+
+
+def test_renaming_a_patient_rewrites_its_tokens(client, db):
+    make_user(db)
+    patient_id = add_patient(client, 'Jane Roe')
+
+    client.put(f'/api/patients/{patient_id}', json={'name': 'Mary Smith'}, headers=auth_headers('doctor-1'))
+
+    assert search(client, 'roe') == []
+    assert search(client, 'ja') == []
+    assert search(client, 'smi') == ['Mary Smith']
+
+
+def test_reindex_names_indexes_existing_patients(app, client, db, monkeypatch):
+    make_user(db)
+    # Written before the blind index existed
+    db.collection('patients').document('legacy').set({'name': encrypt_data('Jane Roe'), 'age': 40, 'doctor_id': 'doctor-1'})
+    add_patient(client, 'Mary Smith')
+    assert search(client, 'jane') == []
+
+    # Reindexing also moves existing tokens to a new blind index key
+    monkeypatch.setenv('BLIND_INDEX_KEY', 'rotated-blind-index-key')
+    result = app.test_cli_runner().invoke(args=['patient', 'reindex-names'])
+
+    assert result.exit_code == 0, result.output
+    assert 'Reindexed 2 patient names' in result.output
+    assert search(client, 'jane') == ['Jane Roe']
+    assert search(client, 'smi') == ['Mary Smith']
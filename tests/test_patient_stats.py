@@ -0,0 +1,87 @@
+import deletion_jobs
+import patient_routes
+from conftest import make_user, auth_headers
+
+
+PATIENTS = [
+    {'name': 'Ann', 'age': 8, 'gender': 'female'},
+    {'name': 'Bob', 'age': 18, 'gender': 'male'},
+    {'name': 'Cid', 'age': 39, 'gender': 'male'},
+    {'name': 'Dee', 'age': 40, 'gender': 'other'},
+    {'name': 'Eve', 'age': 64},
+    {'name': 'Fay', 'age': 65, 'gender': 'female'},
+    {'name': 'Gus', 'age': '70'},
+]
+
+
+def full_scan(db, doctor_id):
+    """The statistics computed the slow way, from every patient and note document"""
+    patients = [data for path, data in db.documents.items() if path.startswith('patients/') and data['doctor_id'] == doctor_id]
+    notes = [data for path, data in db.documents.items() if path.startswith('session_notes/') and data['doctor_id'] == doctor_id]
+    ages = [patient['age'] for patient in patients if isinstance(patient['age'], int)]
+    genders = {gender: sum(patient.get('gender') == gender for patient in patients) for gender in patient_routes.GENDER_VALUES}
+    genders['unspecified'] = len(patients) - sum(genders.values())
+    return {
+        'patient_count': len(patients),
+        'session_note_count': len(notes),
+        'notes_per_patient': round(len(notes) / len(patients), 2) if patients else 0,
+        'average_age': sum(ages) / len(ages) if ages else None,
+        'gender_distribution': genders,
+        'age_distribution': {
+            label: sum(low <= age and (high is None or age < high) for age in ages)
+            for label, low, high in patient_routes.AGE_BUCKETS
+        }
+    }
+
+
+def stats(client):
+    return client.get('/api/patients/stats', headers=auth_headers('doctor-1')).get_json()
+
+
+def add_patients(client):
+    return [
+        client.post('/api/patients', json=patient, headers=auth_headers('doctor-1')).get_json()['patient_id']
+        for patient in PATIENTS
+    ]
+
+
+def test_stats_match_a_full_scan(client, db):
+    make_user(db)
+    make_user(db, 'doctor-2', 'other@example.com')
+    patient_ids = add_patients(client)
+    for patient_id in patient_ids[:3]:
+        client.post(f'/api/patients/{patient_id}/session-note', json={'note': 'Checkup'}, headers=auth_headers('doctor-1'))
+    client.post('/api/patients', json={'name': 'Hal', 'age': 30, 'gender': 'male'}, headers=auth_headers('doctor-2'))
+
+    result = stats(client)
+
+    assert result == full_scan(db, 'doctor-1')
+    assert result['patient_count'] == 7
+    assert result['gender_distribution']['unspecified'] == 2
+
+
+def test_patient_and_note_writes_drop_the_cached_stats(client, db, monkeypatch):
+    make_user(db)
+    headers = auth_headers('doctor-1')
+    patient_id = add_patients(client)[0]
+    assert stats(client)['patient_count'] == 7
+
+    client.post('/api/patients', json={'name': 'Ian', 'age': 50}, headers=headers)
+    assert stats(client) == full_scan(db, 'doctor-1')
+
+    client.put(f'/api/patients/{patient_id}', json={'age': 70, 'gender': 'other'}, headers=headers)
+    assert stats(client) == full_scan(db, 'doctor-1')
+
+    note_id = client.post(f'/api/patients/{patient_id}/session-note', json={'note': 'Checkup'}, headers=headers).get_json()['session_id']
+    assert stats(client)['session_note_count'] == 1
+
+    client.delete(f'/api/session-notes/{note_id}', headers=headers)
+    assert stats(client)['session_note_count'] == 0
+
+    client.post(f'/api/patients/{patient_id}/session-note', json={'note': 'Checkup'}, headers=headers)
+    assert stats(client)['session_note_count'] == 1
+    monkeypatch.setattr(deletion_jobs.job_executor, 'submit', lambda fn, *args: fn(*args))
+    client.delete(f'/api/patients/{patient_id}', headers=headers)
+    result = stats(client)
+    assert result == full_scan(db, 'doctor-1')
+    assert (result['patient_count'], result['session_note_count']) == (7, 0)
@@ -0,0 +1,101 @@
+import datetime
+
+import deletion_jobs
+import patient_routes
+from conftest import make_user, auth_headers
+from encryption import encrypt_data
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def sync(client, since, user_id='doctor-1'):
+    if isinstance(since, datetime.datetime):
+        since = since.isoformat()
+    response = client.get('/api/patients', query_string={'updated_since': since}, headers=auth_headers(user_id))
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def add_patient(client, name, user_id='doctor-1'):
+    response = client.post('/api/patients', json={'name': name, 'age': 40}, headers=auth_headers(user_id))
+    return response.get_json()['patient_id']
+
+
+def names(changes):
+    return sorted(patient['name'] for patient in changes['patients'])
+
+
+def test_watermark_overlaps_writes_committed_during_the_sync(client, db):
+    make_user(db)
+    add_patient(client, 'Jane Roe')
+    started = now()
+
+    changes = sync(client, started - datetime.timedelta(hours=1))
+
+    watermark = patient_routes.parse_watermark(changes['watermark'])
+    assert started - patient_routes.PATIENT_SYNC_OVERLAP <= watermark <= now() - patient_routes.PATIENT_SYNC_OVERLAP
+    assert names(changes) == ['Jane Roe']
+    assert (changes['full'], changes['deleted'], changes['count']) == (False, [], 1)
+
+    # A write stamped just before the sync started but committed after it read
+    db.collection('patients').document('late').set({
+        'name': encrypt_data('Late Commit'), 'age': 50, 'doctor_id': 'doctor-1',
+        'updated_at': started - datetime.timedelta(seconds=1)
+    })
+    changes = sync(client, changes['watermark'])
+
+    # Patients inside the overlap are sent again; clients upsert them by id
+    assert names(changes) == ['Jane Roe', 'Late Commit']
+    assert sync(client, now())['patients'] == []
+
+
+def test_sync_reports_updates_and_deletions_since_the_watermark(client, db, monkeypatch):
+    make_user(db)
+    make_user(db, 'doctor-2', 'other@example.com')
+    kept = add_patient(client, 'Jane Roe')
+    deleted = add_patient(client, 'John Doe')
+    other = add_patient(client, 'Mary Smith', user_id='doctor-2')
+    since = now()
+    monkeypatch.setattr(deletion_jobs.job_executor, 'submit', lambda fn, *args: fn(*args))
+
+    client.put(f'/api/patients/{kept}', json={'name': 'Jane Poe'}, headers=auth_headers('doctor-1'))
+    client.delete(f'/api/patients/{deleted}', headers=auth_headers('doctor-1'))
+    client.delete(f'/api/patients/{other}', headers=auth_headers('doctor-2'))
+    # A tombstone older than the watermark was already reported
+    db.collection('patient_tombstones').document('old').set({
+        'patient_id': 'old', 'doctor_id': 'doctor-1', 'deleted_at': since - datetime.timedelta(minutes=5)
+    })
+
+    changes = sync(client, since)
+
+    assert names(changes) == ['Jane Poe']
+    assert changes['deleted'] == [deleted]
+    assert changes['full'] is False
+    assert sync(client, since, user_id='doctor-2')['deleted'] == [other]
+
+
+def test_sync_older_than_the_tombstone_retention_is_a_full_resync(client, db):
+    make_user(db)
+    add_patient(client, 'Jane Roe')
+    add_patient(client, 'John Doe')
+    db.collection('patient_tombstones').document('gone').set({
+        'patient_id': 'gone', 'doctor_id': 'doctor-1', 'deleted_at': now()
+    })
+    retention = datetime.timedelta(days=patient_routes.PATIENT_TOMBSTONE_RETENTION_DAYS)
+
+    recent = sync(client, now() - retention + datetime.timedelta(hours=1))
+    changes = sync(client, now() - retention - datetime.timedelta(hours=1))
+
+    assert recent['full'] is False
+    assert recent['deleted'] == ['gone']
+    assert changes['full'] is True
+    assert changes['deleted'] == []
+    assert names(changes) == ['Jane Roe', 'John Doe']
+
+
+def test_updated_since_must_be_a_timestamp(client, db):
+    make_user(db)
+    response = client.get('/api/patients', query_string={'updated_since': 'yesterday'}, headers=auth_headers('doctor-1'))
+    assert response.status_code == 400
@@ -0,0 +1,72 @@
+import pytest
+from cryptography.fernet import Fernet
+
+import encryption
+from encryption import decrypt_data, encrypt_data, is_plaintext, reencrypt
+
+
+def foreign_token(value):
+    """Ciphertext under a key that isn't configured"""
+    return Fernet(Fernet.generate_key()).encrypt(value.encode()).decode()
+
+
+def test_reencrypt_refuses_ciphertext_that_does_not_decrypt():
+    with pytest.raises(ValueError):
+        reencrypt(foreign_token('Jane Roe'))
+    with pytest.raises(ValueError):
+        reencrypt(foreign_token('Jane Roe'), binary=True)
+
+
+def test_reencrypt_encrypts_plaintext():
+    assert is_plaintext('Jane Roe')
+    assert is_plaintext('abcd')
+    assert not is_plaintext(foreign_token('Jane Roe'))
+    assert not is_plaintext(encrypt_data('Jane Roe'))
+
+    assert decrypt_data(reencrypt('Jane Roe')) == 'Jane Roe'
+    assert decrypt_data(reencrypt('Follow up in two weeks', binary=True)) == 'Follow up in two weeks'
+
+
+def test_sweep_encrypts_plaintext_and_skips_undecryptable_documents(app, db):
+    broken = foreign_token('John Doe')
+    db.collection('patients').document('broken').set({'name': broken, 'doctor_id': 'doctor-1'})
+    db.collection('patients').document('plain').set({'name': 'Jane Roe', 'doctor_id': 'doctor-1'})
+    db.collection('patients').document('fine').set({'name': encrypt_data('Jane Doe'), 'doctor_id': 'doctor-1'})
+    db.collection('session_notes').document('note-1').set({'note': 'Follow up in two weeks', 'doctor_id': 'doctor-1'})
+
+    result = app.test_cli_runner().invoke(args=['patient', 'reencrypt', '--rate', '1000'])
+
+    assert result.exit_code == 0, result.output
+    assert 'Skipped patients/broken' in result.output
+    assert 'Re-encrypted 2 documents, 2 of them with plaintext fields' in result.output
+    assert db.collection('patients').document('broken').get().get('name') == broken
+    plain = db.collection('patients').document('plain').get().get('name')
+    assert plain.startswith(encryption.ENVELOPE_PREFIX)
+    assert decrypt_data(plain) == 'Jane Roe'
+    note = db.collection('session_notes').document('note-1').get().get('note')
+    assert isinstance(note, bytes)
+    assert decrypt_data(note) == 'Follow up in two weeks'
+    assert decrypt_data(db.collection('patients').document('fine').get().get('name')) == 'Jane Doe'
+
+
+def test_reencrypt_rate_must_be_positive(app, db):
+    result = app.test_cli_runner().invoke(args=['patient', 'reencrypt', '--rate', '0'])
+    assert result.exit_code != 0
+    assert 'Invalid value' in result.output
+
+
+def test_sweep_pages_through_every_document(app, db, monkeypatch):
+    import patient_routes
+    monkeypatch.setattr(patient_routes, 'REENCRYPT_PAGE_SIZE', 3)
+    # Legacy values written with the master key directly
+    legacy = encryption.fernet_for_key(encryption.get_encryption_key())
+    for i in range(7):
+        db.collection('patients').document(f'p{i}').set({'name': legacy.encrypt(f'Patient {i}'.encode()).decode()})
+
+    result = app.test_cli_runner().invoke(args=['patient', 'reencrypt', '--rate', '1000'])
+
+    assert 'Re-encrypted 7 documents' in result.output
+    for i in range(7):
+        name = db.collection('patients').document(f'p{i}').get().get('name')
+        assert name.startswith(encryption.ENVELOPE_PREFIX)
+        assert decrypt_data(name) == f'Patient {i}'
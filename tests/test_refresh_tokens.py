@@ -0,0 +1,143 @@
+import datetime
+
+import pytest
+
+import refresh_tokens
+from conftest import make_user
+from refresh_tokens import RefreshTokenError, hash_token, issue_refresh_token, rotate_refresh_token
+
+
+def refresh(client, token, device_id='device-1'):
+    return client.post('/api/refresh-token', json={'refresh_token': token, 'device_id': device_id})
+
+
+def token_document(db, token):
+    return db.collection('refresh_tokens').document(hash_token(token)).get().to_dict()
+
+
+def family_revoked(db, token):
+    family_id = token_document(db, token)['family_id']
+    docs = db.collection('refresh_tokens').where('family_id', '==', family_id).stream()
+    return all(doc.to_dict()['revoked'] for doc in docs)
+
+
+def age_rotation(db, token, seconds):
+    """Move the rotation of a token into the past"""
+    rotated_at = refresh_tokens.now() - datetime.timedelta(seconds=seconds)
+    db.collection('refresh_tokens').document(hash_token(token)).update({'rotated_at': rotated_at})
+
+
+def start_login(db, user_id='doctor-1'):
+    db.collection('login_verifications').document('verification-1').set({
+        'user_id': user_id,
+        'totp': '123456',
+        'expires_at': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=5)
+    })
+
+
+def test_refresh_rotates_the_token(client, db):
+    make_user(db)
+    token = issue_refresh_token(db, 'doctor-1', 'device-1')
+
+    response = refresh(client, token)
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['token']
+    assert body['refresh_token'] != token
+    assert refresh(client, body['refresh_token']).status_code == 200
+
+
+def test_reuse_after_the_grace_period_revokes_the_family(client, db):
+    make_user(db)
+    token = issue_refresh_token(db, 'doctor-1', 'device-1')
+    successor = refresh(client, token).get_json()['refresh_token']
+    age_rotation(db, token, refresh_tokens.REFRESH_TOKEN_REUSE_GRACE.total_seconds() + 1)
+
+    assert refresh(client, token).status_code == 401
+    assert family_revoked(db, token)
+    assert refresh(client, successor).status_code == 401
+
+
+def test_one_retry_within_the_grace_period_is_recorded(client, db):
+    make_user(db)
+    token = issue_refresh_token(db, 'doctor-1', 'device-1')
+    successor = refresh(client, token).get_json()['refresh_token']
+
+    assert refresh(client, token).status_code == 409
+    assert token_document(db, token)['reuse_count'] == 1
+    assert not family_revoked(db, token)
+
+    assert refresh(client, token).status_code == 401
+    assert family_revoked(db, token)
+    assert refresh(client, successor).status_code == 401
+
+
+def test_reuse_from_another_device_within_the_grace_period_revokes(client, db):
+    make_user(db)
+    token = issue_refresh_token(db, 'doctor-1', 'device-1')
+    refresh(client, token)
+
+    assert refresh(client, token, device_id='device-2').status_code == 401
+    assert family_revoked(db, token)
+
+
+def test_token_presented_from_another_device_revokes_the_family(client, db):
+    make_user(db)
+    token = issue_refresh_token(db, 'doctor-1', 'device-1')
+
+    assert refresh(client, token, device_id='device-2').status_code == 401
+    assert family_revoked(db, token)
+    assert refresh(client, token).status_code == 401
+
+
+def test_refresh_requires_the_device_id(client, db):
+    make_user(db)
+    token = issue_refresh_token(db, 'doctor-1', 'device-1')
+
+    response = client.post('/api/refresh-token', json={'refresh_token': token})
+
+    assert response.status_code == 400
+    assert not family_revoked(db, token)
+
+
+def test_no_refresh_token_is_issued_without_a_device(client, db):
+    make_user(db)
+    start_login(db)
+
+    response = client.post('/api/verify-login', json={'verification_id': 'verification-1', 'totp': '123456'})
+
+    assert response.status_code == 200
+    assert 'refresh_token' not in response.get_json()
+    assert not list(db.collection('refresh_tokens').stream())
+    with pytest.raises(ValueError):
+        issue_refresh_token(db, 'doctor-1', None)
+
+
+def test_login_with_a_device_issues_a_bound_token(client, db):
+    make_user(db)
+    start_login(db)
+
+    response = client.post('/api/verify-login', json={
+        'verification_id': 'verification-1', 'totp': '123456', 'device_id': 'device-1'
+    })
+
+    token = response.get_json()['refresh_token']
+    assert token_document(db, token)['device'] == refresh_tokens.hash_device('device-1')
+
+
+def test_concurrent_rotation_loses_with_a_conflict(db, monkeypatch):
+    make_user(db)
+    token = issue_refresh_token(db, 'doctor-1', 'device-1')
+    token_ref = db.collection('refresh_tokens').document(hash_token(token))
+    batch = db.batch
+
+    def rotated_meanwhile():
+        # Another worker rotates the token between the read and the write
+        token_ref.update({'rotated_at': refresh_tokens.now()})
+        return batch()
+    monkeypatch.setattr(db, 'batch', rotated_meanwhile)
+
+    with pytest.raises(RefreshTokenError) as error:
+        rotate_refresh_token(db, token, 'device-1')
+    assert error.value.code == 409
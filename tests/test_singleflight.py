@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+import singleflight
+from singleflight import SingleFlight
+
+
+def start_leader(group, key, **kwargs):
+    """Run a call for key on another thread; returns the thread and an event that lets fn finish"""
+    started, release = threading.Event(), threading.Event()
+    results = []
+
+    def fn():
+        started.set()
+        release.wait(5)
+        return ['leader']
+
+    def run():
+        try:
+            results.append(group.do(key, fn, **kwargs))
+        except Exception as e:
+            results.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert started.wait(5)
+    return thread, release, results
+
+
+def follow(group, key, results):
+    thread = threading.Thread(target=lambda: results.append(group.do(key, lambda: ['follower'])))
+    thread.start()
+    return thread
+
+
+def test_concurrent_callers_share_one_call():
+    group = SingleFlight()
+    leader, release, results = start_leader(group, ('patients', 'u1'))
+    follower = follow(group, ('patients', 'u1'), results)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert results == [['leader'], ['leader']]
+
+
+def test_results_are_not_shared_after_the_call():
+    group = SingleFlight()
+    assert group.do(('k',), lambda: 1) == 1
+    assert group.do(('k',), lambda: 2) == 2
+
+
+def test_errors_reach_every_caller():
+    group = SingleFlight()
+
+    def fail():
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        group.do(('k',), fail)
+    assert group.do(('k',), lambda: 'ok') == 'ok'
+
+
+def test_retained_result_is_served_once(db):
+    group = SingleFlight()
+    group.do(('patients', 'u1'), lambda: ['prefetched'], retain=10)
+    assert group.do(('patients', 'u1'), lambda: ['fresh']) == ['prefetched']
+    assert group.do(('patients', 'u1'), lambda: ['fresh']) == ['fresh']
+
+
+def test_forget_drops_retained_results(db):
+    group = SingleFlight()
+    group.do(('patients', 'u1'), lambda: ['prefetched'], retain=10)
+    group.forget('patients', 'u1')
+    assert group.do(('patients', 'u1'), lambda: ['fresh']) == ['fresh']
+
+
+def test_followers_are_released_when_sealing_fails(monkeypatch):
+    def broken_seal(value):
+        raise ValueError('no encryption key')
+
+    monkeypatch.setattr(singleflight, 'seal', broken_seal)
+    group = SingleFlight()
+    leader, release, results = start_leader(group, ('patients', 'u1'), retain=10)
+    follower = follow(group, ('patients', 'u1'), results)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert not follower.is_alive()
+    assert results == [['leader'], ['leader']]
+    assert group.retained == {}
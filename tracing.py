@@ -0,0 +1,329 @@
+from flask import request, g
+from contextlib import contextmanager
+from functools import wraps
+import contextvars
+import datetime
+import grpc
+import json
+import logging
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+
+# Request-scoped tracing and structured logging.
+#
+# Every request gets a root span, continuing the caller's trace when a W3C
+# traceparent header is sent. Firestore RPCs (through a gRPC interceptor),
+# encryption, SMTP and password hashing record child spans. Spans are only
+# recorded inside a request; background work without a parent is not traced.
+#
+# TRACE_EXPORTER selects where finished spans go:
+#   none     tracing disabled (default)
+#   console  one JSON line per span on stderr
+#   file     one JSON line per span appended to TRACE_FILE
+#   otlp     an OpenTelemetry collector, configured with the standard OTEL_*
+#            variables (needs opentelemetry-sdk and opentelemetry-exporter-otlp)
+#
+# Logs are written as JSON lines carrying the trace and span id of the request.
+
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'none').lower()
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.ndjson')
+SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', 'ai-medi-backend')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+logger = logging.getLogger(__name__)
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, kind='internal', attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+    def record_error(self, error):
+        self.error = str(error) or type(error).__name__
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            if exporter:
+                try:
+                    exporter.export(self)
+                except Exception as e:
+                    logger.warning('Span export failed: %s', e)
+
+    def to_dict(self):
+        # Field names follow the OTLP JSON encoding
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': self.start_time,
+            'endTimeUnixNano': self.end_time,
+            'durationMs': round((self.end_time - self.start_time) / 1e6, 3),
+            'attributes': self.attributes,
+            'status': {'code': 'ERROR', 'message': self.error} if self.error else {'code': 'UNSET'},
+            'service': SERVICE_NAME
+        }
+
+
+class StreamExporter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+class FileExporter(StreamExporter):
+    def __init__(self, path):
+        super().__init__(open(path, 'a', buffering=1))
+
+
+class OTLPExporter:
+    """Hands finished spans to the OpenTelemetry SDK's batching OTLP exporter"""
+
+    def __init__(self):
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import ReadableSpan
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.trace import SpanContext, SpanKind, TraceFlags
+        from opentelemetry.trace.status import Status, StatusCode
+
+        self.ReadableSpan = ReadableSpan
+        self.SpanContext = SpanContext
+        self.TraceFlags = TraceFlags
+        self.Status = Status
+        self.StatusCode = StatusCode
+        self.kinds = {'server': SpanKind.SERVER, 'client': SpanKind.CLIENT, 'internal': SpanKind.INTERNAL}
+        self.resource = Resource.create({'service.name': SERVICE_NAME})
+        self.processor = BatchSpanProcessor(OTLPSpanExporter())
+
+    def context(self, trace_id, span_id):
+        return self.SpanContext(int(trace_id, 16), int(span_id, 16), is_remote=False,
+                                trace_flags=self.TraceFlags(self.TraceFlags.SAMPLED))
+
+    def export(self, span):
+        self.processor.on_end(self.ReadableSpan(
+            name=span.name,
+            context=self.context(span.trace_id, span.span_id),
+            parent=self.context(span.trace_id, span.parent_id) if span.parent_id else None,
+            resource=self.resource,
+            attributes=span.attributes,
+            kind=self.kinds[span.kind],
+            status=self.Status(self.StatusCode.ERROR, span.error) if span.error else self.Status(self.StatusCode.UNSET),
+            start_time=span.start_time,
+            end_time=span.end_time
+        ))
+
+
+def create_exporter():
+    if TRACE_EXPORTER == 'console':
+        return StreamExporter(sys.stderr)
+    if TRACE_EXPORTER == 'file':
+        return FileExporter(TRACE_FILE)
+    if TRACE_EXPORTER == 'otlp':
+        try:
+            return OTLPExporter()
+        except ImportError:
+            logger.warning('TRACE_EXPORTER=otlp needs opentelemetry-sdk and opentelemetry-exporter-otlp; tracing disabled')
+    return None
+
+
+exporter = create_exporter()
+
+
+def start_span(name, kind='internal', **attributes):
+    """Start a child of the current span without making it current; None outside a traced request"""
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(name, parent.trace_id, parent.span_id, kind, attributes)
+
+
+@contextmanager
+def span(name, kind='internal', **attributes):
+    """Record the enclosed block as a child span of the current one"""
+    child = start_span(name, kind, **attributes)
+    if child is None:
+        yield None
+        return
+    token = current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.record_error(e)
+        raise
+    finally:
+        current_span.reset(token)
+        child.end()
+
+
+def traced(name):
+    """Decorator recording every call of a function as a span"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if current_span.get() is None:
+                return f(*args, **kwargs)
+            with span(name):
+                return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def propagate(fn):
+    """Carry the current trace into fn when it runs on another thread, e.g. in an executor"""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+class FirestoreTracingInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.UnaryStreamClientInterceptor):
+    """Records a client span for every Firestore RPC, ending when the call completes"""
+
+    def intercept(self, continuation, client_call_details, request_message):
+        method = client_call_details.method
+        method = method.decode() if isinstance(method, bytes) else method
+        rpc_span = start_span(f"firestore.{method.rsplit('/', 1)[-1]}", kind='client',
+                              **{'rpc.system': 'grpc', 'rpc.method': method})
+        if rpc_span is None:
+            return continuation(client_call_details, request_message)
+
+        try:
+            call = continuation(client_call_details, request_message)
+        except Exception as e:
+            rpc_span.record_error(e)
+            rpc_span.end()
+            raise
+
+        def done(completed):
+            code = completed.code()
+            if code is not None and code != grpc.StatusCode.OK:
+                rpc_span.record_error(code.name)
+            rpc_span.end()
+
+        call.add_done_callback(done)
+        return call
+
+    def intercept_unary_unary(self, continuation, client_call_details, request_message):
+        return self.intercept(continuation, client_call_details, request_message)
+
+    def intercept_unary_stream(self, continuation, client_call_details, request_message):
+        return self.intercept(continuation, client_call_details, request_message)
+
+
+def request_span(method, route, path, traceparent):
+    """The root span of a request, continuing the trace of its traceparent header if valid"""
+    trace_id, parent_id = None, None
+    match = TRACEPARENT_PATTERN.match(traceparent.strip().lower())
+    if match and match.group(1) != '0' * 32:
+        trace_id, parent_id = match.group(1), match.group(2)
+
+    return Span(
+        f"{method} {route}",
+        trace_id or secrets.token_hex(16),
+        parent_id,
+        kind='server',
+        attributes={'http.method': method, 'http.target': path}
+    )
+
+
+def traceparent_header(root):
+    """The traceparent header value naming a span, returned with the response"""
+    return f'00-{root.trace_id}-{root.span_id}-01'
+
+
+def before_request():
+    root = request_span(
+        request.method,
+        request.url_rule.rule if request.url_rule else request.path,
+        request.path,
+        request.headers.get('traceparent', '')
+    )
+    g.trace_span = root
+    g.trace_token = current_span.set(root)
+
+
+def after_request(response):
+    root = g.get('trace_span')
+    if root is not None:
+        root.set_attribute('http.status_code', response.status_code)
+        if response.status_code >= 500:
+            root.record_error(f'HTTP {response.status_code}')
+        response.headers['traceparent'] = traceparent_header(root)
+    return response
+
+
+def teardown_request(exc):
+    root = g.pop('trace_span', None)
+    token = g.pop('trace_token', None)
+    if root is None:
+        return
+    if exc is not None:
+        root.record_error(exc)
+    # Streamed responses are still running here; they end up in the root span's duration
+    root.end()
+    try:
+        current_span.reset(token)
+    except ValueError:
+        # Teardown ran in a different context than before_request
+        current_span.set(None)
+
+
+def init_app(app):
+    if exporter is None:
+        return
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        active = current_span.get()
+        if active is not None:
+            entry['trace_id'] = active.trace_id
+            entry['span_id'] = active.span_id
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root_logger = logging.getLogger()
+    root_logger.handlers = [handler]
+    root_logger.setLevel(LOG_LEVEL)